@@ -0,0 +1,59 @@
+# coding: utf-8
+
+"""
+Benchmark of decoding the documents of an OP_REPLY.
+
+compares decoding every document by itself (`BSON.decode` per document,
+which is what `Collection.find` used to do) with decoding the whole
+documents section at once (`ReplyDocuments.decode_all`).
+
+usage: python bench/bench_decode.py [n_documents]
+"""
+
+import struct
+import sys
+import time
+
+import bson
+
+from txmongo2.protocol import MongoDecoder, OP_REPLY
+
+
+def encode_reply(documents, ):
+    documents = [bson.BSON.encode(i) for i in documents]
+    body = struct.pack('<iqii', 0, 0, 0, len(documents), ) + ''.join(documents)
+    return struct.pack('<iiii', 16 + len(body), 1, 0, OP_REPLY, ) + body
+
+
+def make_document(size, ):
+    document = {'_id': bson.ObjectId(), 'n': 1, 'f': 1.5, 'tags': ['a', 'b', 'c'], }
+    document['s'] = 'x' * max(0, size - len(bson.BSON.encode(document)) - 8)
+    return document
+
+
+def measure(fn, n_documents, repeat=5, ):
+    _best = None
+    for i in range(repeat) :
+        _start = time.time()
+        fn()
+        _elapsed = time.time() - _start
+        _best = _elapsed if _best is None else min(_best, _elapsed, )
+
+    return n_documents / _best
+
+
+def main(n_documents=20000, ):
+    print 'bson C extension: %s' % bson.has_c()
+    for size in (200, 4096, ) :
+        decoder = MongoDecoder()
+        decoder.feed(encode_reply([make_document(size, ) for i in xrange(n_documents)], ), )
+        documents = decoder.next().documents
+
+        _before = measure(lambda : [d.decode(as_class=dict) for d in documents], n_documents, )
+        _after = measure(lambda : documents.decode_all(as_class=dict), n_documents, )
+        print '%5d bytes: per document %10d docs/sec, whole batch %10d docs/sec (x%.2f)' % (
+                size, _before, _after, _after / _before, )
+
+
+if __name__ == '__main__' :
+    main(*[int(i) for i in sys.argv[1:]])
@@ -1,6 +1,6 @@
 # coding: utf-8
 
-from . import filter
+from . import filter, selection
 from .connection import (
         AutoDetectConnection,
         SingleConnection,
@@ -14,5 +14,13 @@ from .connection import (
     )
 from .database import Database
 from .collection import Collection
+from .bulk import (
+        InsertOne,
+        UpdateOne,
+        UpdateMany,
+        ReplaceOne,
+        DeleteOne,
+        DeleteMany,
+    )
 
 
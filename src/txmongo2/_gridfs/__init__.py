@@ -56,7 +56,7 @@ class GridFS(object):
         self.__collection = database[collection]
         self.__files = self.__collection.files
         self.__chunks = self.__collection.chunks
-        self.__chunks.create_index(filter.sort(ASCENDING("files_id") + ASCENDING("n")),
+        self.__chunks.ensure_index(filter.sort(ASCENDING("files_id") + ASCENDING("n")),
                                    unique=True)
 
     def new_file(self, **kwargs):
@@ -0,0 +1,323 @@
+# coding: utf-8
+
+"""
+Bulk writes.
+
+`Collection.bulk_write()` takes a list of `InsertOne`, `UpdateOne`,
+`UpdateMany`, `ReplaceOne`, `DeleteOne` and `DeleteMany` operations. They
+are grouped by kind and split into batches which fit the limits the server
+reported in `ismaster` (`maxWriteBatchSize`, `maxMessageSizeBytes` and
+`maxBsonObjectSize`); every batch is one write command, or with the legacy
+protocol one message per operation acknowledged by its own `getlasterror`.
+"""
+
+import bson
+from bson import ObjectId
+from bson.son import SON
+from pymongo import errors
+from twisted.internet import defer
+
+from . import codec
+from .protocol import (
+        Delete,
+        Insert,
+        Update,
+        DELETE_SINGLE_REMOVE,
+        INSERT_CONTINUE_ON_ERROR,
+        MESSAGE_OVERHEAD,
+        UPDATE_MULTI,
+        UPDATE_UPSERT,
+    )
+
+# name of the document sequence of each write command
+IDENTIFIERS = {
+        'insert': 'documents',
+        'update': 'updates',
+        'delete': 'deletes',
+    }
+
+
+class InsertOne (object, ) :
+    """
+    insert a document, either a dict or an already encoded `bson.BSON`
+    which is sent as is.
+    """
+    kind = 'insert'
+
+    def __init__ (self, document, ) :
+        if not isinstance(document, (dict, bson.BSON, ), ) :
+            raise TypeError('document must be an instance of dict or bson.BSON', )
+        self.document = document
+
+    def statement (self, ) :
+        if isinstance(self.document, dict, ) and '_id' not in self.document :
+            self.document['_id'] = ObjectId()
+        return self.document
+
+
+class UpdateOne (object, ) :
+    kind = 'update'
+    multi = False
+
+    def __init__ (self, spec, document, upsert=False, ) :
+        if not isinstance(spec, dict, ) :
+            raise TypeError('spec must be an instance of dict', )
+        if not isinstance(document, dict, ) :
+            raise TypeError('document must be an instance of dict', )
+        self.spec = spec
+        self.document = document
+        self.upsert = upsert
+
+    def statement (self, ) :
+        return SON([('q', self.spec, ), ('u', self.document, ),
+                    ('upsert', bool(self.upsert, ), ), ('multi', self.multi, ), ], )
+
+
+class UpdateMany (UpdateOne, ) :
+    multi = True
+
+
+class ReplaceOne (UpdateOne, ) :
+    pass
+
+
+class DeleteOne (object, ) :
+    kind = 'delete'
+    limit = 1
+
+    def __init__ (self, spec, ) :
+        if not isinstance(spec, dict, ) :
+            raise TypeError('spec must be an instance of dict', )
+        self.spec = spec
+
+    def statement (self, ) :
+        return SON([('q', self.spec, ), ('limit', self.limit, ), ], )
+
+
+class DeleteMany (DeleteOne, ) :
+    limit = 0
+
+
+def split (operations, ordered, max_batch_size, max_message_size, max_bson_size, encoded=None, ) :
+    """
+    group `(index, operation, encoded)` tuples into batches of one kind;
+    ordered operations keep their order, unordered ones are grouped by kind.
+    `encoded` are the statements of the operations when already encoded.
+    Fails with `DocumentTooLarge` before anything is sent.
+    """
+    if encoded is None :
+        encoded = [codec.encode(_operation.statement(), ) for _operation in operations]
+
+    _groups = list()
+    _by_kind = dict()
+    for _index, _operation in enumerate(operations, ) :
+        _encoded = encoded[_index]
+        if len(_encoded, ) > max_bson_size :
+            raise errors.DocumentTooLarge(
+                    'operation %d is %d bytes, the maximum is %d bytes.' % (
+                        _index, len(_encoded, ), max_bson_size, ), )
+
+        if ordered :
+            if not _groups or _groups[-1][0] != _operation.kind :
+                _groups.append((_operation.kind, list(), ), )
+            _group = _groups[-1][1]
+        else :
+            if _operation.kind not in _by_kind :
+                _by_kind[_operation.kind] = list()
+                _groups.append((_operation.kind, _by_kind[_operation.kind], ), )
+            _group = _by_kind[_operation.kind]
+
+        _group.append((_index, _operation, _encoded, ), )
+
+    _max_bytes = max_message_size - MESSAGE_OVERHEAD
+    _batches = list()
+    for _kind, _group in _groups :
+        _batch = list()
+        _n_bytes = 0
+        for _item in _group :
+            if _batch and (len(_batch, ) >= max_batch_size or _n_bytes + len(_item[2], ) > _max_bytes) :
+                _batches.append((_kind, _batch, ), )
+                _batch = list()
+                _n_bytes = 0
+
+            _batch.append(_item, )
+            _n_bytes += len(_item[2], )
+
+        if _batch :
+            _batches.append((_kind, _batch, ), )
+
+    return _batches
+
+
+@defer.inlineCallbacks
+def gather (deferreds, ) :
+    """wait for all `deferreds`, failing with the first error"""
+    try :
+        yield defer.gatherResults(deferreds, consumeErrors=True, )
+    except defer.FirstError, e :
+        e.subFailure.raiseException()
+
+
+class BulkWrite (object, ) :
+    """
+    Run the batches of a bulk write on one protocol.
+
+    ordered batches are sent one after the other and stop at the first
+    error; unordered batches are all sent at once and acknowledged
+    together. The result counts the operations like the bulk API of
+    pymongo, with the errors indexed by the position of the operation in
+    the request; `BulkWriteError` is raised with it when there are errors.
+    """
+
+    def __init__ (self, collection, proto, ordered=True, safe=True, ) :
+        self._collection = collection
+        self._proto = proto
+        self._ordered = ordered
+        self._safe = safe
+
+        self.result = {
+                'nInserted': 0,
+                'nUpserted': 0,
+                'nMatched': 0,
+                'nModified': 0,
+                'nRemoved': 0,
+                'upserted': list(),
+                'writeErrors': list(),
+                'writeConcernErrors': list(),
+            }
+
+    @defer.inlineCallbacks
+    def execute (self, operations, ) :
+        _encoded = yield codec.get_executor().encode([_operation.statement() for _operation in operations], )
+        _batches = split(operations, self._ordered, self._proto.max_write_batch_size,
+                         self._proto.max_message_size, self._proto.max_bson_size, encoded=_encoded, )
+        if self._proto.op_msg_enabled() :
+            _send = self._send_command
+        else :
+            _send = self._send_legacy
+
+        if self._ordered :
+            for _kind, _batch in _batches :
+                yield _send(_kind, _batch, )
+                if self.result['writeErrors'] :
+                    break
+        else :
+            yield gather([_send(_kind, _batch, ) for _kind, _batch in _batches], )
+
+        if not self._safe :
+            defer.returnValue(None, )
+
+        self.result['writeErrors'].sort(key=lambda error : error['index'], )
+        self.result['upserted'].sort(key=lambda upserted : upserted['index'], )
+        if self.result['writeErrors'] or self.result['writeConcernErrors'] :
+            raise errors.BulkWriteError(self.result, )
+
+        defer.returnValue(self.result, )
+
+    def _add_error (self, index, operation, code, errmsg, ) :
+        self.result['writeErrors'].append({
+                'index': index,
+                'code': code,
+                'errmsg': errmsg,
+                'op': operation.statement(),
+            }, )
+
+    @defer.inlineCallbacks
+    def _send_command (self, kind, batch, ) :
+        _command = SON([(kind, self._collection._collection_name, ), ('ordered', self._ordered, ), ], )
+        _reply = yield self._proto.write_command(
+                str(self._collection._database, ), _command, IDENTIFIERS[kind],
+                [_encoded for _index, _operation, _encoded in batch], safe=self._safe, check=False, )
+        if not self._safe :
+            return
+
+        _n = _reply.get('n', 0, )
+        _upserted = _reply.get('upserted', (), )
+        if kind == 'insert' :
+            self.result['nInserted'] += _n
+        elif kind == 'update' :
+            self.result['nMatched'] += _n - len(_upserted, )
+            self.result['nUpserted'] += len(_upserted, )
+            if self.result['nModified'] is not None :
+                self.result['nModified'] += _reply.get('nModified', 0, )
+            for _document in _upserted :
+                self.result['upserted'].append(
+                        {'index': batch[_document['index']][0], '_id': _document['_id'], }, )
+        else :
+            self.result['nRemoved'] += _n
+
+        for _error in _reply.get('writeErrors', (), ) :
+            _index, _operation, _encoded = batch[_error['index']]
+            self._add_error(_index, _operation, _error.get('code', ), _error.get('errmsg', ), )
+
+        _error = _reply.get('writeConcernError', )
+        if _error :
+            self.result['writeConcernErrors'].append(_error, )
+
+    @defer.inlineCallbacks
+    def _send_legacy (self, kind, batch, ) :
+        if kind == 'insert' and not self._safe :
+            # nothing is acknowledged, so the batch is one message
+            _flags = 0 if self._ordered else INSERT_CONTINUE_ON_ERROR
+            self._proto.send_INSERT(Insert(flags=_flags, collection=str(self._collection, ),
+                                           documents=[_encoded for _index, _operation, _encoded in batch], ), )
+            return
+
+        _dl = list()
+        for _item in batch :
+            _index, _operation, _encoded = _item
+            if kind == 'insert' :
+                # one document a message, since a `getlasterror` reports
+                # neither which document of a message failed nor how many
+                # were inserted before it
+                self._proto.send_INSERT(Insert(collection=str(self._collection, ), documents=[_encoded, ], ), )
+            elif kind == 'update' :
+                _flags = (UPDATE_MULTI if _operation.multi else 0) | (UPDATE_UPSERT if _operation.upsert else 0)
+                self._proto.send_UPDATE(Update(flags=_flags, collection=str(self._collection, ),
+                                               selector=bson.BSON.encode(_operation.spec, ),
+                                               update=bson.BSON.encode(_operation.document, ), ), )
+            else :
+                _flags = DELETE_SINGLE_REMOVE if _operation.limit else 0
+                self._proto.send_DELETE(Delete(flags=_flags, collection=str(self._collection, ),
+                                               selector=bson.BSON.encode(_operation.spec, ), ), )
+
+            # every operation is acknowledged by its own `getlasterror`,
+            # pipelined right after it unless the operations are ordered
+            _d = self._getlasterror(kind, _item, )
+            if not self._ordered :
+                _dl.append(_d, )
+                continue
+
+            yield _d
+            if self.result['writeErrors'] :
+                return
+
+        yield gather(_dl, )
+
+    @defer.inlineCallbacks
+    def _getlasterror (self, kind, item, ) :
+        if not self._safe :
+            return
+
+        _index, _operation, _encoded = item
+        _document = yield self._proto.getlasterror(str(self._collection._database, ), check=False, )
+        if _document.get('wtimeout', ) :
+            self.result['writeConcernErrors'].append(
+                    {'code': _document.get('code', ), 'errmsg': _document.get('err', ), }, )
+        elif _document.get('err', ) is not None :
+            self._add_error(_index, _operation, _document.get('code', ), _document['err'], )
+            return
+
+        _n = _document.get('n', 0, )
+        if kind == 'insert' :
+            self.result['nInserted'] += 1
+        elif kind == 'update' :
+            # the legacy protocol does not report modified documents
+            self.result['nModified'] = None
+            if 'upserted' in _document :
+                self.result['nUpserted'] += 1
+                self.result['upserted'].append({'index': _index, '_id': _document['upserted'], }, )
+            elif _document.get('updatedExisting', ) :
+                self.result['nMatched'] += _n
+        else :
+            self.result['nRemoved'] += _n
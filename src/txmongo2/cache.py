@@ -0,0 +1,340 @@
+# coding: utf-8
+
+"""
+Client side cache of query results.
+
+A `QueryCache` is set as `query_cache` of a connection; `Collection.find`
+and `find_one` then keep the undecoded replies of the collections which
+have a TTL, set with `Collection.set_cache_ttl()`, `Database.set_cache_ttl()`
+or the `ttl` of the cache for every collection. The least recently used
+results are evicted once the cache is bigger than `max_bytes`. A write of
+this client through a collection drops the cached results of it.
+
+A `SingleFlight` set as `single_flight` of a connection shares one server
+request between identical queries in flight at the same time.
+
+A `MetadataCache` set as `metadata_cache` of a connection keeps the
+indexes made by `Collection.ensure_index`, and the results of
+`Collection.index_information`, `Collection.options` and
+`Database.collection_names`, for `ttl` seconds. Dropping or renaming a
+collection or an index through this client drops what it knows about it;
+changes made by other clients, and collections created by a write, are
+only seen once it expires.
+"""
+
+import copy
+from collections import OrderedDict
+
+import bson
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+
+class QueryCache (object, ) :
+    clock = reactor
+
+    def __init__ (self, max_bytes=64 * 1024 * 1024, ttl=None, ) :
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._ttls = dict()
+        self._entries = OrderedDict()
+        self._keys = dict()
+        self._generations = dict()
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__ (self, ) :
+        return len(self._entries, )
+
+    @property
+    def size (self, ) :
+        return self._size
+
+    def stats (self, ) :
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self, ),
+                'bytes': self._size,
+            }
+
+    def set_ttl (self, namespace, ttl, ) :
+        """
+        cache the results of `namespace`, a collection or a whole database,
+        for `ttl` seconds; `None` stops caching them.
+        """
+        if ttl is None :
+            self._ttls.pop(namespace, None, )
+        else :
+            self._ttls[namespace] = ttl
+
+    def get_ttl (self, namespace, ) :
+        if namespace in self._ttls :
+            return self._ttls[namespace]
+
+        return self._ttls.get(namespace.split('.', 1, )[0], self.ttl, )
+
+    @classmethod
+    def key (cls, namespace, spec, fields, skip, limit, ) :
+        return (
+                namespace,
+                bson.BSON.encode(spec, ),
+                bson.BSON.encode(fields, ) if fields is not None else None,
+                skip,
+                limit,
+            )
+
+    def generation (self, namespace, ) :
+        return self._generations.get(namespace, 0, )
+
+    def get (self, key, ) :
+        _entry = self._entries.pop(key, None, )
+        if _entry is None :
+            self.misses += 1
+            return None
+
+        _expires, _size, _batches = _entry
+        if _expires <= self.clock.seconds() :
+            self._remove(key, _entry, )
+            self.misses += 1
+            return None
+
+        # the most recently used are at the end
+        self._entries[key] = _entry
+        self.hits += 1
+        return _batches
+
+    def put (self, key, batches, generation, ) :
+        """
+        keep the `ReplyDocuments` of a result, unless the collection was
+        written to since `generation`.
+        """
+        _namespace = key[0]
+        _ttl = self.get_ttl(_namespace, )
+        if _ttl is None or generation != self.generation(_namespace, ) :
+            return
+
+        _size = sum([_batch.size for _batch in batches], )
+        if _size > self.max_bytes :
+            return
+
+        if key in self._entries :
+            self._remove(key, self._entries.pop(key, ), )
+
+        self._entries[key] = (self.clock.seconds() + _ttl, _size, batches, )
+        self._keys.setdefault(_namespace, set(), ).add(key, )
+        self._size += _size
+
+        while self._size > self.max_bytes :
+            _key, _entry = self._entries.popitem(last=False, )
+            self._remove(_key, _entry, )
+            self.evictions += 1
+
+    def _remove (self, key, entry, ) :
+        self._entries.pop(key, None, )
+        self._size -= entry[1]
+        _keys = self._keys.get(key[0], )
+        if _keys is not None :
+            _keys.discard(key, )
+            if not _keys :
+                del self._keys[key[0]]
+
+    def invalidate (self, namespace, ) :
+        """
+        drop the results of a collection after it was written to.
+        """
+        self._generations[namespace] = self.generation(namespace, ) + 1
+        for _key in self._keys.pop(namespace, set(), ) :
+            _entry = self._entries.pop(_key, None, )
+            if _entry is not None :
+                self._size -= _entry[1]
+                self.invalidations += 1
+
+    def clear (self, ) :
+        for _namespace in self._keys.keys() :
+            self.invalidate(_namespace, )
+
+
+class SingleFlight (object, ) :
+    """
+    Identical queries in flight share one request.
+
+    while a query is waiting for the server, the same query on the same
+    collection (with `Collection.set_single_flight()`, `Database.set_single_flight()`
+    or `enabled` for every collection) waits for its result instead of
+    being sent again; every caller then decodes its own copy of the
+    documents.
+    """
+
+    def __init__ (self, enabled=False, ) :
+        self.enabled = enabled
+
+        self._namespaces = dict()
+        self._inflight = dict()
+
+        self.requests = 0
+        self.coalesced = 0
+
+    def stats (self, ) :
+        return {
+                'requests': self.requests,
+                'coalesced': self.coalesced,
+                'inflight': len(self._inflight, ),
+            }
+
+    def set_enabled (self, namespace, enabled, ) :
+        """
+        enable or disable it for `namespace`, a collection or a whole
+        database; `None` falls back to the database or to `enabled`.
+        """
+        if enabled is None :
+            self._namespaces.pop(namespace, None, )
+        else :
+            self._namespaces[namespace] = enabled
+
+    def is_enabled (self, namespace, ) :
+        if namespace in self._namespaces :
+            return self._namespaces[namespace]
+
+        return self._namespaces.get(namespace.split('.', 1, )[0], self.enabled, )
+
+    def run (self, key, f, *a, **kw) :
+        """
+        call `f` unless a call with the same `key` is in flight; fires with
+        a copy of its list of results.
+        """
+        _waiters = self._inflight.get(key, )
+        if _waiters is not None :
+            self.coalesced += 1
+            _d = defer.Deferred()
+            _waiters.append(_d, )
+            return _d
+
+        self.requests += 1
+        _waiters = self._inflight[key] = list()
+
+        def _done (result, ) :
+            del self._inflight[key]
+            for _d in _waiters :
+                if isinstance(result, failure.Failure, ) :
+                    _d.errback(result, )
+                else :
+                    _d.callback(list(result, ), )
+
+            return result
+
+        return defer.maybeDeferred(f, *a, **kw).addBoth(_done, )
+
+
+class MetadataCache (object, ) :
+    clock = reactor
+
+    def __init__ (self, ttl=60, ) :
+        self.ttl = ttl
+
+        # (namespace, kind) -> (expires, value)
+        self._entries = dict()
+        self._generations = dict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__ (self, ) :
+        return len(self._entries, )
+
+    def stats (self, ) :
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self, ),
+            }
+
+    def generation (self, namespace, ) :
+        """
+        changes when `namespace`, or its database, is invalidated.
+        """
+        return (
+                self._generations.get(namespace, 0, ),
+                self._generations.get(namespace.split('.', 1, )[0], 0, ),
+            )
+
+    def _get (self, key, ) :
+        _entry = self._entries.get(key, )
+        if _entry is None :
+            return None
+
+        if _entry[0] <= self.clock.seconds() :
+            del self._entries[key]
+            return None
+
+        return _entry
+
+    def get (self, namespace, kind, ) :
+        """
+        a copy of the `kind` of metadata of `namespace`, or `None`.
+        """
+        _entry = self._get((namespace, kind, ), )
+        if _entry is None :
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return copy.deepcopy(_entry[1], )
+
+    def put (self, namespace, kind, value, generation, ) :
+        """
+        keep `value`, unless `namespace` was invalidated since `generation`.
+        """
+        if generation != self.generation(namespace, ) :
+            return
+
+        self._entries[(namespace, kind, )] = (self.clock.seconds() + self.ttl, copy.deepcopy(value, ), )
+
+    def is_ensured (self, namespace, name, ) :
+        return self._get((namespace, ('index', name, ), ), ) is not None
+
+    def ensured (self, namespace, name, ) :
+        self._entries[(namespace, ('index', name, ), )] = (self.clock.seconds() + self.ttl, True, )
+
+    def _drop (self, match, ) :
+        for _key in [_key for _key in self._entries if match(_key, )] :
+            del self._entries[_key]
+
+    def invalidate (self, namespace, ) :
+        """
+        forget a collection and the collection names of its database, or
+        everything about a database.
+        """
+        self._generations[namespace] = self._generations.get(namespace, 0, ) + 1
+
+        if '.' not in namespace :
+            _prefix = namespace + '.'
+            self._drop(lambda key : key[0] == namespace or key[0].startswith(_prefix, ), )
+            return
+
+        _database = namespace.split('.', 1, )[0]
+        self._generations[_database] = self._generations.get(_database, 0, ) + 1
+        self._drop(lambda key : key[0] == namespace or key == (_database, 'collection_names', ), )
+
+    def invalidate_indexes (self, namespace, name=None, ) :
+        """
+        forget the indexes of a collection, or only the one called `name`.
+        """
+        self._generations[namespace] = self._generations.get(namespace, 0, ) + 1
+        self._drop(
+                lambda key : key[0] == namespace and (
+                    key[1] == 'index_information'
+                    or (isinstance(key[1], tuple, ) and (name is None or key[1][1] == name))
+                ),
+            )
+
+    def clear (self, ) :
+        for _namespace in set([_key[0] for _key in self._entries], ) :
+            self.invalidate(_namespace, )
@@ -0,0 +1,167 @@
+# coding: utf-8
+
+"""
+Executors for encoding and decoding BSON.
+
+Documents are encoded and decoded by the executor set with
+`set_executor()`; `InlineExecutor`, the default, does it right away on the
+reactor thread. `ThreadExecutor` and `ProcessExecutor` split batches of at
+least `threshold` documents into chunks of `chunk_size` documents, which
+are encoded or decoded in a thread pool or in a `multiprocessing` pool, so
+the reactor keeps serving the other connections meanwhile. Every method
+returns a deferred.
+
+the C extension of `bson` does not release the GIL, so with threads a
+chunk still blocks the reactor while it is decoded, but only for the time
+of one chunk instead of the whole batch. Threads would only compete for
+the GIL, so `ThreadExecutor` runs one chunk at a time and the reactor
+gets the GIL back between chunks. A process pool does not block the
+reactor at all but pays for pickling the documents.
+"""
+
+from itertools import chain
+
+import bson
+from twisted.internet import defer, reactor, threads
+
+
+def encode (document, ) :
+    """
+    encode a document; an already encoded `bson.BSON` is returned as is.
+    """
+    if isinstance(document, bson.BSON, ) :
+        return document
+    return bson.BSON.encode(document, )
+
+
+def _encode_chunk (documents, ) :
+    return [encode(_document, ) for _document in documents]
+
+
+def _decode_chunk (data, as_class, ) :
+    return bson.decode_all(data, as_class, False, )
+
+
+def _concat (chunks, ) :
+    return list(chain(*chunks))
+
+
+def _first_error (failure, ) :
+    failure.trap(defer.FirstError, )
+    return failure.value.subFailure
+
+
+class InlineExecutor (object, ) :
+    """
+    encode and decode on the reactor thread.
+    """
+
+    def encode (self, documents, ) :
+        return defer.succeed(_encode_chunk(documents, ), )
+
+    def decode (self, documents, as_class=dict, ) :
+        """
+        decode the `ReplyDocuments` of a reply.
+        """
+        return defer.succeed(documents.decode_all(as_class=as_class, ), )
+
+
+class _ChunkedExecutor (InlineExecutor, ) :
+    threshold = 1000
+    chunk_size = 1000
+    # chunks run at the same time, `None` for no limit
+    concurrency = None
+
+    _semaphore = None
+
+    def _limit (self, f, *args) :
+        if self.concurrency is None :
+            return f(*args)
+
+        if self._semaphore is None :
+            self._semaphore = defer.DeferredSemaphore(self.concurrency, )
+        return self._semaphore.run(f, *args)
+
+    def _chunks (self, documents, ) :
+        return [documents[i:i + self.chunk_size] for i in xrange(0, len(documents, ), self.chunk_size, )]
+
+    def _gather (self, deferreds, ) :
+        _d = defer.gatherResults(deferreds, consumeErrors=True, )
+        return _d.addCallbacks(_concat, _first_error, )
+
+    def encode (self, documents, ) :
+        if len(documents, ) < self.threshold :
+            return InlineExecutor.encode(self, documents, )
+
+        return self._gather([self._limit(self._run, _encode_chunk, _chunk, ) for _chunk in self._chunks(documents, )], )
+
+    def decode (self, documents, as_class=dict, ) :
+        if len(documents, ) < self.threshold :
+            return InlineExecutor.decode(self, documents, as_class=as_class, )
+
+        return self._gather([self._limit(self._run_decode, _chunk, as_class, ) for _chunk in self._chunks(documents, )], )
+
+
+class ThreadExecutor (_ChunkedExecutor, ) :
+    """
+    encode and decode large batches in a thread pool, the one of the
+    reactor by default.
+    """
+    concurrency = 1
+
+    def __init__ (self, threadpool=None, threshold=None, chunk_size=None, ) :
+        self._threadpool = threadpool
+        if threshold is not None :
+            self.threshold = threshold
+        if chunk_size is not None :
+            self.chunk_size = chunk_size
+
+    def _run (self, f, *args) :
+        return threads.deferToThreadPool(reactor, self._threadpool or reactor.getThreadPool(), f, *args)
+
+    def _run_decode (self, documents, as_class, ) :
+        return self._run(documents.decode_all, as_class, )
+
+
+class ProcessExecutor (_ChunkedExecutor, ) :
+    """
+    encode and decode large batches in a `multiprocessing.Pool`, waited
+    for from the thread pool of the reactor. The documents and `as_class`
+    must be picklable.
+    """
+
+    def __init__ (self, pool=None, processes=None, threshold=None, chunk_size=None, ) :
+        if pool is None :
+            import multiprocessing
+            pool = multiprocessing.Pool(processes, )
+        self.pool = pool
+        if threshold is not None :
+            self.threshold = threshold
+        if chunk_size is not None :
+            self.chunk_size = chunk_size
+
+    def _run (self, f, *args) :
+        return threads.deferToThreadPool(reactor, reactor.getThreadPool(), self.pool.apply, f, args, )
+
+    def _run_decode (self, documents, as_class, ) :
+        return self._run(_decode_chunk, ''.join(documents, ), as_class, )
+
+    def close (self, ) :
+        self.pool.terminate()
+        self.pool.join()
+
+
+_executor = InlineExecutor()
+
+
+def get_executor () :
+    return _executor
+
+
+def set_executor (executor, ) :
+    """
+    set the executor used by every collection; `None` restores the inline
+    one.
+    """
+    global _executor
+    _executor = executor if executor is not None else InlineExecutor()
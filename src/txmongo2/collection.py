@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import bson
+import functools
 from bson import ObjectId
 from bson.code import Code
 from bson.son import SON
@@ -21,9 +22,27 @@ import types
 from pymongo import errors
 from . import filter as qf
 from .protocol import DELETE_SINGLE_REMOVE, UPDATE_UPSERT, \
-                             UPDATE_MULTI, Query, Getmore, Insert, \
-                             Update, Delete, QUERY_SLAVE_OK
+                             UPDATE_MULTI, Query, Insert, \
+                             Update, Delete, QUERY_SLAVE_OK, LazyDocuments, \
+                             INSERT_CONTINUE_ON_ERROR
 from twisted.internet import defer
+from .cursor import Cursor, CommandCursor, TailableCursor, n_to_return
+from . import bulk, codec, scan
+from .cache import QueryCache
+from .counter import Counter
+from .loader import Loader
+from .pagination import Paginator
+
+def _invalidates_cache(method):
+    """
+    drop the cached results of the collection once the write is done,
+    whether it succeeded or not.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return method(self, *args, **kwargs).addBoth(self._invalidate_cache)
+    return wrapper
+
 
 class Collection(object):
     def __init__(self, database, name):
@@ -91,12 +110,20 @@ class Collection(object):
                 return options
             return {}
 
+        cache = self._metadata_cache()
+        if cache is not None:
+            options = cache.get(str(self), 'options')
+            if options is not None:
+                return defer.succeed(options)
+            generation = cache.generation(str(self))
+
         d = self._database.system.namespaces.find_one({"name": str(self)})
         d.addCallback(wrapper)
+        if cache is not None:
+            d.addCallback(self._cache_metadata, 'options', generation)
         return d
 
-    @defer.inlineCallbacks
-    def find(self, spec=None, skip=0, limit=0, fields=None, filter=None, **kwargs):
+    def _query_spec(self, spec, skip, limit, fields, filter):
         if spec is None:
             spec = SON()
 
@@ -119,45 +146,209 @@ class Collection(object):
             if '$query' not in spec:
                 spec = {'$query': spec}
                 for k,v in filter.iteritems():
-                    spec['$' + k] = dict(v)
-
-        proto = yield self._database.connection.getprotocol(_type='read', )
-
-        flags = kwargs.get('flags', 0, )
-        if not proto.config or proto.config.get('stateStr') in ('SECONDARY', ) :
-            flags = flags | QUERY_SLAVE_OK
-
-        query = Query(flags=flags, collection=str(self),
-                      n_to_skip=skip, n_to_return=limit,
-                      query=spec, fields=fields)
-
-        reply = yield proto.send_QUERY(query)
-        documents = reply.documents
-        while reply.cursor_id:
-            to_fetch = 0 if limit <= 0 else limit - len(documents)
-            if to_fetch <= 0:
-                break
-                
-            getmore = Getmore(collection=str(self),
-                              n_to_return=to_fetch,
-                              cursor_id=reply.cursor_id)
-            reply = yield proto.send_GETMORE(getmore)
-            documents.extend(reply.documents)
-
-        if limit > 0:
-            documents = documents[:limit]
+                    spec['$' + k] = SON(v)
+
+        return spec, fields
+
+    def find_cursor(self, spec=None, skip=0, limit=0, fields=None, filter=None,
+                    batch_size=0, **kwargs):
+        """
+        returns a `Cursor` over the results, which fetches them batch by
+        batch instead of collecting every document like `find`. With
+        `prefetch=True` the next batch is read ahead while the current one
+        is consumed.
+        """
+        spec, fields = self._query_spec(spec, skip, limit, fields, filter)
+        return Cursor(self, spec, skip=skip, limit=limit, fields=fields,
+                      batch_size=batch_size, flags=kwargs.get('flags', 0),
+                      as_class=kwargs.get('as_class', dict),
+                      prefetch=kwargs.get('prefetch', False),
+                      raw=kwargs.get('raw', False))
+
+    def _query_cache(self):
+        """
+        the query cache of the connection, if it caches this collection.
+        """
+        cache = getattr(self._database.connection, 'query_cache', None)
+        if cache is not None and cache.get_ttl(str(self)) is not None:
+            return cache
+        return None
+
+    def _invalidate_cache(self, result=None, namespace=None):
+        cache = getattr(self._database.connection, 'query_cache', None)
+        if cache is not None:
+            cache.invalidate(namespace or str(self))
+        return result
+
+    def _single_flight(self):
+        flight = getattr(self._database.connection, 'single_flight', None)
+        if flight is not None and flight.is_enabled(str(self)):
+            return flight
+        return None
+
+    def set_single_flight(self, enabled=True):
+        """
+        share one request between identical `find`s of this collection in
+        flight at the same time, with the `single_flight` of the connection.
+        """
+        flight = getattr(self._database.connection, 'single_flight', None)
+        if flight is None:
+            raise errors.InvalidOperation("the connection has no single flight")
+        flight.set_enabled(str(self), enabled)
+
+    def _metadata_cache(self):
+        return getattr(self._database.connection, 'metadata_cache', None)
+
+    def _cache_metadata(self, value, kind, generation):
+        self._metadata_cache().put(str(self), kind, value, generation)
+        return value
+
+    def _invalidate_metadata(self, result=None, namespace=None):
+        cache = self._metadata_cache()
+        if cache is not None:
+            cache.invalidate(namespace or str(self))
+        return result
+
+    def _invalidate_indexes(self, result=None, name=None):
+        cache = self._metadata_cache()
+        if cache is not None:
+            cache.invalidate_indexes(str(self), name)
+        return result
+
+    def set_cache_ttl(self, ttl):
+        """
+        cache the results of `find` on this collection for `ttl` seconds in
+        the `query_cache` of the connection; `None` stops caching them.
+        """
+        cache = getattr(self._database.connection, 'query_cache', None)
+        if cache is None:
+            raise errors.InvalidOperation("the connection has no query cache")
+        cache.set_ttl(str(self), ttl)
+
+    @defer.inlineCallbacks
+    def find(self, spec=None, skip=0, limit=0, fields=None, filter=None, **kwargs):
+        spec, fields = self._query_spec(spec, skip, limit, fields, filter)
+
+        batches = None
+        cache = self._query_cache() if kwargs.get('cache', True) else None
+        if cache is not None:
+            key = cache.key(str(self), spec, fields, skip, limit)
+            generation = cache.generation(str(self))
+            batches = cache.get(key)
+
+        if batches is None:
+            flight = self._single_flight() if kwargs.get('single_flight', True) else None
+            if flight is not None:
+                # share the request of the same query in flight
+                flight_key = QueryCache.key(str(self), spec, fields, skip, limit) + \
+                        (kwargs.get('flags', 0), bool(kwargs.get('exhaust')))
+                batches = yield flight.run(flight_key, self._find_batches,
+                                           spec, skip, limit, fields, **kwargs)
+            else:
+                batches = yield self._find_batches(spec, skip, limit, fields, **kwargs)
+            if cache is not None:
+                cache.put(key, batches, generation)
 
         as_class = kwargs.get('as_class', dict)
 
-        defer.returnValue([d.decode(as_class=as_class) for d in documents])
+        if kwargs.get('lazy'):
+            documents = LazyDocuments(as_class=as_class, raw=kwargs.get('raw', False))
+            for batch in batches:
+                documents.extend(batch)
+            defer.returnValue(documents)
+
+        documents = list()
+        if kwargs.get('raw'):
+            # the undecoded `bson.BSON` of every document
+            for batch in batches:
+                documents.extend(batch)
+            defer.returnValue(documents)
+
+        for batch in batches:
+            decoded = yield codec.get_executor().decode(batch, as_class=as_class)
+            documents.extend(decoded)
+
+        defer.returnValue(documents)
+
+    @defer.inlineCallbacks
+    def _find_batches(self, spec, skip, limit, fields, **kwargs):
+        if kwargs.get('exhaust'):
+            if limit:
+                raise errors.InvalidOperation("exhaust can not be used with limit")
+
+            proto = yield self._database.connection.getprotocol(_type='read', )
+
+            flags = kwargs.get('flags', 0, )
+            if not proto.config or proto.config.get('stateStr') in ('SECONDARY', ) :
+                flags = flags | QUERY_SLAVE_OK
+
+            # the server streams every batch back for the single query
+            query = Query(flags=flags, collection=str(self),
+                          n_to_skip=skip, n_to_return=n_to_return(kwargs.get('batch_size', 0)),
+                          query=spec, fields=fields)
+            batches = list()
+            yield proto.send_QUERY_EXHAUST(query, lambda r: batches.append(r.documents))
+        else:
+            cursor = Cursor(self, spec, skip=skip, limit=limit, fields=fields,
+                            batch_size=kwargs.get('batch_size', 0),
+                            flags=kwargs.get('flags', 0),
+                            prefetch=kwargs.get('prefetch', False))
+            batches = list()
+            while cursor.alive:
+                batch = yield cursor.fetch()
+                batches.append(batch)
+
+        defer.returnValue(batches)
 
     def find_one(self, spec=None, fields=None, **kwargs):
         if isinstance(spec, ObjectId):
             spec = {'_id': spec}
         df = self.find(spec=spec, limit=1, fields=fields, **kwargs)
+        if kwargs.get('raw'):
+            df.addCallback(lambda r: r[0] if r else None)
+            return df
         df.addCallback(lambda r: r[0] if r else {})
         return df
 
+    def loader(self, key='_id', fields=None, max_batch_size=1000, **kwargs):
+        """
+        returns a `Loader` which looks up the documents by `key` in batches,
+        `loader.load(value)` fires with the document or `None`.
+        """
+        return Loader(self, key=key, fields=fields, max_batch_size=max_batch_size, **kwargs)
+
+    def paginator(self, sort, page_size=100, spec=None, fields=None, **kwargs):
+        """
+        a `Paginator` reading the documents matching `spec` in the order of
+        `sort`, `page_size` at a time, with continuation tokens instead of
+        skip.
+        """
+        return Paginator(self, sort, page_size=page_size, spec=spec, fields=fields, **kwargs)
+
+    def parallel_scan(self, n_segments, spec=None, fields=None, batch_size=0, **kwargs):
+        """
+        fires with a `scan.ParallelScan` reading the documents matching
+        `spec` in up to `n_segments` ranges of `_id` at the same time, over
+        the protocols of the connection. The keyword arguments of
+        `find_cursor` (as_class, prefetch, raw) apply to every segment.
+        """
+        return scan.parallel_scan(self, n_segments, spec, fields, batch_size, **kwargs)
+
+    def tail(self, callback, spec=None, fields=None, **kwargs):
+        """
+        follow a capped collection, or the oplog with `oplog_replay=True`;
+        `callback` is called with every new document. Returns the started
+        `TailableCursor`, call its `stop()` to stop tailing.
+        """
+        if spec is not None and not isinstance(spec, types.DictType):
+            raise TypeError("spec must be an instance of dict")
+        if fields is not None and not isinstance(fields, types.DictType):
+            fields = self._fields_list_to_dict(fields)
+
+        cursor = TailableCursor(self, callback, spec=spec, fields=fields, **kwargs)
+        cursor.start()
+        return cursor
+
     def count(self, spec=None, fields=None):
         def wrapper(result):
             return result["n"]
@@ -208,16 +399,29 @@ class Collection(object):
         d.addCallback(wrapper)
         return d
 
+    @_invalidates_cache
     @defer.inlineCallbacks
     def insert(self, docs, safe=True, **kwargs):
-        if isinstance(docs, types.DictType):
+        """
+        with `group_commit=True` the documents are merged with the ones
+        inserted concurrently into the same collection, see `GroupCommit`.
+
+        an already encoded `bson.BSON` is sent as is; its id is returned as
+        `None`, since it is not decoded.
+        """
+        if isinstance(docs, bson.BSON):
+            ids = None
+            docs = [docs]
+        elif isinstance(docs, types.DictType):
             ids = docs.get('_id', ObjectId())
             docs["_id"] = ids
             docs = [docs]
         elif isinstance(docs, types.ListType):
             ids = []
             for doc in docs:
-                if isinstance(doc, types.DictType):
+                if isinstance(doc, bson.BSON):
+                    ids.append(None)
+                elif isinstance(doc, types.DictType):
                     id = doc.get('_id', ObjectId())
                     ids.append(id)
                     doc["_id"] = id
@@ -226,17 +430,76 @@ class Collection(object):
         else:
             raise TypeError("insert takes a document or a list of documents")
 
-        docs = [bson.BSON.encode(d) for d in docs]
         flags = kwargs.get('flags', 0)
-        insert = Insert(flags=flags, collection=str(self), documents=docs)
+        encoded = yield codec.get_executor().encode(docs)
         proto = yield self._database.connection.getprotocol(_type='insert', )
-        proto.send_INSERT(insert)
 
-        if safe:
-            yield proto.getlasterror(str(self._database))
+        if kwargs.get('group_commit'):
+            # merged with the inserts of other callers into one message
+            yield proto.group_commit.insert(str(self._database), self._collection_name,
+                                            encoded, safe=safe)
+            defer.returnValue(ids)
+
+        # a message can not exceed the limits of the server
+        batches = bulk.split([bulk.InsertOne(d) for d in docs], True,
+                             proto.max_write_batch_size, proto.max_message_size,
+                             proto.max_bson_size, encoded=encoded)
+        for kind, batch in batches:
+            documents = [document for index, operation, document in batch]
+            if proto.op_msg_enabled():
+                command = SON([("insert", self._collection_name),
+                               ("ordered", not flags & INSERT_CONTINUE_ON_ERROR)])
+                yield proto.write_command(str(self._database), command,
+                                          "documents", documents, safe=safe)
+                continue
+
+            insert = Insert(flags=flags, collection=str(self), documents=documents)
+            proto.send_INSERT(insert)
+
+            if safe:
+                yield proto.getlasterror(str(self._database))
+
+        defer.returnValue(ids)
 
+    @defer.inlineCallbacks
+    def insert_many(self, docs, ordered=True, safe=True):
+        """
+        insert the documents with `bulk_write`; returns their ids.
+        """
+        operations = [bulk.InsertOne(doc) for doc in docs]
+        ids = [operation.statement().get("_id") if isinstance(doc, dict) else None
+               for doc, operation in zip(docs, operations)]
+        yield self.bulk_write(operations, ordered=ordered, safe=safe)
         defer.returnValue(ids)
 
+    @_invalidates_cache
+    @defer.inlineCallbacks
+    def bulk_write(self, operations, ordered=True, safe=True):
+        """
+        run a list of `InsertOne`, `UpdateOne`, `UpdateMany`, `ReplaceOne`,
+        `DeleteOne` and `DeleteMany` operations in as few messages as the
+        limits of the server allow. Ordered operations stop at the first
+        error, unordered ones are all sent at once.
+
+        returns the counts of the operations (`nInserted`, `nMatched`,
+        `nModified`, `nUpserted`, `nRemoved` and `upserted`), or raises
+        `BulkWriteError` with them and the `writeErrors` by operation index.
+        """
+        proto = yield self._database.connection.getprotocol(_type='write', )
+        result = yield bulk.BulkWrite(self, proto, ordered=ordered, safe=safe).execute(operations)
+        defer.returnValue(result)
+
+    def counter(self, interval=1, max_keys=1000, upsert=True):
+        """
+        a started `Counter` merging `$inc` updates of this collection in
+        memory and writing them every `interval` seconds, or once
+        `max_keys` documents have pending increments.
+        """
+        counter = Counter(self, interval=interval, max_keys=max_keys, upsert=upsert)
+        counter.start()
+        return counter
+
+    @_invalidates_cache
     @defer.inlineCallbacks
     def update(self, spec, document, upsert=False, multi=False, safe=True, **kwargs):
         if not isinstance(spec, types.DictType):
@@ -253,11 +516,27 @@ class Collection(object):
         if upsert:
             flags |= UPDATE_UPSERT
 
+        proto = yield self._database.connection.getprotocol(_type='update', )
+        if proto.op_msg_enabled():
+            statement = SON([("q", spec), ("u", document),
+                             ("upsert", upsert), ("multi", bool(multi))])
+            ret = yield proto.write_command(
+                    str(self._database), SON([("update", self._collection_name)]),
+                    "updates", [bson.BSON.encode(statement)], safe=safe)
+            if safe:
+                # shape the result like the one of getlasterror
+                upserted = ret.pop("upserted", None)
+                if upserted:
+                    ret["upserted"] = upserted[0]["_id"]
+                ret["updatedExisting"] = bool(ret.get("n")) and not upserted
+                ret.setdefault("err", None)
+                defer.returnValue(ret)
+            return
+
         spec = bson.BSON.encode(spec)
         document = bson.BSON.encode(document)
         update = Update(flags=flags, collection=str(self),
                         selector=spec, update=document)
-        proto = yield self._database.connection.getprotocol(_type='update', )
         proto.send_UPDATE(update)
 
         if safe:
@@ -274,6 +553,7 @@ class Collection(object):
         else:
             return self.insert(doc, safe=safe, **kwargs)
 
+    @_invalidates_cache
     @defer.inlineCallbacks
     def remove(self, spec, safe=True, single=False, **kwargs):
         if isinstance(spec, ObjectId):
@@ -285,9 +565,19 @@ class Collection(object):
         if single:
             flags |= DELETE_SINGLE_REMOVE
 
+        proto = yield self._database.connection.getprotocol(_type='remove', )
+        if proto.op_msg_enabled():
+            statement = SON([("q", spec), ("limit", 1 if single else 0)])
+            ret = yield proto.write_command(
+                    str(self._database), SON([("delete", self._collection_name)]),
+                    "deletes", [bson.BSON.encode(statement)], safe=safe)
+            if safe:
+                ret.setdefault("err", None)
+                defer.returnValue(ret)
+            return
+
         spec = bson.BSON.encode(spec)
         delete = Delete(flags=flags, collection=str(self), selector=spec)
-        proto = yield self._database.connection.getprotocol(_type='remove', )
         proto.send_DELETE(delete)
 
         if safe:
@@ -299,6 +589,10 @@ class Collection(object):
 
     def create_index(self, sort_fields, **kwargs):
         def wrapper(result, name):
+            cache = self._metadata_cache()
+            if cache is not None:
+                cache.invalidate_indexes(str(self), name)
+                cache.ensured(str(self), name)
             return name
 
         if not isinstance(sort_fields, qf.sort):
@@ -331,8 +625,18 @@ class Collection(object):
         return d
 
     def ensure_index(self, sort_fields, **kwargs):
-        # ensure_index is an alias of create_index since we are not 
-        # keep an index cache same way pymongo does
+        """
+        create_index, unless the index was created or ensured by this
+        client within the TTL of the `metadata_cache` of the connection.
+        """
+        cache = self._metadata_cache()
+        if cache is not None:
+            if not isinstance(sort_fields, qf.sort):
+                raise TypeError("sort_fields must be an instance of filter.sort")
+            name = kwargs.get("name") or self._gen_index_name(sort_fields["orderby"])
+            if cache.is_ensured(str(self), name):
+                return defer.succeed(name)
+
         return self.create_index(sort_fields, **kwargs)
 
     def drop_index(self, index_identifier):
@@ -344,7 +648,9 @@ class Collection(object):
             raise TypeError("index_identifier must be a name or instance of filter.sort")
 
         cmd = SON([("deleteIndexes", self._collection_name), ("index", name)])
-        return self._database["$cmd"].find_one(cmd)
+        d = self._database["$cmd"].find_one(cmd)
+        d.addBoth(self._invalidate_indexes, None if name == "*" else name)
+        return d
 
     def drop_indexes(self):
         return self.drop_index("*")
@@ -356,14 +662,28 @@ class Collection(object):
                 info[idx["name"]] = idx["key"].items()
             return info
 
+        cache = self._metadata_cache()
+        if cache is not None:
+            info = cache.get(str(self), 'index_information')
+            if info is not None:
+                return defer.succeed(info)
+            generation = cache.generation(str(self))
+
         d = self._database.system.indexes.find({"ns": str(self)})
         d.addCallback(wrapper)
+        if cache is not None:
+            d.addCallback(self._cache_metadata, 'index_information', generation)
         return d
 
     def rename(self, new_name):
-        cmd = SON([("renameCollection", str(self)), ("to", "%s.%s" % \
-            (str(self._database), new_name))])
-        return self._database("admin")["$cmd"].find_one(cmd)
+        new_namespace = "%s.%s" % (str(self._database), new_name)
+        cmd = SON([("renameCollection", str(self)), ("to", new_namespace)])
+        d = self._database("admin")["$cmd"].find_one(cmd)
+        d.addBoth(self._invalidate_metadata)
+        d.addBoth(self._invalidate_metadata, new_namespace)
+        d.addBoth(self._invalidate_cache)
+        d.addBoth(self._invalidate_cache, new_namespace)
+        return d
 
     def distinct(self, key, spec=None):
         def wrapper(result):
@@ -379,6 +699,28 @@ class Collection(object):
         d.addCallback(wrapper)
         return d
 
+    def aggregate(self, pipeline, batch_size=0, allowDiskUse=False, **kwargs):
+        """
+        run an aggregation pipeline; returns a `CommandCursor` over its
+        results, fetched `batch_size` documents at a time. The keyword
+        arguments of `find_cursor` (as_class, prefetch, raw) apply to it.
+        """
+        if not isinstance(pipeline, (list, tuple)):
+            raise TypeError("pipeline must be a list")
+
+        cmd = SON([("aggregate", self._collection_name),
+                   ("pipeline", list(pipeline)),
+                   ("cursor", {"batchSize": batch_size} if batch_size else {})])
+        if allowDiskUse:
+            cmd["allowDiskUse"] = True
+
+        # a pipeline writing its result with $out runs on the primary
+        _type = "write" if any("$out" in stage for stage in pipeline) else "read"
+        return CommandCursor(self, cmd, batch_size=batch_size,
+                             as_class=kwargs.get('as_class', dict),
+                             prefetch=kwargs.get('prefetch', False),
+                             raw=kwargs.get('raw', False), _type=_type)
+
     def map_reduce(self, map, reduce, full_response=False, **kwargs):
         def wrapper(result, full_response):
             if full_response:
@@ -392,6 +734,7 @@ class Collection(object):
         d.addCallback(wrapper, full_response)
         return d
 
+    @_invalidates_cache
     def find_and_modify(self, query={}, update=None, upsert=False, **kwargs):
         def wrapper(result):
             no_obj_error = "No matching object found"
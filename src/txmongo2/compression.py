@@ -0,0 +1,51 @@
+# coding: utf-8
+
+"""
+Compressors for OP_COMPRESSED.
+
+A compressor is registered under the name used in the `compression` field
+of `ismaster` and the id used in the OP_COMPRESSED header. `zlib` is
+available by default, other codecs can be added with
+`register_compressor()`.
+"""
+
+import zlib
+from collections import namedtuple
+
+
+Compressor = namedtuple('Compressor', ['name', 'compressor_id', 'compress', 'decompress'])
+
+_compressors = dict()
+_compressors_by_id = dict()
+
+
+def register_compressor (name, compressor_id, compress, decompress, ) :
+    _compressor = Compressor(name, compressor_id, compress, decompress, )
+    _compressors[name] = _compressor
+    _compressors_by_id[compressor_id] = _compressor
+
+    return _compressor
+
+
+def get_compressor (name, ) :
+    return _compressors.get(name, )
+
+
+def get_compressor_by_id (compressor_id, ) :
+    return _compressors_by_id.get(compressor_id, )
+
+
+def negotiate (requested, supported, ) :
+    """
+    choose the first of the `requested` compressors which is supported by
+    the server and registered here.
+    """
+    for name in requested :
+        if name in supported and name in _compressors :
+            return _compressors[name]
+
+    return None
+
+
+register_compressor('noop', 0, str, str, )
+register_compressor('zlib', 2, zlib.compress, zlib.decompress, )
@@ -30,8 +30,8 @@ senario
 
 import logging
 import copy
-import random
 
+from bson.son import SON
 from pymongo.uri_parser import parse_uri
 from pymongo import errors
 from pymongo.read_preferences import ReadPreference
@@ -44,28 +44,59 @@ from .factory import (
         AutoDetectConnectionFactory,
         SingleConnectionFactory,
         ReplicaSetConnectionFactory,
+        MonitorConnectionFactory,
     )
 from .protocol import Query
+from . import selection
 from .database import Database
 
 STATE_PRIMARY = 1
 STATE_SECONDARY = 2
 
 
+def _idle (protocols, ) :
+    """
+    the protocols not streaming an exhaust query; all of them when every
+    one is, so the request waits for the end of the stream.
+    """
+    _r = filter(lambda proto : not proto.exhausting(), protocols, )
+    return _r if _r else protocols
+
+
 class BaseConnection (object, ) :
     factory = None
     uri = None
     uri_nodelist = None
 
+    # `cache.QueryCache` of the results of `find`
+    query_cache = None
+    # `cache.SingleFlight` of the queries in flight
+    single_flight = None
+    # `cache.MetadataCache` of the indexes and collections
+    metadata_cache = None
+
     class NoMoreNodeToConnect (Exception, ) : pass
 
     @classmethod
     def send_is_master (cls, proto, ) :
-        _query = Query(collection='admin.$cmd', query={'ismaster': 1, }, )
+        _command = SON([('ismaster', 1, ), ], )
+        _compressors = proto.requested_compressors()
+        if _compressors :
+            _command['compression'] = _compressors
+
+        _query = Query(collection='admin.$cmd', query=_command, )
         _d = proto.send_QUERY(_query, )
+        _d.addCallback(cls._cb_is_master, proto, )
 
         return _d
 
+    @classmethod
+    def _cb_is_master (cls, r, proto, ) :
+        if len(r.documents) == 1 :
+            proto.set_server_info(r.documents[0].decode(), )
+
+        return r
+
     @classmethod
     def send_replset_get_status (cls, proto, ) :
         _query = Query(collection='admin.$cmd', query={'replSetGetStatus': 1, }, )
@@ -144,9 +175,10 @@ class AutoDetectConnection (BaseConnection, ) :
         if 'hosts' in _config and 'setName' in _config : # replicaset
             log.msg('[debug,%s] found replicaset for `%s`' % (
                     proto.addr, _config.get('setName'), ), )
-            _connection = ReplicaSetConnection(
-                    parse_uri('mongodb://%s' % _config.get('me'), ),
-                )
+            _uri = parse_uri('mongodb://%s' % _config.get('me'), )
+            # keep the options given to the pool
+            _uri['options'] = dict(self.uri.get('options', dict(), ), )
+            _connection = ReplicaSetConnection(_uri, )
         else :
             log.msg('[debug,%s] found Single mode.' % (proto.addr, ), )
             _connection = SingleConnection(self.uri.copy(), )
@@ -180,6 +212,12 @@ class RealConnection (BaseConnection, ) :
     def getprotocol (self, _type='read', ) :
         raise NotImplemented
 
+    def getprotocols (self, _type='read', ) :
+        """
+        every protocol which can serve `_type` at the same time.
+        """
+        return [self.getprotocol(_type, ), ]
+
     def add_connection (self, proto, config=None, ) :
         if config is not None :
             proto.config = config
@@ -193,6 +231,7 @@ class RealConnection (BaseConnection, ) :
 
         _proto = self.connections.get(name, )
         if _proto.transport :
+            _proto.flush()
             _proto.transport.loseConnection()
 
         del self.connections[name]
@@ -203,8 +242,12 @@ class SingleConnection (RealConnection, ) :
     factory = SingleConnectionFactory
 
     def _cb_connected (self, proto, ) :
-        self.add_connection(proto, config=dict(), )
-        return RealConnection._cb_connected(self, proto, )
+        _d = BaseConnection.send_is_master(proto, )
+        _d.addCallback(lambda r : self.add_connection(proto, config=dict(), ), )
+        _d.addCallback(lambda r : RealConnection._cb_connected(self, proto, ), )
+        _d.addErrback(self._eb, proto, )
+
+        return _d
 
     def getprotocol (self, _type='read', ) :
         if not self.connections:
@@ -223,6 +266,15 @@ class ReplicaSetConnection (RealConnection, ) :
     factory = ReplicaSetConnectionFactory
     hosts = list()
 
+    # `selection` strategy choosing among the secondaries, or among the
+    # nearest members
+    selector = selection.Random()
+
+    # reads with `ReadPreference.NEAREST` go to the members whose `rtt` is
+    # within this many milliseconds of the fastest one; the
+    # `localThresholdMS` option of the uri takes precedence
+    local_threshold_ms = 15
+
     connections = dict()
 
     def connect (self, ) :
@@ -232,9 +284,14 @@ class ReplicaSetConnection (RealConnection, ) :
         return self.factory(self, uri, )
 
     def connect_new (self, config, ) :
+        def _cb_connected (proto, ) :
+            return BaseConnection.send_is_master(proto, ).addCallback(
+                    lambda r : self.add_connection(proto, config=config, ),
+                )
+
         _uri = parse_uri('mongodb://%s' % config.get('name'), )
         return self.do_connect([_uri.get('nodelist')[0], ], ).addCallback(
-                lambda proto : self.add_connection(proto, config=config, ),
+                _cb_connected,
             )
 
     def _cb_connected (self, proto, ) :
@@ -306,7 +363,7 @@ class ReplicaSetConnection (RealConnection, ) :
         if len(_r) < 1 :
             raise errors.OperationFailure('connections not found for %s' % state, )
 
-        return _r
+        return _idle(_r, )
 
     def _get_protocol (self, state=None, ) :
         if state is None :
@@ -319,7 +376,25 @@ class ReplicaSetConnection (RealConnection, ) :
         if len(_r) < 2 :
             return _r[0]
 
-        return _r[random.choice(range(len(_r)))]
+        return self.selector.select(_r, )
+
+    def _get_nearest_protocols (self, ) :
+        _r = filter(
+                lambda proto : proto.config.get('state') in (STATE_PRIMARY, STATE_SECONDARY, ),
+                self.connections.values(),
+            )
+        if len(_r) < 1 :
+            raise errors.OperationFailure('connections not found for nearest.', )
+
+        _r = _idle(_r, )
+        _rtts = [proto.rtt for proto in _r if proto.rtt is not None]
+        if not _rtts :
+            # not probed by the monitor yet
+            return _r
+
+        _threshold = self.uri.get('options', dict(), ).get('localthresholdms', self.local_threshold_ms, )
+        _limit = min(_rtts) + _threshold / 1000.0
+        return filter(lambda proto : proto.rtt is not None and proto.rtt <= _limit, _r, )
 
     def getprotocol (self, _type='read', ) :
         if not self.connections :
@@ -331,6 +406,11 @@ class ReplicaSetConnection (RealConnection, ) :
             return _proto
 
         _rf = self.uri.get('options', dict(), ).get('read_preferences', ReadPreference.SECONDARY_PREFERRED, )
+        if _rf == ReadPreference.NEAREST :
+            _proto = self.selector.select(self._get_nearest_protocols(), )
+            log.msg('[debug] get nearest, %s (%s).' % (_proto, _rf, ), )
+            return _proto
+
         if _rf not in self.READ_PREFERENCES_FOR_READ :
             _proto = self._get_protocol(STATE_PRIMARY, )
             log.msg('[debug] get primary, %s (%s).' % (_proto, _rf, ), )
@@ -341,7 +421,7 @@ class ReplicaSetConnection (RealConnection, ) :
             log.msg('[debug] get secondary, %s (%s).' % (_proto, _rf, ), )
             return _proto
 
-        if _rf in (ReadPreference.SECONDARY_PREFERRED, ReadPreference.NEAREST, ) :
+        if _rf in (ReadPreference.SECONDARY_PREFERRED, ) :
             try :
                 _proto = self._get_protocol(STATE_SECONDARY, )
                 log.msg('[debug] get secondary, %s (%s).' % (_proto, _rf, ), )
@@ -357,29 +437,162 @@ class ReplicaSetConnection (RealConnection, ) :
         return _proto
 
 
+    def getprotocols (self, _type='read', ) :
+        """
+        every secondary for reads where `getprotocol` would choose one,
+        otherwise the primary.
+        """
+        if not self.connections :
+            raise errors.OperationFailure('connections not found.', )
+
+        _rf = self.uri.get('options', dict(), ).get('read_preferences', ReadPreference.SECONDARY_PREFERRED, )
+        if _type == 'read' and _rf == ReadPreference.NEAREST :
+            return self._get_nearest_protocols()
+
+        if _type == 'read' and _rf in self.READ_PREFERENCES_FOR_READ :
+            try :
+                return self._filter_protocol(STATE_SECONDARY, )
+            except errors.OperationFailure :
+                if _rf in (ReadPreference.SECONDARY, ReadPreference.SECONDARY_ONLY, ) :
+                    raise
+
+        return [self._get_protocol(STATE_PRIMARY, ), ]
+
+
 class ReplicaSetConnectionMonitor (object, ) :
+    clock = reactor
+
     interval = 1
     #interval = 5
 
+    # seconds the configuration or a probe of a member may take before it
+    # is cancelled
+    timeout = 5
+
     hosts = list()
 
     def __init__ (self, connection, ) :
         self._connection = connection
 
+        # member name -> the monitoring connection its probes are sent on
+        self._probes = dict()
+        # names of the members with a probe in flight
+        self._probing = set()
+
     def start (self, ) :
         log.msg('[debug] start monitor.',)
         return self._monitor()
 
     def _monitor (self, ) :
-        return defer.maybeDeferred(self._select_connection, ).addBoth(self._cb_start, )
+        _d = self._with_timeout(defer.maybeDeferred(self._select_connection, ), )
+        _d.addBoth(self._cb_start, )
+
+        return _d
 
     def _cb_start (self, r, ) :
         if isinstance(r, failure.Failure, ) :
             log.msg(r.printDetailedTraceback(), logLevel=logging.ERROR, )
 
-        reactor.callLater(self.interval, self._monitor, )
+        # the next round does not wait for the probes
+        self._probe_members()
+        self.clock.callLater(self.interval, self._monitor, )
         return
 
+    def _with_timeout (self, d, ) :
+        _call = self.clock.callLater(self.timeout, d.cancel, )
+
+        def _done (r, ) :
+            if _call.active() :
+                _call.cancel()
+            return r
+
+        return d.addBoth(_done, )
+
+    def connect_probe (self, name, ) :
+        """
+        connect the monitoring connection of the member `name`.
+        """
+        _host, _port = parse_uri('mongodb://%s' % name, ).get('nodelist')[0]
+        _uri = copy.copy(self._connection.uri, )
+        _uri['nodelist'] = [(_host, _port, ), ]
+
+        return TCP4ClientEndpoint(reactor, _host, int(_port), ).connect(
+                MonitorConnectionFactory(self, _uri, ),
+            ).addCallback(lambda proto : proto.connectionReady(), )
+
+    def remove_probe (self, proto, ) :
+        for _name, _proto in self._probes.items() :
+            if _proto is proto :
+                del self._probes[_name]
+
+    def _get_probe (self, name, ) :
+        _proto = self._probes.get(name, )
+        if _proto is not None :
+            return defer.succeed(_proto, )
+
+        def _cb_connected (proto, ) :
+            self._probes[name] = proto
+            return proto
+
+        return self.connect_probe(name, ).addCallback(_cb_connected, )
+
+    def probe (self, proto, ) :
+        """
+        send `ismaster` to a member and record its round trip time.
+
+        the probes go on a connection of their own, so the time is not
+        spent waiting behind the requests in flight on `proto`, like the
+        GETMOREs of tailable cursors or an exhaust query.
+        """
+        def _cb_probe (probe, ) :
+            _start = self.clock.seconds()
+            _d = BaseConnection.send_is_master(probe, )
+            _d.addCallback(lambda r : proto.record_rtt(self.clock.seconds() - _start, ), )
+            return _d
+
+        _d = self._get_probe(proto.addr, ).addCallback(_cb_probe, )
+        return self._with_timeout(_d, ).addErrback(self._eb_probe, proto, )
+
+    def _eb_probe (self, f, proto, ) :
+        # a member which does not answer is left out of the nearest ones
+        # until it does again
+        proto.rtt = None
+
+        _probe = self._probes.pop(proto.addr, None, )
+        if _probe is not None and _probe.transport :
+            _probe.transport.loseConnection()
+
+        return f
+
+    def _close_probes (self, ) :
+        for _name in self._probes.keys() :
+            if _name in self._connection.connections :
+                continue
+
+            _proto = self._probes.pop(_name, )
+            if _proto.transport :
+                _proto.transport.loseConnection()
+
+    def _probe_members (self, ) :
+        def _done (r, name, ) :
+            self._probing.discard(name, )
+            if isinstance(r, failure.Failure, ) :
+                log.msg('[debug] failed to probe `%s`, %s.' % (name, r.getErrorMessage(), ), )
+
+            return
+
+        self._close_probes()
+
+        _dl = list()
+        for _proto in self._connection.connections.values() :
+            if _proto.addr in self._probing :
+                continue
+
+            self._probing.add(_proto.addr, )
+            _dl.append(self.probe(_proto, ).addBoth(_done, _proto.addr, ), )
+
+        return defer.DeferredList(_dl, )
+
     def _select_connection (self, ) :
         if not self._connection.connections :
             raise errors.OperationFailure('no connection found.', )
@@ -389,10 +602,10 @@ class ReplicaSetConnectionMonitor (object, ) :
         except errors.OperationFailure :
             _primary = None
 
-        if _primary :
+        if _primary and not _primary.exhausting() :
             return self.configure(_primary, )
 
-        for i in self._connection.connections.values() :
+        for i in _idle(self._connection.connections.values(), ) :
             return self.configure(i, )
 
     def configure (self, proto, ) :
@@ -471,13 +684,22 @@ class ReplicaSetConnectionMonitor (object, ) :
 
 
 class _ConnectionPool (object, ) :
-    _index = 0
     _pool = None
     _pool_size = None
     _cls = AutoDetectConnection
     uri = None
 
-    def __init__ (self, uri=None, pool_size=1, cls=None, ) :
+    # `cache.QueryCache` of the results of `find`
+    query_cache = None
+    # `cache.SingleFlight` of the queries in flight
+    single_flight = None
+    # `cache.MetadataCache` of the indexes and collections
+    metadata_cache = None
+
+    # `selection` strategy choosing among the protocols of the pool
+    selector = None
+
+    def __init__ (self, uri=None, pool_size=1, cls=None, selector=None, compressors=None, ) :
         assert isinstance(pool_size, int)
         assert pool_size >= 1
 
@@ -488,10 +710,16 @@ class _ConnectionPool (object, ) :
 
             uri = parse_uri(uri, )
 
+        if compressors is not None :
+            # the uri parser of pymongo does not know the `compressors`
+            # option, so it is set here for the protocols to request
+            uri['options']['compressors'] = list(compressors, )
+
         self.uri = uri
         self._cls = cls if cls else AutoDetectConnection
         self._pool_size = pool_size
         self._pool = list()
+        self.selector = selector if selector is not None else selection.RoundRobin()
 
     def connect (self, ) :
         def _cb_connection_done (connection, ) :
@@ -524,42 +752,49 @@ class _ConnectionPool (object, ) :
         return
 
     def getprotocol (self, _type='read', ) :
-        _retry = 0
-        _c = self._get_connection()
-        while not _c.connections :
-            if _retry > self._pool_size :
-                break
-
-            _c = self._get_connection()
-            _retry += 1
-
-        _p = _c.getprotocol(_type)
+        _p = self.selector.select(self.getprotocols(_type, ), )
+        log.msg('[debug] choose the protocol from pool, `%s`.' % _p, )
 
         return _p
 
-    def _get_connection (self, ) :
-        if self._index > self._pool_size :
-            self._index = 0
+    def getprotocols (self, _type='read', ) :
+        """
+        the protocols of every connection of the pool which can serve
+        `_type` at the same time.
+        """
+        _protocols = list()
+        for _c in self._pool :
+            if not _c.connections :
+                continue
 
-        _r = self._pool
-        _c = _r[self._index % len(_r)]
-        log.msg('choose the connection from pool, `%s`.' % _c, )
+            try :
+                _candidates = _c.getprotocols(_type, )
+            except errors.OperationFailure :
+                # no primary or no secondary on this one at the moment
+                continue
 
-        self._index += 1
+            for _p in _candidates :
+                if _p not in _protocols :
+                    _protocols.append(_p, )
 
-        return _c
+        if not _protocols :
+            raise errors.OperationFailure('connections not found.', )
 
+        return _idle(_protocols, )
 
-def MongoConnection (host, port, pool_size=1, cls=None, ) :
+def MongoConnection (host, port, pool_size=1, cls=None, selector=None, compressors=None, ) :
     return _ConnectionPool(
             'mongodb://%s:%d' % (host, port, ),
             pool_size=pool_size,
             cls=cls,
+            selector=selector,
+            compressors=compressors,
         ).connect()
 
 
-def MongoConnectionPool (host, port, pool_size=5, cls=None, ) :
-    return MongoConnection(host, port, pool_size=pool_size, cls=cls, )
+def MongoConnectionPool (host, port, pool_size=5, cls=None, selector=None, compressors=None, ) :
+    return MongoConnection(host, port, pool_size=pool_size, cls=cls, selector=selector,
+                           compressors=compressors, )
 
 
 Connection = MongoConnection
@@ -0,0 +1,128 @@
+# coding: utf-8
+
+"""
+Write-behind counters.
+
+`Collection.counter()` returns a started `Counter`; `Counter.inc()` adds
+to a field of the document matching a spec in memory only, and every
+`interval` seconds, or as soon as `max_keys` documents have pending
+increments, the increments are merged into one `$inc` update per document
+and sent together as one unordered `Collection.bulk_write`.
+
+the increments not flushed yet are lost when the process dies, at most
+`interval` seconds or `max_keys` documents of them; `stop()`, also called
+before the reactor shuts down, flushes what is left. A failed flush is
+logged and not retried, so an increment is never applied twice.
+"""
+
+import logging
+
+import bson
+from pymongo import errors
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+
+from .bulk import UpdateOne
+
+
+class Counter (object, ) :
+    clock = reactor
+
+    def __init__ (self, collection, interval=1, max_keys=1000, upsert=True, ) :
+        self._collection = collection
+        self.interval = interval
+        self.max_keys = max_keys
+        self.upsert = upsert
+
+        # encoded spec -> (spec, {field: amount})
+        self._pending = dict()
+        self._call = None
+        self._trigger = None
+
+        self.increments = 0
+        self.updates = 0
+        self.lost = 0
+
+    def __len__ (self, ) :
+        return len(self._pending, )
+
+    def stats (self, ) :
+        return {
+                'increments': self.increments,
+                'updates': self.updates,
+                'lost': self.lost,
+                'pending': len(self, ),
+            }
+
+    @property
+    def running (self, ) :
+        return self._call is not None
+
+    def start (self, ) :
+        if self._call is not None :
+            return
+
+        self._call = task.LoopingCall(self.flush, )
+        self._call.clock = self.clock
+        self._call.start(self.interval, now=False, )
+        self._trigger = reactor.addSystemEventTrigger('before', 'shutdown', self._shutdown, )
+
+    def stop (self, ) :
+        """
+        stop flushing on the interval; fires when what is left is flushed.
+        """
+        if self._call is not None :
+            self._call.stop()
+            self._call = None
+        if self._trigger is not None :
+            reactor.removeSystemEventTrigger(self._trigger, )
+            self._trigger = None
+
+        return self.flush()
+
+    def _shutdown (self, ) :
+        # the trigger being run can not be removed
+        self._trigger = None
+        return self.stop()
+
+    def inc (self, spec, field, amount=1, ) :
+        """
+        add `amount` to `field` of the document matching `spec`.
+        """
+        _key = bson.BSON.encode(spec, )
+        _increments = self._pending.get(_key, )
+        if _increments is None :
+            _increments = self._pending[_key] = (spec, dict(), )
+        _increments[1][field] = _increments[1].get(field, 0, ) + amount
+        self.increments += 1
+
+        if len(self._pending, ) >= self.max_keys :
+            self.flush()
+
+    def flush (self, ) :
+        """
+        send the pending increments; fires when they are written.
+        """
+        if not self._pending :
+            return defer.succeed(None, )
+
+        _pending, self._pending = self._pending, dict()
+        _operations = [
+                UpdateOne(_spec, {'$inc': _increments, }, upsert=self.upsert, )
+                for _spec, _increments in _pending.itervalues()
+            ]
+        self.updates += len(_operations, )
+
+        _d = self._collection.bulk_write(_operations, ordered=False, )
+        _d.addCallbacks(lambda result : None, self._eb_flush, errbackArgs=(len(_operations, ), ), )
+        return _d
+
+    def _eb_flush (self, failure, n_updates, ) :
+        if failure.check(errors.BulkWriteError, ) and not failure.value.details['writeConcernErrors'] :
+            # the other updates are written; with a write concern error
+            # none of them is confirmed
+            n_updates = len(failure.value.details['writeErrors'], )
+        self.lost += n_updates
+
+        log.msg('failed to flush %d counter updates of `%s`, %s' % (
+                n_updates, self._collection, failure.getErrorMessage(), ), logLevel=logging.WARNING, )
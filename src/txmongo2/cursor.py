@@ -0,0 +1,518 @@
+# coding: utf-8
+
+"""
+Server cursors.
+
+`Cursor` fetches the results of a query batch by batch, so only one batch
+is held in memory however large the result is. `CommandCursor` does the
+same for the cursor returned by a command such as `aggregate`.
+`TailableCursor` follows a capped collection, or the oplog, and passes
+each new document to a callback as the GETMOREs return it.
+"""
+
+import logging
+from collections import deque
+
+import bson
+from bson.son import SON
+from pymongo import errors
+from twisted.internet import defer, error, reactor, task
+from twisted.python import failure, log
+
+from . import codec
+from .protocol import (
+        Query,
+        Getmore,
+        QUERY_AWAIT_DATA,
+        QUERY_OPLOG_REPLAY,
+        QUERY_SLAVE_OK,
+        QUERY_TAILABLE_CURSOR,
+        REPLY_CURSOR_NOT_FOUND,
+        Reply,
+        ReplyDocuments,
+    )
+
+# errors after which a cursor is opened again
+RETRY_ERRORS = (
+        errors.ConnectionFailure,
+        error.ConnectionDone,
+        error.ConnectionLost,
+    )
+
+
+def n_to_return (batch_size, limit=0, n_returned=0, ) :
+    """
+    the `numberToReturn` of the next batch of a query or a GETMORE.
+
+    the server takes 1 for -1 and closes the cursor after one document, so
+    a `batch_size` of 1 asks for 2, like pymongo, unless only one document
+    is left to `limit`.
+    """
+    if limit < 0 :
+        return limit
+
+    if batch_size == 1 :
+        batch_size = 2
+    if limit == 0 :
+        return batch_size
+
+    _remaining = limit - n_returned
+    return min(batch_size, _remaining, ) if batch_size else _remaining
+
+
+class Cursor (object, ) :
+    """
+    Cursor of a query.
+
+    the query is sent with the first fetch, and every following fetch gets
+    the next batch with a GETMORE of `batch_size` documents (0 lets the
+    server decide). `next_batch()` fires with the decoded documents of the
+    next batch, `next()` with the next document or `None` at the end.
+    A cursor closed before it is exhausted is killed on the server.
+
+    with `prefetch`, the GETMORE of the next batch is sent as soon as a
+    batch arrives, while the current one is consumed. The batch size then
+    adapts: it doubles whenever the consumer has to wait for a batch, but a
+    batch is kept under `max_batch_bytes` from the average size of the
+    documents seen, so at most two batches of a cursor are in memory.
+
+    with `raw` the documents are not decoded but returned as `bson.BSON`;
+    with `proto` the query is sent on that protocol.
+    """
+    max_batch_bytes = 4 * 1024 * 1024
+
+    def __init__ (self, collection, spec=None, skip=0, limit=0, fields=None,
+                batch_size=0, flags=0, as_class=dict, prefetch=False, raw=False, proto=None, ) :
+        self._collection = collection
+        self._spec = spec if spec is not None else SON()
+        self._skip = skip
+        self._limit = limit
+        self._fields = fields
+        self._flags = flags
+        self._as_class = as_class
+        self._raw = raw
+        self.batch_size = batch_size
+
+        # the protocol of the cursor, the connection chooses one when `None`
+        self._proto = proto
+        self._cursor_id = None
+        self._n_returned = 0
+        self._documents = deque()
+        self._fetching = False
+
+        self._prefetch = prefetch
+        self._prefetched = None
+        self._n_bytes = 0
+
+    @property
+    def alive (self, ) :
+        return self._cursor_id != 0
+
+    @property
+    def cursor_id (self, ) :
+        return self._cursor_id
+
+    def _kill (self, ) :
+        if self._proto is not None and self._cursor_id :
+            self._proto.cursors.kill(self._cursor_id, )
+        self._cursor_id = 0
+
+    def close (self, ) :
+        self._kill()
+        if self._prefetched is not None :
+            # nobody will consume the batch being prefetched
+            self._prefetched.addErrback(lambda failure : None, )
+            self._prefetched = None
+
+    def _n_to_return (self, ) :
+        return n_to_return(self.batch_size, self._limit, self._n_returned, )
+
+    @defer.inlineCallbacks
+    def _send_query (self, ) :
+        if self._proto is None :
+            self._proto = yield self._collection._database.connection.getprotocol(_type='read', )
+
+        _flags = self._flags
+        if not self._proto.config or self._proto.config.get('stateStr') in ('SECONDARY', ) :
+            _flags |= QUERY_SLAVE_OK
+
+        _query = Query(flags=_flags, collection=str(self._collection, ),
+                       n_to_skip=self._skip, n_to_return=self._n_to_return(),
+                       query=self._spec, fields=self._fields, )
+        _reply = yield self._proto.send_QUERY(_query, )
+        defer.returnValue(_reply, )
+
+    def _send_getmore (self, ) :
+        _getmore = Getmore(collection=str(self._collection, ),
+                           n_to_return=self._n_to_return(), cursor_id=self._cursor_id, )
+        return self._proto.send_GETMORE(_getmore, )
+
+    def fetch (self, ) :
+        """
+        fetch the next batch; fires with its undecoded `ReplyDocuments`,
+        empty when the cursor is exhausted.
+        """
+        if self._prefetched is not None :
+            _d, self._prefetched = self._prefetched, None
+            if not _d.called :
+                # the consumer is faster than the server, fetch more at once
+                self._grow_batch_size()
+        else :
+            _d = self._fetch()
+
+        if self._prefetch :
+            _d.addCallback(self._prefetch_next, )
+        return _d
+
+    def _prefetch_next (self, documents, ) :
+        if self.alive and self._prefetched is None :
+            self._prefetched = self._fetch()
+        return documents
+
+    def _grow_batch_size (self, ) :
+        if not self._n_returned :
+            return
+
+        _average = max(self._n_bytes // self._n_returned, 1, )
+        _max_batch_size = max(self.max_batch_bytes // _average, 1, )
+        self.batch_size = min((self.batch_size or self._n_returned) * 2, _max_batch_size, )
+
+    @defer.inlineCallbacks
+    def _fetch (self, ) :
+        if not self.alive :
+            defer.returnValue(ReplyDocuments('', [], ), )
+        if self._fetching :
+            raise errors.InvalidOperation('cursor is already fetching a batch.', )
+
+        _cursor_id = self._cursor_id
+        self._fetching = True
+        try :
+            if self._cursor_id is None :
+                _reply = yield self._send_query()
+            else :
+                _reply = yield self._send_getmore()
+        except :
+            self._kill()
+            raise
+        finally :
+            self._fetching = False
+
+        if self._cursor_id != _cursor_id :
+            # closed while the batch was fetched
+            if _reply.cursor_id and _reply.cursor_id != _cursor_id :
+                self._proto.cursors.add(_reply.cursor_id, str(self._collection, ), )
+                self._proto.cursors.kill(_reply.cursor_id, )
+            defer.returnValue(ReplyDocuments('', [], ), )
+
+        if _reply.response_flags & REPLY_CURSOR_NOT_FOUND :
+            self._proto.cursors.remove(self._cursor_id, )
+            self._cursor_id = 0
+            raise errors.OperationFailure('cursor not found, cursor id: %d' % _reply.cursor_id, )
+
+        if _reply.cursor_id != self._cursor_id :
+            self._proto.cursors.remove(self._cursor_id, )
+            self._proto.cursors.add(_reply.cursor_id, str(self._collection, ), )
+            self._cursor_id = _reply.cursor_id
+
+        _documents = _reply.documents
+        self._n_returned += len(_documents, )
+        self._n_bytes += _documents.size
+        if self._limit < 0 :
+            self._kill()
+        elif self._limit > 0 and self._n_returned >= self._limit :
+            _documents = _documents[:len(_documents) - (self._n_returned - self._limit)]
+            self._n_returned = self._limit
+            self._kill()
+
+        defer.returnValue(_documents, )
+
+    def next_batch (self, ) :
+        if self._raw :
+            return self.fetch().addCallback(list, )
+        return self.fetch().addCallback(
+                lambda documents : codec.get_executor().decode(documents, as_class=self._as_class, ), )
+
+    def next (self, ) :
+        if self._documents :
+            return defer.succeed(self._documents.popleft(), )
+        if not self.alive :
+            return defer.succeed(None, )
+
+        def _cb (batch, ) :
+            self._documents.extend(batch, )
+            return self.next()
+
+        return self.next_batch().addCallback(_cb, )
+
+    @defer.inlineCallbacks
+    def each (self, callback, ) :
+        """
+        call `callback` with every document; when it returns a deferred, the
+        next document waits for it.
+        """
+        try :
+            while True :
+                _document = yield self.next()
+                if _document is None :
+                    break
+
+                yield callback(_document, )
+        except :
+            self.close()
+            raise
+
+    @defer.inlineCallbacks
+    def to_list (self, ) :
+        _documents = list(self._documents, )
+        self._documents.clear()
+        while self.alive :
+            _batch = yield self.next_batch()
+            _documents.extend(_batch, )
+
+        defer.returnValue(_documents, )
+
+
+class CommandCursor (Cursor, ) :
+    """
+    Cursor of a command replying with `{cursor: {id, ns, firstBatch}}`.
+
+    the command is sent with the first fetch, its `firstBatch` is the first
+    batch and the following ones are fetched with GETMOREs like a `Cursor`.
+    The reply of the command is decoded to read the cursor, so the first
+    batch is decoded twice; pass a small `batchSize` in the command when
+    the rest is consumed as raw documents.
+    """
+
+    def __init__ (self, collection, command, batch_size=0, as_class=dict,
+                prefetch=False, raw=False, _type='read', ) :
+        super(CommandCursor, self, ).__init__(
+                collection, batch_size=batch_size, as_class=as_class, prefetch=prefetch, raw=raw, )
+        self._command = command
+        self._type = _type
+        self._namespace = str(collection, )
+
+    @defer.inlineCallbacks
+    def _send_query (self, ) :
+        self._proto = yield self._collection._database.connection.getprotocol(_type=self._type, )
+
+        _flags = 0
+        if not self._proto.config or self._proto.config.get('stateStr') in ('SECONDARY', ) :
+            _flags |= QUERY_SLAVE_OK
+
+        _query = Query(flags=_flags, collection='%s.$cmd' % self._collection._database,
+                       n_to_return=-1, query=self._command, )
+        _reply = yield self._proto.send_QUERY(_query, )
+
+        _result = _reply.documents[0].decode(as_class=SON, ) if _reply.documents else dict()
+        if not _result.get('ok', ) :
+            raise errors.OperationFailure(_result.get('errmsg', 'Unknown error', ), _result.get('code', ), )
+
+        _cursor = _result['cursor']
+        self._namespace = _cursor.get('ns', self._namespace, )
+
+        _encoded = [bson.BSON.encode(_document, ) for _document in _cursor.get('firstBatch', [], )]
+        _offsets = list()
+        _offset = 0
+        for _document in _encoded :
+            _offsets.append((_offset, _offset + len(_document, ), ), )
+            _offset += len(_document, )
+
+        _documents = ReplyDocuments(''.join(_encoded, ), _offsets, )
+        defer.returnValue(Reply(cursor_id=_cursor['id'], documents=_documents, ), )
+
+    def _send_getmore (self, ) :
+        _getmore = Getmore(collection=self._namespace,
+                           n_to_return=self._n_to_return(), cursor_id=self._cursor_id, )
+        return self._proto.send_GETMORE(_getmore, )
+
+
+class TailableCursor (object, ) :
+    """
+    Tail a capped collection.
+
+    every new document is decoded and passed to `callback`; when the
+    callback returns a deferred, the next document waits for it. After a
+    reconnect, or when the server drops the cursor, the query is sent again
+    for documents after the last seen `resume_field` (`ts` for the oplog,
+    `_id` otherwise). Without `await_data`, where the server does not wait
+    for new documents, the GETMORE after an empty one is delayed, from
+    `min_delay` doubling up to `max_delay` seconds; so is the query sent
+    again after an error.
+    """
+    clock = reactor
+
+    batch_size = 0
+    min_delay = 0.1
+    max_delay = 5
+
+    def __init__ (self, collection, callback, spec=None, fields=None, await_data=True,
+                oplog_replay=False, resume_field=None, as_class=dict, ) :
+        self._collection = collection
+        self._callback = callback
+        self._spec = spec if spec is not None else SON()
+        self._as_class = as_class
+
+        self._flags = QUERY_TAILABLE_CURSOR
+        if await_data :
+            self._flags |= QUERY_AWAIT_DATA
+        if oplog_replay :
+            self._flags |= QUERY_OPLOG_REPLAY
+
+        if resume_field is None :
+            resume_field = 'ts' if oplog_replay else '_id'
+        self.resume_field = resume_field
+        self.last_value = None
+        self._fields = self._with_resume_field(fields, )
+
+        self._delay = 0
+        self._sleeping = None
+        self._stopped = True
+        self._done = None
+
+    def start (self, ) :
+        """
+        start tailing; the returned deferred fires when `stop()` is called,
+        or fails with the error of the callback.
+        """
+        if self._done is None :
+            self._stopped = False
+            self._done = self._run()
+
+        return self._done
+
+    def stop (self, ) :
+        self._stopped = True
+        if self._sleeping is not None :
+            # no query after the backoff
+            self._sleeping.cancel()
+
+    @property
+    def stopped (self, ) :
+        return self._stopped
+
+    def _with_resume_field (self, fields, ) :
+        """
+        `fields` returning `resume_field` as well, which the resume needs.
+        """
+        if fields is None :
+            return None
+
+        _fields = SON(fields, )
+        _included = [_key for _key, _value in _fields.items() if _key != '_id' and _value == 1]
+        if _included :
+            _fields[self.resume_field] = 1
+        else :
+            # every other field is returned
+            _fields.pop(self.resume_field, None, )
+        return _fields
+
+    def _resume_spec (self, ) :
+        if self.last_value is None :
+            return self._spec
+
+        _condition = {self.resume_field: {'$gt': self.last_value, }, }
+        _spec = self._spec
+        if '$query' in _spec :
+            _spec = SON(_spec, )
+            _spec['$query'] = {'$and': [_spec['$query'], _condition, ], }
+            return _spec
+
+        if self.resume_field in _spec :
+            return {'$and': [_spec, _condition, ], }
+
+        _spec = SON(_spec, )
+        _spec.update(_condition, )
+        return _spec
+
+    def _sleep (self, delay, ) :
+        def _done (r, ) :
+            self._sleeping = None
+            if isinstance(r, failure.Failure, ) :
+                r.trap(defer.CancelledError, )
+            return None
+
+        self._sleeping = task.deferLater(self.clock, delay, lambda : None, )
+        return self._sleeping.addBoth(_done, )
+
+    def _backoff (self, ) :
+        self._delay = min(max(self._delay * 2, self.min_delay, ), self.max_delay, )
+        return self._sleep(self._delay, )
+
+    @defer.inlineCallbacks
+    def _run (self, ) :
+        try :
+            while not self._stopped :
+                try :
+                    yield self._tail()
+                except RETRY_ERRORS, e :
+                    log.msg('[debug] tailing `%s` is interrupted, %r.' % (self._collection, e, ), )
+
+                if not self._stopped :
+                    yield self._backoff()
+        finally :
+            self._stopped = True
+            self._done = None
+
+    @defer.inlineCallbacks
+    def _getprotocol (self, ) :
+        try :
+            _proto = yield self._collection._database.connection.getprotocol(_type='read', )
+        except errors.OperationFailure, e :
+            # no connection at the moment
+            raise errors.AutoReconnect(str(e), )
+
+        defer.returnValue(_proto, )
+
+    @defer.inlineCallbacks
+    def _tail (self, ) :
+        _proto = yield self._getprotocol()
+
+        _flags = self._flags
+        if not _proto.config or _proto.config.get('stateStr') in ('SECONDARY', ) :
+            _flags |= QUERY_SLAVE_OK
+
+        _query = Query(flags=_flags, collection=str(self._collection, ),
+                       n_to_return=n_to_return(self.batch_size, ), query=self._resume_spec(),
+                       fields=self._fields, )
+        _reply = yield _proto.send_QUERY(_query, )
+        _cursor_id = _reply.cursor_id
+        _proto.cursors.add(_cursor_id, str(self._collection, ), )
+        try :
+            yield self._deliver(_reply, )
+
+            while _cursor_id and not self._stopped :
+                if _reply.documents or self._flags & QUERY_AWAIT_DATA :
+                    # the server already waited for new documents
+                    self._delay = 0
+                else :
+                    yield self._backoff()
+                    if self._stopped :
+                        break
+
+                _getmore = Getmore(collection=str(self._collection, ),
+                                   n_to_return=n_to_return(self.batch_size, ), cursor_id=_cursor_id, )
+                _reply = yield _proto.send_GETMORE(_getmore, )
+                if _reply.response_flags & REPLY_CURSOR_NOT_FOUND :
+                    log.msg('cursor of `%s` is not found, tailing again.' % self._collection,
+                            logLevel=logging.WARNING, )
+                    _proto.cursors.remove(_cursor_id, )
+                    return
+
+                if _reply.cursor_id != _cursor_id :
+                    _proto.cursors.remove(_cursor_id, )
+                    _cursor_id = _reply.cursor_id
+
+                yield self._deliver(_reply, )
+        finally :
+            _proto.cursors.kill(_cursor_id, )
+
+    @defer.inlineCallbacks
+    def _deliver (self, reply, ) :
+        _documents = yield codec.get_executor().decode(reply.documents, as_class=self._as_class, )
+        for _document in _documents :
+            if self._stopped :
+                break
+
+            yield self._callback(_document, )
+            if self.resume_field in _document :
+                self.last_value = _document[self.resume_field]
@@ -14,7 +14,7 @@
 # limitations under the License.
 
 from bson.son import SON
-from pymongo import helpers
+from pymongo import errors, helpers
 from twisted.internet import defer
 from txmongo2.collection import Collection
 
@@ -33,7 +33,7 @@ class Database(object):
         return "Database(%r, %r)" % (self.__factory, self._database_name,)
 
     def __call__(self, database_name):
-        return Database(self._factory, database_name)
+        return Database(self.__factory, database_name)
 
     def __getitem__(self, collection_name):
         return Collection(self, collection_name)
@@ -45,6 +45,26 @@ class Database(object):
     def connection(self):
         return self.__factory
 
+    def set_cache_ttl(self, ttl):
+        """
+        cache the results of `find` on every collection of the database,
+        see `Collection.set_cache_ttl`.
+        """
+        cache = getattr(self.__factory, 'query_cache', None)
+        if cache is None:
+            raise errors.InvalidOperation("the connection has no query cache")
+        cache.set_ttl(self._database_name, ttl)
+
+    def set_single_flight(self, enabled=True):
+        """
+        share the requests of identical `find`s on every collection of the
+        database, see `Collection.set_single_flight`.
+        """
+        flight = getattr(self.__factory, 'single_flight', None)
+        if flight is None:
+            raise errors.InvalidOperation("the connection has no single flight")
+        flight.set_enabled(self._database_name, enabled)
+
     def create_collection(self, name, options={}):
         def wrapper(result, deferred, collection):
             if result.get("ok", 0.0):
@@ -62,6 +82,7 @@ class Database(object):
             command = SON({"create": name})
             command.update(options)
             d = self["$cmd"].find_one(command)
+            d.addBoth(collection._invalidate_metadata)
             d.addCallback(wrapper, deferred, collection)
         else:
             deferred.callback(collection)
@@ -76,7 +97,10 @@ class Database(object):
         else:
             raise TypeError("name must be an instance of basestring or txmongo.Collection")
 
-        return self["$cmd"].find_one({"drop": unicode(name)})
+        d = self["$cmd"].find_one({"drop": unicode(name)})
+        d.addBoth(self[name]._invalidate_metadata)
+        d.addBoth(self[name]._invalidate_cache)
+        return d
 
     def collection_names(self):
         def wrapper(results):
@@ -86,10 +110,23 @@ class Database(object):
             names = [n for n in names if "$" not in n]
             return names
 
+        cache = getattr(self.__factory, 'metadata_cache', None)
+        if cache is not None:
+            names = cache.get(self._database_name, 'collection_names')
+            if names is not None:
+                return defer.succeed(names)
+            generation = cache.generation(self._database_name)
+
         d = self["system.namespaces"].find()
         d.addCallback(wrapper)
+        if cache is not None:
+            d.addCallback(self._cache_collection_names, cache, generation)
         return d
 
+    def _cache_collection_names(self, names, cache, generation):
+        cache.put(self._database_name, 'collection_names', names, generation)
+        return names
+
     def authenticate(self, name, password):
         """
         Send an authentication command for this database.
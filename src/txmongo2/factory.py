@@ -50,3 +50,13 @@ class ReplicaSetConnectionFactory (BaseConnectionFactory, ) :
         return
 
 
+class MonitorConnectionFactory (BaseConnectionFactory, ) :
+    def __init__ (self, monitor, uri, ) :
+        self._monitor = monitor
+        BaseConnectionFactory.__init__(self, uri, )
+
+    def clientConnectionLost (self, connector, reason, ) :
+        BaseConnectionFactory.clientConnectionLost(self, connector, reason, )
+        self._monitor.remove_probe(connector, )
+
+        return
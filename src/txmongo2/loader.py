@@ -0,0 +1,99 @@
+# coding: utf-8
+
+"""
+Batched lookups by a single key.
+
+`Collection.loader()` returns a `Loader`; the values passed to
+`Loader.load()` within one reactor iteration are looked up together with
+one `{key: {'$in': [...]}}` query per `max_batch_size` values, and the
+deferred of every caller fires with its document, or `None` when there is
+none.
+"""
+
+import copy
+
+from twisted.internet import defer, reactor
+
+from .pagination import _get_value
+
+
+class Loader (object, ) :
+    clock = reactor
+
+    def __init__ (self, collection, key='_id', fields=None, max_batch_size=1000, **kwargs) :
+        self._collection = collection
+        self._key = key
+        self._fields = fields
+        self._kwargs = kwargs
+        self.max_batch_size = max_batch_size
+
+        self._pending = dict()
+        self._dispatch_call = None
+
+    def __len__ (self, ) :
+        return len(self._pending, )
+
+    def load (self, value, ) :
+        """
+        fires with the document whose key is `value`, or `None`.
+        """
+        _d = defer.Deferred()
+        if value not in self._pending :
+            self._pending[value] = list()
+        self._pending[value].append(_d, )
+
+        if self._dispatch_call is None :
+            self._dispatch_call = self.clock.callLater(0, self.dispatch, )
+
+        return _d
+
+    def load_many (self, values, ) :
+        return defer.gatherResults([self.load(_value, ) for _value in values], )
+
+    def dispatch (self, ) :
+        """
+        send the queries of the pending values now.
+        """
+        if self._dispatch_call is not None and self._dispatch_call.active() :
+            self._dispatch_call.cancel()
+        self._dispatch_call = None
+
+        _pending, self._pending = self._pending, dict()
+        _values = _pending.keys()
+        for i in xrange(0, len(_values, ), self.max_batch_size, ) :
+            _batch = dict([(_value, _pending[_value], ) for _value in _values[i:i + self.max_batch_size]], )
+            self._find(_batch, )
+
+    def _fields_with_key (self, ) :
+        if self._fields is None :
+            return None
+
+        if isinstance(self._fields, dict, ) :
+            _fields = dict(self._fields, )
+            _fields[self._key] = 1
+            return _fields
+
+        return list(self._fields, ) + [self._key, ]
+
+    def _find (self, batch, ) :
+        _d = self._collection.find(
+                {self._key: {'$in': batch.keys(), }, },
+                fields=self._fields_with_key(), **self._kwargs)
+        _d.addCallbacks(self._cb_find, self._eb_find, callbackArgs=(batch, ), errbackArgs=(batch, ), )
+
+    def _cb_find (self, documents, batch, ) :
+        _found = dict()
+        for _document in documents :
+            # the first document of a value when the key is not unique
+            _found.setdefault(_get_value(_document, self._key, ), _document, )
+
+        for _value, _deferreds in batch.iteritems() :
+            _document = _found.get(_value, )
+            for i, _d in enumerate(_deferreds, ) :
+                # every caller of the same value gets its own document
+                _d.callback(_document if i == 0 or _document is None else copy.deepcopy(_document, ), )
+
+    def _eb_find (self, failure, batch, ) :
+        for _deferreds in batch.itervalues() :
+            for _d in _deferreds :
+                _d.errback(failure, )
@@ -0,0 +1,123 @@
+# coding: utf-8
+
+"""
+Keyset pagination.
+
+`Collection.paginator()` returns a `Paginator`, which reads the pages of a
+sorted query without `skip`: every page ends with an opaque token holding
+the values of the sort fields of its last document, and the next page is
+the documents after them, queried with a range on the sort fields. `_id`
+is added as the last sort field, so documents with the same values are
+neither repeated nor skipped. With an index on the sort fields a page
+costs the same wherever it is.
+
+the sort fields should exist in every document; the range of a missing
+field compares with `null`.
+"""
+
+import base64
+
+import bson
+from bson.son import SON
+from pymongo import errors
+from twisted.internet import defer
+
+from . import filter as qf
+
+
+def _get_value (document, key, ) :
+    for _name in key.split('.', ) :
+        if not isinstance(document, dict, ) :
+            return None
+        document = document.get(_name, )
+    return document
+
+
+class Paginator (object, ) :
+
+    def __init__ (self, collection, sort, page_size=100, spec=None, fields=None, **kwargs) :
+        if not isinstance(sort, qf.sort, ) :
+            raise TypeError('sort must be an instance of filter.sort', )
+
+        _orderby = list(sort['orderby'], )
+        for _key, _direction in _orderby :
+            if _direction not in (1, -1, ) :
+                raise TypeError('can not paginate on a %r index of %r.' % (_direction, _key, ), )
+        if '_id' not in [_key for _key, _direction in _orderby] :
+            _orderby.append(('_id', _orderby[-1][1] if _orderby else 1, ), )
+
+        self._collection = collection
+        self._orderby = _orderby
+        self._spec = spec
+        self._fields = fields
+        self._kwargs = kwargs
+        self.page_size = page_size
+
+    def _sort (self, ) :
+        return qf.sort(list(self._orderby, ), )
+
+    def _fields_with_keys (self, ) :
+        if self._fields is None :
+            return None
+
+        _keys = [_key for _key, _direction in self._orderby]
+        if isinstance(self._fields, dict, ) :
+            _fields = dict(self._fields, )
+            _fields.update([(_key, 1, ) for _key in _keys], )
+            return _fields
+
+        return list(self._fields, ) + _keys
+
+    def token (self, document, ) :
+        """
+        the token of the page after `document`.
+        """
+        _keys = [_key for _key, _direction in self._orderby]
+        _encoded = bson.BSON.encode({
+                'k': _keys,
+                'v': [_get_value(document, _key, ) for _key in _keys],
+            }, )
+        return base64.urlsafe_b64encode(_encoded, )
+
+    def _values (self, token, ) :
+        try :
+            _decoded = bson.BSON(base64.urlsafe_b64decode(str(token, ), ), ).decode()
+        except Exception :
+            raise errors.InvalidOperation('invalid page token.', )
+
+        if _decoded.get('k', ) != [_key for _key, _direction in self._orderby] :
+            raise errors.InvalidOperation('the page token is not of this sort order.', )
+
+        return _decoded['v']
+
+    def after (self, values, ) :
+        """
+        the query of the documents after the sort `values`.
+        """
+        _or = list()
+        for i, (_key, _direction) in enumerate(self._orderby, ) :
+            _condition = SON([(_k, _v, ) for (_k, _d), _v in zip(self._orderby[:i], values[:i], )], )
+            _condition[_key] = {'$gt' if _direction == 1 else '$lt': values[i], }
+            _or.append(_condition, )
+
+        _after = {'$or': _or, }
+        return {'$and': [self._spec, _after, ], } if self._spec else _after
+
+    @defer.inlineCallbacks
+    def page (self, token=None, ) :
+        """
+        fires with the documents of the page after `token`, the first one
+        when `None`, and the token of the next page, `None` after the last.
+        """
+        _spec = self._spec if token is None else self.after(self._values(token, ), )
+
+        # one more document tells whether there is a next page
+        _documents = yield self._collection.find(
+                _spec, limit=self.page_size + 1, fields=self._fields_with_keys(),
+                filter=self._sort(), **self._kwargs)
+        _documents = list(_documents, )
+        if len(_documents, ) <= self.page_size :
+            defer.returnValue((_documents, None, ), )
+
+        _documents = _documents[:self.page_size]
+        defer.returnValue((_documents, self.token(_documents[-1], ), ), )
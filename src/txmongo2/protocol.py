@@ -25,37 +25,49 @@ implementation can be shared. This includes BSON encoding and
 decoding as well as Exception types, when applicable.
 """
 
+import bisect
 import bson
+from   bson.son         import SON
 from   collections      import namedtuple
 from   pymongo          import errors
 import struct
-from   twisted.internet import defer, protocol
+from   twisted.internet import defer, protocol, reactor
 from   twisted.python   import failure, log
 
+from   . import compression
+
 INT_MAX = 2147483647
 
+_use_c = bson.has_c()
+
 OP_REPLY        = 1
-OP_MSG          = 1000
+OP_LEGACY_MSG   = 1000
 OP_UPDATE       = 2001
 OP_INSERT       = 2002
 OP_QUERY        = 2004
 OP_GETMORE      = 2005
 OP_DELETE       = 2006
 OP_KILL_CURSORS = 2007
+OP_COMPRESSED   = 2012
+OP_MSG          = 2013
 
 OP_NAMES = {
     OP_REPLY:        'REPLY',
+    OP_LEGACY_MSG:   'LEGACY_MSG',
     OP_MSG:          'MSG',
     OP_UPDATE:       'UPDATE',
     OP_INSERT:       'INSERT',
     OP_QUERY:        'QUERY',
     OP_GETMORE:      'GETMORE',
     OP_DELETE:       'DELETE',
-    OP_KILL_CURSORS: 'KILL_CURSORS'
+    OP_KILL_CURSORS: 'KILL_CURSORS',
+    OP_COMPRESSED:   'COMPRESSED',
 }
 
 DELETE_SINGLE_REMOVE = 1 << 0
 
+INSERT_CONTINUE_ON_ERROR = 1 << 0
+
 QUERY_TAILABLE_CURSOR   = 1 << 1
 QUERY_SLAVE_OK          = 1 << 2
 QUERY_OPLOG_REPLAY      = 1 << 3
@@ -72,8 +84,34 @@ REPLY_AWAIT_CAPABLE      = 1 << 3
 UPDATE_UPSERT = 1 << 0
 UPDATE_MULTI  = 1 << 1
 
-Msg = namedtuple('Msg', ['len', 'request_id', 'response_to', 'opcode', 'message'])
-KillCursors = namedtuple('KillCursors', ['len', 'request_id', 'response_to', 'opcode', 'zero', 'n_cursors', 'cursors'])
+MSG_CHECKSUM_PRESENT = 1 << 0
+MSG_MORE_TO_COME     = 1 << 1
+MSG_EXHAUST_ALLOWED  = 1 << 16
+
+# the first wire version with OP_MSG, mongodb 3.6
+OP_MSG_WIRE_VERSION = 6
+
+# room left in a write message for everything but the documents
+MESSAGE_OVERHEAD = 16 * 1024
+
+# commands never compressed: the handshake, before the compressor is
+# negotiated, and the ones carrying credentials
+UNCOMPRESSED_COMMANDS = frozenset([
+    'ismaster', 'isMaster',
+    'saslStart', 'saslContinue',
+    'getnonce', 'authenticate',
+    'createUser', 'updateUser',
+    'copydbSaslStart', 'copydbgetnonce', 'copydb',
+])
+
+
+def _command_name(document):
+    """the first key of an encoded document, the name of a command."""
+    if len(document) <= 5:
+        return None
+    return document[5:document.index('\x00', 5)]
+
+LegacyMsg = namedtuple('LegacyMsg', ['len', 'request_id', 'response_to', 'opcode', 'message'])
 
 class Delete(namedtuple('Delete', ['len', 'request_id', 'response_to', 'opcode', 'zero', 'collection', 'flags', 'selector'])):
     def __new__(cls, len=0, request_id=0, response_to=0, opcode=OP_DELETE,
@@ -82,6 +120,36 @@ class Delete(namedtuple('Delete', ['len', 'request_id', 'response_to', 'opcode',
                                            opcode, zero, collection,
                                            flags, selector)
 
+class Msg(namedtuple('Msg', ['len', 'request_id', 'response_to', 'opcode',
+                             'flags', 'body', 'sequences'])):
+    """
+    OP_MSG; `body` is the kind 0 section and `sequences` maps the
+    identifier of each kind 1 section to its list of documents.
+    """
+    def __new__(cls, len=0, request_id=0, response_to=0, opcode=OP_MSG,
+                flags=0, body=None, sequences=None):
+        if body is None:
+            body = {}
+        if not isinstance(body, bson.BSON):
+            body = bson.BSON.encode(body)
+        if sequences is None:
+            sequences = {}
+        return super(Msg, cls).__new__(cls, len, request_id, response_to,
+                                       opcode, flags, body, sequences)
+
+class KillCursors(namedtuple('KillCursors', ['len', 'request_id', 'response_to',
+                                             'opcode', 'zero', 'n_cursors',
+                                             'cursors'])):
+    def __new__(cls, len=0, request_id=0, response_to=0, opcode=OP_KILL_CURSORS,
+                zero=0, n_cursors=None, cursors=None):
+        if cursors is None:
+            cursors = []
+        if n_cursors is None:
+            # `len` is shadowed by the message length
+            n_cursors = cursors.__len__()
+        return super(KillCursors, cls).__new__(cls, len, request_id, response_to,
+                                               opcode, zero, n_cursors, cursors)
+
 class Getmore(namedtuple('Getmore', ['len', 'request_id', 'response_to',
                                      'opcode', 'zero', 'collection',
                                      'n_to_return', 'cursor_id'])):
@@ -109,12 +177,125 @@ class Reply(namedtuple('Reply', ['len', 'request_id', 'response_to', 'opcode',
             documents = []
         if n_returned is None:
             n_returned = len(documents)
-        documents = [b if isinstance(b, bson.BSON) else bson.BSON.encode(b) for b in documents]
+        if not isinstance(documents, ReplyDocuments):
+            documents = [b if isinstance(b, bson.BSON) else bson.BSON.encode(b) for b in documents]
         return super(Reply, cls).__new__(cls, _len, request_id, response_to,
                                          opcode, response_flags, cursor_id,
                                          starting_from, n_returned,
                                          documents)
 
+class ReplyDocuments(object):
+    """
+    Read-only sequence over the documents of an OP_REPLY.
+
+    Only the raw documents section of the message and a table of document
+    offsets are kept; a document is sliced out as `bson.BSON` only when it
+    is indexed or iterated. Slicing returns another `ReplyDocuments`
+    sharing the same data.
+    """
+    __slots__ = ('_data', '_offsets', )
+
+    def __init__(self, data, offsets):
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    @property
+    def size(self):
+        """total size of the documents in bytes"""
+        return sum([end - start for start, end in self._offsets])
+
+    def __iter__(self):
+        for start, end in self._offsets:
+            yield bson.BSON(self._data[start:end])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ReplyDocuments(self._data, self._offsets[index])
+        start, end = self._offsets[index]
+        return bson.BSON(self._data[start:end])
+
+    def decode_all(self, as_class=dict):
+        """
+        decode every document; with the C extension of `bson` the whole
+        documents section is decoded by a single `bson.decode_all` call.
+        """
+        if not self._offsets:
+            return []
+
+        start, end = self._offsets[0][0], self._offsets[-1][1]
+        if _use_c and self.size == end - start:
+            return bson.decode_all(self._data[start:end], as_class, False)
+
+        return [bson.BSON(self._data[s:e]).decode(as_class=as_class) for s, e in self._offsets]
+
+    def __repr__(self):
+        return '<ReplyDocuments: %d documents>' % len(self)
+
+
+class LazyDocuments(object):
+    """
+    Read-only sequence over the documents of one or more replies.
+
+    A document is decoded with `as_class` the first time it is indexed or
+    iterated, and the decoded document is kept for later accesses. With
+    `raw=True` the undecoded `bson.BSON` is returned instead.
+    """
+
+    def __init__(self, documents=None, as_class=dict, raw=False):
+        self.as_class = as_class
+        self.raw = raw
+
+        self._batches = list()
+        self._ends = list()
+        self._decoded = dict()
+        if documents is not None:
+            self.extend(documents)
+
+    def extend(self, documents):
+        if not len(documents):
+            return
+        self._batches.append(documents)
+        self._ends.append(len(self) + len(documents))
+
+    def __len__(self):
+        return self._ends[-1] if self._ends else 0
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('document index out of range')
+
+        if index not in self._decoded:
+            batch = bisect.bisect_right(self._ends, index)
+            start = self._ends[batch - 1] if batch else 0
+            document = self._batches[batch][index - start]
+            if not self.raw:
+                document = document.decode(as_class=self.as_class)
+            self._decoded[index] = document
+
+        return self._decoded[index]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<LazyDocuments: %d documents>' % len(self)
+
+
 class Query(namedtuple('Query', ['len', 'request_id', 'response_to', 'opcode',
                                  'flags', 'collection', 'n_to_skip',
                                  'n_to_return', 'query', 'fields'])):
@@ -143,19 +324,82 @@ class Update(namedtuple('Update', ['len', 'request_id', 'response_to',
 class MongoClientProtocol(protocol.Protocol):
     __request_id = 1
 
+    # messages sent within the same reactor iteration are queued and
+    # written with a single `writeSequence`; the queue is flushed right
+    # away once it holds `write_buffer_size` bytes.
+    coalesce_writes = True
+    write_buffer_size = 64 * 1024
+
+    clock = reactor
+
+    # the compressor negotiated with the server; messages of at least
+    # `compression_threshold` bytes are sent in OP_COMPRESSED, except the
+    # ones with an opcode in `uncompressed_opcodes` and the commands in
+    # `uncompressed_commands`.
+    compressor = None
+    compression_threshold = 1024
+    uncompressed_opcodes = frozenset([OP_GETMORE, OP_KILL_CURSORS, ])
+    uncompressed_commands = UNCOMPRESSED_COMMANDS
+
+    _write_queue = None
+    _write_queue_size = 0
+    _flush_call = None
+
     def getrequestid(self):
         return self.__request_id
 
-    def _send(self, iovec):
+    def _compress(self, iovec):
+        datalen = sum([len(chunk) for chunk in iovec]) - 8
+        if datalen + 16 < self.compression_threshold:
+            return iovec
+        response_to, opcode = struct.unpack_from('<ii', iovec[0])
+        if opcode in self.uncompressed_opcodes:
+            return iovec
+
+        data = self.compressor.compress(''.join(iovec)[8:])
+        return [struct.pack('<iiiiB', response_to, OP_COMPRESSED, opcode, datalen,
+                            self.compressor.compressor_id),
+                data]
+
+    def _compressible(self, command):
+        return _command_name(command) not in self.uncompressed_commands
+
+    def _send(self, iovec, compress=True):
+        if self.compressor is not None and compress:
+            iovec = self._compress(iovec)
         request_id, self.__request_id = self.__request_id, self.__request_id + 1
         if self.__request_id >= INT_MAX:
             self.__request_id = 1
         datalen = sum([len(chunk) for chunk in iovec]) + 8
         datareq = struct.pack('<ii', datalen, request_id)
         iovec.insert(0, datareq)
-        self.transport.write(''.join(iovec))
+        if not self.coalesce_writes:
+            self.transport.write(''.join(iovec))
+            return request_id
+
+        if self._write_queue is None:
+            self._write_queue = []
+        self._write_queue.extend(iovec)
+        self._write_queue_size += datalen
+        if self._write_queue_size >= self.write_buffer_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(0, self.flush)
         return request_id
 
+    def flush(self):
+        """
+        write the queued messages to the transport.
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+
+        queue, self._write_queue, self._write_queue_size = self._write_queue, None, 0
+        if queue and self.transport:
+            self.transport.writeSequence(queue)
+
     def send(self, request):
         opname = OP_NAMES[request.opcode]
         sender = getattr(self, 'send_%s' % opname, None)
@@ -169,10 +413,19 @@ class MongoClientProtocol(protocol.Protocol):
         iovec.extend(request.documents)
         self._send(iovec)
 
-    def send_MSG(self, request):
+    def send_LEGACY_MSG(self, request):
         iovec = [struct.pack('<ii', *request[2:4]), request.message, '\x00']
         return self._send(iovec)
 
+    def send_MSG(self, request):
+        iovec = [struct.pack('<iiI', *request[2:5]), '\x00', request.body]
+        for identifier, documents in request.sequences.items():
+            identifier = identifier.encode('ascii') + '\x00'
+            size = 4 + len(identifier) + sum([len(d) for d in documents])
+            iovec.append('\x01' + struct.pack('<i', size) + identifier)
+            iovec.extend(documents)
+        return self._send(iovec, self._compressible(request.body))
+
     def send_UPDATE(self, request):
         iovec = [struct.pack('<iii', *request[2:5]),
                  request.collection.encode('ascii'), '\x00',
@@ -193,7 +446,9 @@ class MongoClientProtocol(protocol.Protocol):
                  struct.pack('<ii', request.n_to_skip, request.n_to_return),
                  request.query,
                  (request.fields or '')]
-        return self._send(iovec)
+        compress = (not request.collection.endswith('.$cmd') or
+                    self._compressible(request.query))
+        return self._send(iovec, compress)
 
     def send_GETMORE(self, request):
         iovec = [struct.pack('<iii', *request[2:5]),
@@ -210,12 +465,195 @@ class MongoClientProtocol(protocol.Protocol):
 
     def send_KILL_CURSORS(self, request):
         iovec = [struct.pack('<iii', *request[2:5]),
-                 request.collection.encode('ascii'), '\x00',
                  struct.pack('<i', len(request.cursors))]
         for cursor in request.cursors:
             iovec.append(struct.pack('<q', cursor))
         return self._send(iovec)
 
+def _moving_average(average, sample, alpha):
+    """exponentially weighted, starting from the first sample"""
+    if average is None:
+        return sample
+    return average + alpha * (sample - average)
+
+
+class CursorRegistry(object):
+    """
+    The open server cursors of a connection.
+
+    Cursors given up before they are exhausted are not killed one by one;
+    their ids are collected and sent in a single OP_KILL_CURSORS every
+    `interval` seconds. Nothing is sent for the cursors of a lost
+    connection.
+    """
+    interval = 1
+    max_cursors = 10000
+
+    def __init__(self, proto):
+        self._proto = proto
+        self._open = {}
+        self._killed = []
+        self._flush_call = None
+
+    def __len__(self):
+        return len(self._open)
+
+    def __contains__(self, cursor_id):
+        return cursor_id in self._open
+
+    def add(self, cursor_id, collection):
+        if cursor_id:
+            self._open[cursor_id] = collection
+
+    def remove(self, cursor_id):
+        """
+        forget the cursor, it was exhausted or closed by the server.
+        """
+        self._open.pop(cursor_id, None)
+
+    def kill(self, cursor_id):
+        if self._open.pop(cursor_id, None) is None:
+            return
+        self._killed.append(cursor_id)
+        if len(self._killed) >= self.max_cursors:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self._proto.clock.callLater(self.interval, self.flush)
+
+    def flush(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+
+        killed, self._killed = self._killed, []
+        if killed and self._proto.transport:
+            self._proto.send_KILL_CURSORS(KillCursors(cursors=killed))
+
+    def clear(self):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        self._open = {}
+        self._killed = []
+
+class _PendingInsert(object):
+    def __init__(self, db, collection):
+        self.db = db
+        self.collection = collection
+        self.documents = []
+        self.size = 0
+        self.callers = []
+        self.call = None
+
+class GroupCommit(object):
+    """
+    Inserts of concurrent callers merged into one message.
+
+    the documents inserted into a collection within `window` seconds (0 is
+    the next reactor iteration) are sent in one OP_INSERT acknowledged by
+    one `getlasterror`, or one `insert` command, and the outcome is passed
+    to the deferred of every caller. The documents are inserted
+    independently of each other, as with `INSERT_CONTINUE_ON_ERROR`. A
+    write command reports its errors by document, so only the callers of
+    the failed documents get them; `getlasterror` reports a single error,
+    which then fails every caller of the message.
+    """
+    window = 0
+
+    def __init__(self, proto):
+        self._proto = proto
+        self._pending = {}
+
+    def __len__(self):
+        return sum([len(batch.callers) for batch in self._pending.itervalues()])
+
+    def insert(self, db, collection, documents, safe=True):
+        """
+        queue the encoded `documents`; fires once they are acknowledged.
+        """
+        key = (db, collection, safe)
+        size = sum([len(document) for document in documents])
+        batch = self._pending.get(key)
+        if batch is not None and (
+                len(batch.documents) + len(documents) > self._proto.max_write_batch_size or
+                batch.size + size > self._proto.max_message_size - MESSAGE_OVERHEAD):
+            self.flush(key)
+            batch = None
+
+        if batch is None:
+            batch = self._pending[key] = _PendingInsert(db, collection)
+            batch.call = self._proto.clock.callLater(self.window, self.flush, key)
+
+        df = defer.Deferred()
+        batch.callers.append((len(batch.documents), len(documents), df))
+        batch.documents.extend(documents)
+        batch.size += size
+        return df
+
+    def flush(self, key=None):
+        if key is None:
+            for key in self._pending.keys():
+                self.flush(key)
+            return
+
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        if batch.call.active():
+            batch.call.cancel()
+
+        db, collection, safe = key
+        if self._proto.op_msg_enabled():
+            command = SON([('insert', collection), ('ordered', False)])
+            df = self._proto.write_command(db, command, 'documents', batch.documents,
+                                           safe=safe, check=False)
+        else:
+            self._proto.send_INSERT(Insert(flags=INSERT_CONTINUE_ON_ERROR,
+                                           collection='%s.%s' % (db, collection),
+                                           documents=batch.documents))
+            df = self._proto.getlasterror(db) if safe else defer.succeed(None)
+
+        df.addCallbacks(self._callback, self._errback,
+                        callbackArgs=(batch,), errbackArgs=(batch,))
+
+    def _callback(self, result, batch):
+        errors_by_index = {}
+        for error in (result or {}).get('writeErrors', ()):
+            errors_by_index.setdefault(error.get('index'), error)
+        concern_error = (result or {}).get('writeConcernError')
+
+        for start, n, df in batch.callers:
+            for index in xrange(start, start + n):
+                if index in errors_by_index:
+                    error = errors_by_index[index]
+                    code = error.get('code')
+                    if code == 11000:
+                        df.errback(errors.DuplicateKeyError(error.get('errmsg'), code=code))
+                    else:
+                        df.errback(errors.OperationFailure(error.get('errmsg'), code=code))
+                    break
+            else:
+                if concern_error:
+                    df.errback(errors.OperationFailure(concern_error.get('errmsg'),
+                                                       code=concern_error.get('code')))
+                else:
+                    df.callback(None)
+
+    def _errback(self, failure, batch):
+        for start, n, df in batch.callers:
+            df.errback(failure)
+
+    def clear(self, reason):
+        """
+        fail the inserts not sent yet.
+        """
+        pending, self._pending = self._pending, {}
+        for batch in pending.itervalues():
+            if batch.call.active():
+                batch.call.cancel()
+            self._errback(reason, batch)
+
 class MongoServerProtocol(protocol.Protocol):
     __decoder = None
 
@@ -244,6 +682,9 @@ class MongoServerProtocol(protocol.Protocol):
     def handle_REPLY(self, request):
         pass
 
+    def handle_LEGACY_MSG(self, request):
+        pass
+
     def handle_MSG(self, request):
         pass
 
@@ -268,14 +709,43 @@ class MongoServerProtocol(protocol.Protocol):
 class MongoProtocol(MongoServerProtocol, MongoClientProtocol):
     __connection_ready = None
     __deferreds = None
+    __exhaust = None
+    __sent = None
 
     addr = None
     config = None
 
+    # OP_MSG is used for writes when the server supports it
+    use_op_msg = True
+
+    # limits of the server, updated from the `ismaster` result
+    max_wire_version = 0
+    max_bson_size = 16 * 1024 * 1024
+    max_message_size = 48000000
+    max_write_batch_size = 1000
+
+    # compressors to request from the server, in order of preference; the
+    # `compressors` argument of `MongoConnection` takes precedence
+    compressors = ()
+
+    # average seconds from a query or a command to its reply, each reply
+    # weighing `latency_alpha`; `None` until the first reply
+    latency = None
+    latency_alpha = 0.2
+
+    # average round trip seconds of the `ismaster` probes of the replica
+    # set monitor, each probe weighing `rtt_alpha`
+    rtt = None
+    rtt_alpha = 0.2
+
     def __init__(self):
         MongoServerProtocol.__init__(self)
         self.__connection_ready = []
         self.__deferreds = {}
+        self.__exhaust = {}
+        self.__sent = {}
+        self.cursors = CursorRegistry(self)
+        self.group_commit = GroupCommit(self)
 
         self.config = None
 
@@ -300,6 +770,45 @@ class MongoProtocol(MongoServerProtocol, MongoClientProtocol):
     def inflight(self):
         return len(self.__deferreds)
 
+    def exhausting(self):
+        """
+        whether an exhaust query is streaming its replies on this connection.
+        """
+        return bool(self.__exhaust)
+
+    def _record_latency(self, request_id):
+        sent = self.__sent.pop(request_id, None)
+        if sent is None:
+            return
+        self.latency = _moving_average(self.latency, self.clock.seconds() - sent, self.latency_alpha)
+
+    def record_rtt(self, seconds):
+        self.rtt = _moving_average(self.rtt, seconds, self.rtt_alpha)
+
+    def set_server_info(self, document):
+        """
+        record the wire version and the limits of the server from the
+        result of `ismaster`.
+        """
+        self.max_wire_version = document.get('maxWireVersion', 0)
+        self.max_bson_size = document.get('maxBsonObjectSize', self.max_bson_size)
+        self.max_message_size = document.get('maxMessageSizeBytes', self.max_message_size)
+        self.max_write_batch_size = document.get('maxWriteBatchSize', self.max_write_batch_size)
+        # only the handshake requests compression; the `ismaster` of the
+        # replica set monitor and other later ones keep the compressor
+        if 'compression' in document:
+            self.compressor = compression.negotiate(
+                    self.requested_compressors(), document['compression'])
+
+    def requested_compressors(self):
+        compressors = self.factory.uri['options'].get('compressors', self.compressors)
+        if isinstance(compressors, basestring):
+            compressors = compressors.split(',')
+        return list(compressors)
+
+    def op_msg_enabled(self):
+        return self.use_op_msg and self.max_wire_version >= OP_MSG_WIRE_VERSION
+
     def connectionMade(self):
         deferreds, self.__connection_ready = self.__connection_ready, []
         if deferreds:
@@ -309,6 +818,15 @@ class MongoProtocol(MongoServerProtocol, MongoClientProtocol):
         self.factory.clientConnectionMade(self, )
 
     def connectionLost(self, reason):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        self._write_queue, self._write_queue_size = None, 0
+
+        self.__exhaust = {}
+        self.__sent = {}
+        self.cursors.clear()
+        self.group_commit.clear(reason)
         if self.__deferreds:
             deferreds, self.__deferreds = self.__deferreds, {}
             for df in deferreds.itervalues():
@@ -339,46 +857,125 @@ class MongoProtocol(MongoServerProtocol, MongoClientProtocol):
         request_id = MongoClientProtocol.send_QUERY(self, request)
         df = defer.Deferred()
         self.__deferreds[request_id] = df
+        # not GETMOREs, which may wait for data on the server
+        self.__sent[request_id] = self.clock.seconds()
         return df
 
-    def handle_REPLY(self, request):
+    def send_QUERY_EXHAUST(self, request, callback):
+        """
+        send the query as an exhaust cursor; the server streams every batch
+        back without GETMOREs. `callback` is called with each reply, and the
+        returned deferred fires with the last one, when the cursor is
+        exhausted. The server answers no other request on this connection
+        until then, so `exhausting()` is true and the connections leave
+        this protocol out of the selection while another one is available.
+        """
+        request = request._replace(flags=request.flags | QUERY_EXHAUST)
+        request_id = MongoClientProtocol.send_QUERY(self, request)
+        df = defer.Deferred()
+        self.__deferreds[request_id] = df
+        self.__exhaust[request_id] = callback
+        return df
+
+    def send_MSG(self, request):
+        request_id = MongoClientProtocol.send_MSG(self, request)
+        if request.flags & MSG_MORE_TO_COME:
+            return defer.succeed(None)
+        df = defer.Deferred()
+        self.__deferreds[request_id] = df
+        self.__sent[request_id] = self.clock.seconds()
+        return df
+
+    def handle_MSG(self, request):
         if request.response_to in self.__deferreds:
             df = self.__deferreds.pop(request.response_to)
-            if request.response_flags & REPLY_QUERY_FAILURE:
-                doc = request.documents[0].decode()
+            self._record_latency(request.response_to)
+            doc = request.body.decode()
+            if not doc.get('ok'):
                 code = doc.get('code')
-                msg = doc.get('$err', 'Unknown error')
-                fail_conn = False
-                if code == 13435:
-                    err = errors.AutoReconnect(msg)
-                    fail_conn = True
-                else:
-                    err = errors.OperationFailure(msg, code)
-                df.errback(err)
-                if fail_conn:
+                msg = doc.get('errmsg', 'Unknown error')
+                if code in (10107, 13435, ):
+                    df.errback(errors.AutoReconnect(msg))
                     self.transport.loseConnection()
+                else:
+                    df.errback(errors.OperationFailure(msg, code))
             else:
                 df.callback(request)
 
+    def handle_REPLY(self, request):
+        if request.response_to in self.__deferreds:
+            df = self.__deferreds.pop(request.response_to)
+            self._record_latency(request.response_to)
+            if request.response_to in self.__exhaust:
+                callback = self.__exhaust.pop(request.response_to)
+                self._handle_exhaust_REPLY(request, df, callback)
+            else:
+                self._callback_REPLY(request, df)
+
+    def _callback_REPLY(self, request, df):
+        if request.response_flags & REPLY_QUERY_FAILURE:
+            doc = request.documents[0].decode()
+            code = doc.get('code')
+            msg = doc.get('$err', 'Unknown error')
+            fail_conn = False
+            if code == 13435:
+                err = errors.AutoReconnect(msg)
+                fail_conn = True
+            else:
+                err = errors.OperationFailure(msg, code)
+            df.errback(err)
+            if fail_conn:
+                self.transport.loseConnection()
+        else:
+            df.callback(request)
+
+    def _handle_exhaust_REPLY(self, request, df, callback):
+        if request.response_flags & REPLY_QUERY_FAILURE:
+            return self._callback_REPLY(request, df)
+
+        if callback is not None:
+            try:
+                callback(request)
+            except:
+                df.errback(failure.Failure())
+                # keep draining the stream without calling back
+                df, callback = defer.Deferred().addErrback(lambda f: None), None
+
+        if request.cursor_id:
+            # the next reply of an exhaust cursor responds to this one
+            self.__deferreds[request.request_id] = df
+            self.__exhaust[request.request_id] = callback
+        else:
+            df.callback(request)
+
     def fail(self, reason):
         if not isinstance(reason, failure.Failure):
             reason = failure.Failure(reason)
         log.err(reason)
         self.transport.loseConnection()
 
-    @defer.inlineCallbacks
-    def getlasterror(self, db):
-        command = {'getlasterror': 1}
-        db = '%s.$cmd' % db.split('.', 1)[0]
+    def _write_concern(self):
+        write_concern = {}
         uri = self.factory.uri
         if 'w' in uri['options']:
-            command['w'] = int(uri['options']['w'])
+            write_concern['w'] = int(uri['options']['w'])
         if 'wtimeoutms' in uri['options']:
-            command['wtimeout'] = int(uri['options']['wtimeoutms'])
+            write_concern['wtimeout'] = int(uri['options']['wtimeoutms'])
         if 'fsync' in uri['options']:
-            command['fsync'] = bool(uri['options']['fsync'])
+            write_concern['fsync'] = bool(uri['options']['fsync'])
         if 'journal' in uri['options']:
-            command['journal'] = bool(uri['options']['journal'])
+            write_concern['journal'] = bool(uri['options']['journal'])
+        return write_concern
+
+    @defer.inlineCallbacks
+    def getlasterror(self, db, check=True):
+        """
+        fires with the document of `getlasterror`; with `check` an error in
+        it is raised instead.
+        """
+        command = {'getlasterror': 1}
+        db = '%s.$cmd' % db.split('.', 1)[0]
+        command.update(self._write_concern())
 
         query = Query(collection=db, query=command)
         reply = yield self.send_QUERY(query)
@@ -389,7 +986,7 @@ class MongoProtocol(MongoServerProtocol, MongoClientProtocol):
         err = document.get('err', None)
         code = document.get('code', None)
 
-        if err is not None:
+        if check and err is not None:
             if code == 11000:
                 raise errors.DuplicateKeyError(err, code=code)
             else:
@@ -397,120 +994,229 @@ class MongoProtocol(MongoServerProtocol, MongoClientProtocol):
 
         defer.returnValue(document)
 
+    @defer.inlineCallbacks
+    def write_command(self, db, command, identifier, documents, safe=True, check=True):
+        """
+        send a write command (`insert`, `update` or `delete`) in an OP_MSG,
+        `documents` are sent as the document sequence `identifier`, so the
+        acknowledgement comes back with the reply and no `getlasterror` is
+        needed. Unsafe writes are sent with `moreToCome` and no reply.
+        Without `check` the reply is returned with its `writeErrors`
+        instead of raising the first one.
+        """
+        command = SON(command)
+        command['$db'] = db.split('.', 1)[0]
+        flags = 0
+        if safe:
+            write_concern = self._write_concern()
+            if 'journal' in write_concern:
+                write_concern['j'] = write_concern.pop('journal')
+            if write_concern:
+                command['writeConcern'] = write_concern
+        else:
+            command['writeConcern'] = {'w': 0}
+            flags |= MSG_MORE_TO_COME
+
+        msg = Msg(flags=flags, body=command, sequences={identifier: documents})
+        reply = yield self.send_MSG(msg)
+        if not safe:
+            defer.returnValue(None)
+
+        document = reply.body.decode()
+        if not check:
+            defer.returnValue(document)
+
+        for error in document.get('writeErrors', ()):
+            code = error.get('code')
+            if code == 11000:
+                raise errors.DuplicateKeyError(error.get('errmsg'), code=code)
+            raise errors.OperationFailure(error.get('errmsg'), code=code)
+
+        error = document.get('writeConcernError')
+        if error:
+            raise errors.OperationFailure(error.get('errmsg'), code=error.get('code'))
+
+        defer.returnValue(document)
+
 class MongoDecoder:
+    """
+    Incremental decoder of the mongo wire protocol.
+
+    Incoming data is appended to a growable `bytearray` and consumed by
+    moving a read offset, so a large message arriving in many segments is
+    not re-copied on every `feed()`. Consumed bytes are only dropped
+    (compacted) once they make up most of the buffer.
+    """
     dataBuffer = None
 
+    # do not compact the receive buffer for less than this many consumed bytes
+    compact_threshold = 64 * 1024
+
     def __init__(self):
-        self.dataBuffer = ''
+        self.dataBuffer = bytearray()
+        self._offset = 0
+
+    def __len__(self):
+        return len(self.dataBuffer) - self._offset
 
     def feed(self, data):
-        self.dataBuffer += data
+        if self._offset:
+            if self._offset == len(self.dataBuffer):
+                del self.dataBuffer[:]
+                self._offset = 0
+            elif self._offset >= self.compact_threshold and \
+                    self._offset * 2 >= len(self.dataBuffer):
+                del self.dataBuffer[:self._offset]
+                self._offset = 0
+        self.dataBuffer.extend(data)
 
     def next(self):
-        if len(self.dataBuffer) < 16:
+        if len(self) < 16:
             return None
-        msglen, = struct.unpack('<i', self.dataBuffer[:4])
-        if len(self.dataBuffer) < msglen:
+        msglen, = struct.unpack_from('<i', self.dataBuffer, self._offset)
+        if len(self) < msglen:
             return None
         if msglen < 16:
             raise errors.ConnectionFailure()
-        msgdata = self.dataBuffer[:msglen]
-        self.dataBuffer = self.dataBuffer[msglen:]
-        return self.decode(msgdata)
+        start, self._offset = self._offset, self._offset + msglen
+        # `decode` gets a view on the receive buffer; it must not keep it
+        # around, otherwise the buffer can not be resized in `feed()`.
+        return self.decode(memoryview(self.dataBuffer)[start:start + msglen])
 
     def decode(self, msgdata):
+        if not isinstance(msgdata, memoryview):
+            msgdata = memoryview(msgdata)
         msglen = len(msgdata)
-        header = struct.unpack('<iiii', msgdata[:16])
+        header = struct.unpack_from('<iiii', msgdata)
         opcode = header[3]
         if opcode == OP_UPDATE:
-            zero, = struct.unpack('<i', msgdata[16:20])
+            zero, = struct.unpack_from('<i', msgdata, 16)
             if zero != 0:
                 raise errors.ConnectionFailure()
-            name = msgdata[20:].split('\x00', 1)[0]
-            offset = 20 + len(name) + 1
-            flags, = struct.unpack('<i', msgdata[offset:offset+4])
+            name, offset = _read_cstring(msgdata, 20)
+            flags, = struct.unpack_from('<i', msgdata, offset)
             offset += 4
-            selectorlen, = struct.unpack('<i', msgdata[offset:offset+4])
-            selector = bson.BSON(msgdata[offset:offset+selectorlen])
-            offset += selectorlen
-            updatelen, = struct.unpack('<i', msgdata[offset:offset+4])
-            update = bson.BSON(msgdata[offset:offset+updatelen])
+            selector, offset = _read_document(msgdata, offset)
+            update, offset = _read_document(msgdata, offset)
             return Update(*(header + (zero, name, flags, selector, update)))
         elif opcode == OP_INSERT:
-            flags, = struct.unpack('<i', msgdata[16:20])
-            name = msgdata[20:].split('\x00', 1)[0]
-            offset = 20 + len(name) + 1
+            flags, = struct.unpack_from('<i', msgdata, 16)
+            name, offset = _read_cstring(msgdata, 20)
             docs = []
-            while offset < len(msgdata):
-                doclen, = struct.unpack('<i', msgdata[offset:offset+4])
-                docdata = msgdata[offset:offset+doclen]
-                doc = bson.BSON(docdata)
+            while offset < msglen:
+                doc, offset = _read_document(msgdata, offset)
                 docs.append(doc)
-                offset += doclen
             return Insert(*(header + (flags, name, docs)))
         elif opcode == OP_QUERY:
-            flags, = struct.unpack('<i', msgdata[16:20])
-            name = msgdata[20:].split('\x00', 1)[0]
-            offset = 20 + len(name) + 1
-            ntoskip, ntoreturn = struct.unpack('<ii', msgdata[offset:offset+8])
+            flags, = struct.unpack_from('<i', msgdata, 16)
+            name, offset = _read_cstring(msgdata, 20)
+            ntoskip, ntoreturn = struct.unpack_from('<ii', msgdata, offset)
             offset += 8
-            querylen, = struct.unpack('<i', msgdata[offset:offset+4])
-            querydata = msgdata[offset:offset+querylen]
-            query = bson.BSON(querydata)
-            offset += querylen
+            query, offset = _read_document(msgdata, offset)
             fields = None
             if msglen > offset:
-                fieldslen, = struct.unpack('<i', msgdata[offset:offset+4])
-                fields = bson.BSON(msgdata[offset:offset+fieldslen])
+                fields, offset = _read_document(msgdata, offset)
             return Query(*(header + (flags, name, ntoskip, ntoreturn, query, fields)))
         elif opcode == OP_GETMORE:
-            zero, = struct.unpack('<i', msgdata[16:20])
+            zero, = struct.unpack_from('<i', msgdata, 16)
             if zero != 0:
                 raise errors.ConnectionFailure()
-            name = msgdata[20:].split('\x00', 1)[0]
-            offset = 20 + len(name) + 1
-            ntoreturn, cursorid = struct.unpack('<iq', msgdata[offset:offset+12])
+            name, offset = _read_cstring(msgdata, 20)
+            ntoreturn, cursorid = struct.unpack_from('<iq', msgdata, offset)
             return Getmore(*(header + (zero, name, ntoreturn, cursorid)))
         elif opcode == OP_DELETE:
-            zero, = struct.unpack('<i', msgdata[16:20])
+            zero, = struct.unpack_from('<i', msgdata, 16)
             if zero != 0:
                 raise errors.ConnectionFailure()
-            name = msgdata[20:].split('\x00', 1)[0]
-            offset = 20 + len(name) + 1
-            flags, = struct.unpack('<i', msgdata[offset:offset+4])
+            name, offset = _read_cstring(msgdata, 20)
+            flags, = struct.unpack_from('<i', msgdata, offset)
             offset += 4
-            selector = bson.BSON(msgdata[offset:])
+            selector = bson.BSON(msgdata[offset:].tobytes())
             return Delete(*(header + (zero, name, flags, selector)))
         elif opcode == OP_KILL_CURSORS:
-            cursors = struct.unpack('<ii', msgdata[16:24])
+            cursors = struct.unpack_from('<ii', msgdata, 16)
             if cursors[0] != 0:
                 raise errors.ConnectionFailure()
-            offset = 24
-            cursor_list = []
-            for i in xrange(cursors[1]):
-                cursor, = struct.unpack('<q', msgdata[offset:offset+8])
-                cursor_list.append(cursor)
-                offset += 8
+            cursor_list = list(struct.unpack_from('<%dq' % cursors[1], msgdata, 24))
             return KillCursors(*(header + cursors + (cursor_list,)))
-        elif opcode == OP_MSG:
+        elif opcode == OP_LEGACY_MSG:
             if msgdata[-1] != '\x00':
                 raise errors.ConnectionFailure()
-            return Msg(*(header + (msgdata[16:-1].decode('ascii'),)))
+            return LegacyMsg(*(header + (msgdata[16:-1].tobytes().decode('ascii'),)))
+        elif opcode == OP_MSG:
+            flags, = struct.unpack_from('<I', msgdata, 16)
+            # the crc-32c checksum is not verified
+            end = msglen - 4 if flags & MSG_CHECKSUM_PRESENT else msglen
+            body = None
+            sequences = {}
+            offset = 20
+            while offset < end:
+                kind = msgdata[offset]
+                offset += 1
+                if kind == '\x00':
+                    body, offset = _read_document(msgdata, offset)
+                elif kind == '\x01':
+                    size, = struct.unpack_from('<i', msgdata, offset)
+                    section_end = offset + size
+                    identifier, offset = _read_cstring(msgdata, offset + 4)
+                    documents = []
+                    while offset < section_end:
+                        document, offset = _read_document(msgdata, offset)
+                        documents.append(document)
+                    sequences[identifier] = documents
+                else:
+                    raise errors.ConnectionFailure()
+            if body is None:
+                raise errors.ConnectionFailure()
+            return Msg(*(header + (flags, body, sequences)))
+        elif opcode == OP_COMPRESSED:
+            original_opcode, size, compressor_id = struct.unpack_from('<iiB', msgdata, 16)
+            compressor = compression.get_compressor_by_id(compressor_id)
+            if compressor is None:
+                raise errors.ConnectionFailure()
+            data = compressor.decompress(msgdata[25:].tobytes())
+            if len(data) != size:
+                raise errors.ConnectionFailure()
+            return self.decode(struct.pack('<iiii', 16 + size, header[1], header[2],
+                                           original_opcode) + data)
         elif opcode == OP_REPLY:
-            reply = struct.unpack('<iqii', msgdata[16:36])
-            docs = []
-            offset = 36
+            reply = struct.unpack_from('<iqii', msgdata, 16)
+            # keep a single copy of the documents section, documents are
+            # sliced out of it on access.
+            data = msgdata[36:].tobytes()
+            offsets = []
+            offset = 0
             for i in xrange(reply[3]):
-                doclen, = struct.unpack('<i', msgdata[offset:offset+4])
-                if doclen > (msglen - offset):
+                doclen, = struct.unpack_from('<i', data, offset)
+                if doclen < 5 or doclen > (len(data) - offset):
                     raise errors.ConnectionFailure()
-                docdata = msgdata[offset:offset+doclen]
-                doc = bson.BSON(docdata)
-                docs.append(doc)
+                offsets.append((offset, offset + doclen))
                 offset += doclen
-            return Reply(*(header + reply + (docs,)))
+            return Reply(*(header + reply + (ReplyDocuments(data, offsets),)))
         else:
             raise errors.ConnectionFailure()
         return header
 
 
+def _read_cstring(msgdata, offset):
+    """
+    read a NUL-terminated string from `msgdata` at `offset`, returns the
+    string and the offset just after the terminator.
+    """
+    end = offset
+    try:
+        while msgdata[end] != '\x00':
+            end += 1
+    except IndexError:
+        raise errors.ConnectionFailure()
+    return msgdata[offset:end].tobytes(), end + 1
+
+
+def _read_document(msgdata, offset):
+    """
+    copy the BSON document at `offset` out of `msgdata`, returns the
+    document and the offset of the next one.
+    """
+    doclen, = struct.unpack_from('<i', msgdata, offset)
+    end = offset + doclen
+    return bson.BSON(msgdata[offset:end].tobytes()), end
@@ -0,0 +1,216 @@
+# coding: utf-8
+
+"""
+Parallel scan of a collection.
+
+`Collection.parallel_scan()` splits the `_id` range of a collection into
+segments and scans every segment with its own `Cursor`. The cursors are
+spread over the protocols returned by `getprotocols()` of the connection,
+every socket of a `_ConnectionPool` and every secondary of a replica set,
+so the segments are read at the same time.
+
+the boundaries of the segments are interpolated between the smallest and
+the largest `_id` when they are numbers, `ObjectId`s or dates, and taken
+from a `$sample` of the `_id`s otherwise. The first and the last segments
+are open, so documents inserted out of the range during the scan are
+still read; a collection whose `_id`s are of different types is scanned
+as one segment.
+"""
+
+import datetime
+
+from bson.objectid import ObjectId
+from bson.son import SON
+from twisted.internet import defer
+from twisted.python import log
+
+from . import filter as qf
+from .bulk import gather
+from .cursor import Cursor
+
+# the `_id`s of a sample taken per segment
+SAMPLE_PER_SEGMENT = 20
+
+
+def _type_of (value, ) :
+    """
+    the group of types `value` is ordered in by the server.
+    """
+    if isinstance(value, bool, ) :
+        return bool
+    if isinstance(value, (int, long, float, ), ) :
+        return float
+    if isinstance(value, basestring, ) :
+        return basestring
+    return type(value, )
+
+
+def _unique (values, lower, ) :
+    _values = list()
+    for _value in values :
+        if _value > lower and (not _values or _value > _values[-1]) :
+            _values.append(_value, )
+    return _values
+
+
+def interpolate (lower, upper, n_segments, ) :
+    """
+    the boundaries splitting `lower` to `upper` into `n_segments` even
+    segments, or `None` when the type of the values can not be split.
+    """
+    if _type_of(lower, ) is not _type_of(upper, ) :
+        return None
+
+    _steps = range(1, n_segments, )
+    if _type_of(lower, ) is float :
+        if isinstance(lower, float, ) or isinstance(upper, float, ) :
+            _values = [lower + (upper - lower) * float(i, ) / n_segments for i in _steps]
+        else :
+            _values = [lower + (upper - lower) * i // n_segments for i in _steps]
+    elif isinstance(lower, ObjectId, ) :
+        _lower, _upper = long(str(lower, ), 16, ), long(str(upper, ), 16, )
+        _values = [ObjectId('%024x' % (_lower + (_upper - _lower) * i // n_segments), ) for i in _steps]
+    elif isinstance(lower, datetime.datetime, ) :
+        _values = [lower + (upper - lower) * i // n_segments for i in _steps]
+    else :
+        return None
+
+    return _unique(_values, lower, )
+
+
+def quantiles (values, lower, n_segments, ) :
+    """
+    the boundaries splitting a sample of `_id`s into `n_segments`.
+    """
+    _values = sorted([_value for _value in values if _type_of(_value, ) is _type_of(lower, )], )
+    if not _values :
+        return list()
+
+    return _unique([_values[len(_values, ) * i // n_segments] for i in range(1, n_segments, )], lower, )
+
+
+@defer.inlineCallbacks
+def boundaries (collection, n_segments, ) :
+    """
+    fires with the `_id`s splitting `collection` into at most `n_segments`.
+    """
+    if n_segments < 2 :
+        defer.returnValue(list(), )
+
+    _lower = yield collection.find_one(fields=['_id', ], filter=qf.sort(qf.ASCENDING('_id', ), ), cache=False, )
+    _upper = yield collection.find_one(fields=['_id', ], filter=qf.sort(qf.DESCENDING('_id', ), ), cache=False, )
+    if not _lower or not _upper :
+        defer.returnValue(list(), )
+
+    _lower, _upper = _lower['_id'], _upper['_id']
+    if _type_of(_lower, ) is not _type_of(_upper, ) :
+        # ranges only match the `_id`s of one type
+        defer.returnValue(list(), )
+
+    _values = interpolate(_lower, _upper, n_segments, )
+    if _values is not None :
+        defer.returnValue(_values, )
+
+    try :
+        _sample = yield collection.aggregate([
+                {'$sample': {'size': n_segments * SAMPLE_PER_SEGMENT, }, },
+                {'$project': {'_id': 1, }, },
+            ]).to_list()
+    except Exception, e :
+        log.msg('[debug] failed to sample `%s`, scanning it in one segment, %r.' % (collection, e, ), )
+        defer.returnValue(list(), )
+
+    defer.returnValue(quantiles([_document['_id'] for _document in _sample], _lower, n_segments, ), )
+
+
+def segment_specs (spec, boundaries, ) :
+    """
+    the query of every segment between `boundaries`.
+    """
+    if not boundaries :
+        return [spec, ]
+
+    _specs = list()
+    _bounds = [None, ] + list(boundaries, ) + [None, ]
+    for _lower, _upper in zip(_bounds[:-1], _bounds[1:], ) :
+        _range = SON()
+        if _lower is not None :
+            _range['$gte'] = _lower
+        if _upper is not None :
+            _range['$lt'] = _upper
+
+        _condition = {'_id': _range, }
+        _specs.append({'$and': [spec, _condition, ], } if spec else _condition, )
+
+    return _specs
+
+
+@defer.inlineCallbacks
+def getprotocols (connection, _type='read', ) :
+    if hasattr(connection, 'getprotocols', ) :
+        _protocols = yield defer.maybeDeferred(connection.getprotocols, _type, )
+    else :
+        _protocols = [(yield defer.maybeDeferred(connection.getprotocol, _type, )), ]
+
+    defer.returnValue(_protocols, )
+
+
+class ParallelScan (object, ) :
+    """
+    The cursors of the segments of a collection.
+
+    `cursors` are the streams of every segment; `each()` and `to_list()`
+    read them all at the same time and merge them, in no particular order.
+    """
+
+    def __init__ (self, cursors, ) :
+        self.cursors = cursors
+        self._failed = False
+
+    def __len__ (self, ) :
+        return len(self.cursors, )
+
+    def close (self, ) :
+        for _cursor in self.cursors :
+            _cursor.close()
+
+    @defer.inlineCallbacks
+    def each (self, callback, ) :
+        """
+        call `callback` with every document of every segment; when it
+        returns a deferred, the next document of that segment waits for it.
+        """
+        def _callback (document, ) :
+            # the other segments stop once one failed
+            if not self._failed :
+                return callback(document, )
+
+        try :
+            yield gather([_cursor.each(_callback, ) for _cursor in self.cursors], )
+        except :
+            self._failed = True
+            self.close()
+            raise
+
+    @defer.inlineCallbacks
+    def to_list (self, ) :
+        _documents = list()
+        yield self.each(_documents.append, )
+        defer.returnValue(_documents, )
+
+
+@defer.inlineCallbacks
+def parallel_scan (collection, n_segments, spec=None, fields=None, batch_size=0, **kwargs) :
+    _boundaries = yield boundaries(collection, n_segments, )
+    _protocols = yield getprotocols(collection._database.connection, )
+
+    _cursors = list()
+    for i, _spec in enumerate(segment_specs(spec, _boundaries, ), ) :
+        _spec, _fields = collection._query_spec(_spec, 0, 0, fields, None, )
+        _cursors.append(Cursor(collection, _spec, fields=_fields, batch_size=batch_size,
+                               as_class=kwargs.get('as_class', dict, ),
+                               prefetch=kwargs.get('prefetch', False, ),
+                               raw=kwargs.get('raw', False, ),
+                               proto=_protocols[i % len(_protocols, )], ), )
+
+    defer.returnValue(ParallelScan(_cursors, ), )
@@ -0,0 +1,77 @@
+# coding: utf-8
+
+"""
+Strategies choosing the protocol a request is sent on.
+
+a strategy is set as `selector` of a `_ConnectionPool`, which chooses
+among the protocols of every connection of the pool, or of a
+`ReplicaSetConnection`, which chooses among its secondaries; `select()`
+returns one of a non-empty list of protocols.
+
+`RoundRobin` and `Random` ignore the load of the protocols.
+`LeastInflight` takes the one with the fewest requests waiting for a
+reply, `PowerOfTwoChoices` the less loaded of two taken at random, which
+is nearly as good and does not send every new request to the same idle
+protocol, and `LatencyWeighted` chooses at random, preferring protocols
+which have answered fast lately and have few requests in flight.
+"""
+
+import random
+
+
+class RoundRobin (object, ) :
+    def __init__ (self, ) :
+        self._index = 0
+
+    def select (self, protocols, ) :
+        self._index %= len(protocols, )
+        _proto = protocols[self._index]
+        self._index += 1
+        return _proto
+
+
+class Random (object, ) :
+    def select (self, protocols, ) :
+        return random.choice(protocols, )
+
+
+class LeastInflight (object, ) :
+    def select (self, protocols, ) :
+        _least = min([_proto.inflight() for _proto in protocols], )
+        return random.choice([_proto for _proto in protocols if _proto.inflight() == _least], )
+
+
+class PowerOfTwoChoices (object, ) :
+    def select (self, protocols, ) :
+        if len(protocols, ) < 2 :
+            return protocols[0]
+
+        _a, _b = random.sample(protocols, 2, )
+        return _a if _a.inflight() <= _b.inflight() else _b
+
+
+class LatencyWeighted (object, ) :
+    """
+    weighs a protocol by the inverse of the time a new request would wait,
+    its `latency` times its requests in flight plus one. Protocols without
+    a latency yet count as the fastest one, so they are tried.
+    """
+    # seconds, so an idle local server does not take every request
+    min_latency = 0.001
+
+    def weight (self, proto, default, ) :
+        _latency = proto.latency if proto.latency is not None else default
+        return 1.0 / (max(_latency, self.min_latency, ) * (proto.inflight() + 1))
+
+    def select (self, protocols, ) :
+        _latencies = [_proto.latency for _proto in protocols if _proto.latency is not None]
+        _default = min(_latencies, ) if _latencies else self.min_latency
+
+        _weights = [self.weight(_proto, _default, ) for _proto in protocols]
+        _r = random.random() * sum(_weights, )
+        for _proto, _weight in zip(protocols, _weights, ) :
+            _r -= _weight
+            if _r < 0 :
+                return _proto
+
+        return protocols[-1]
@@ -0,0 +1,240 @@
+# coding: utf-8
+
+"""Test bulk writes against a fake connection.
+
+These tests do not need a running mongodb server.
+"""
+
+import bson
+from bson.son import SON
+from pymongo import errors
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from txmongo2 import bulk
+from txmongo2.bulk import DeleteMany, DeleteOne, InsertOne, UpdateMany, UpdateOne
+from txmongo2.database import Database
+from txmongo2.protocol import Delete, Insert, MongoDecoder, Msg, Query, Update, INSERT_CONTINUE_ON_ERROR
+
+from tests.test_cursor import FakeConnection
+from tests.test_protocol import encode_msg, encode_reply
+
+
+def sent_messages(proto):
+    decoder = MongoDecoder()
+    decoder.feed(proto.transport.value())
+    proto.transport.clear()
+    return list(iter(decoder.next, None))
+
+
+class TestSplit(unittest.TestCase):
+
+    def test_batch_size(self):
+        operations = [InsertOne({'_id': i}) for i in range(5)]
+        batches = bulk.split(operations, True, 2, 48000000, 16 * 1024 * 1024)
+        self.assertEqual([[index for index, o, e in batch] for kind, batch in batches],
+                         [[0, 1], [2, 3], [4]])
+
+    def test_message_size(self):
+        operations = [InsertOne({'_id': i, 's': 'x' * 6000}) for i in range(5)]
+        batches = bulk.split(operations, True, 1000, bulk.MESSAGE_OVERHEAD + 13000, 16 * 1024 * 1024)
+        self.assertEqual([len(batch) for kind, batch in batches], [2, 2, 1])
+
+    def test_ordered(self):
+        operations = [InsertOne({'_id': 1}), DeleteOne({'_id': 1}), InsertOne({'_id': 2})]
+        batches = bulk.split(operations, True, 1000, 48000000, 16 * 1024 * 1024)
+        self.assertEqual([kind for kind, batch in batches], ['insert', 'delete', 'insert'])
+
+        batches = bulk.split(operations, False, 1000, 48000000, 16 * 1024 * 1024)
+        self.assertEqual([(kind, [index for index, o, e in batch]) for kind, batch in batches],
+                         [('insert', [0, 2]), ('delete', [1])])
+
+    def test_document_too_large(self):
+        operations = [InsertOne({'s': 'x' * 100})]
+        self.assertRaises(errors.DocumentTooLarge, bulk.split, operations, True, 1000, 48000000, 100)
+
+
+class BulkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = FakeConnection()
+        self.proto = self.connection.proto
+        self.coll = Database(self.connection, 'mydb').mycol
+
+
+class TestLegacyBulk(BulkTestCase):
+
+    @defer.inlineCallbacks
+    def test_ordered(self):
+        self.proto.max_write_batch_size = 2
+        d = self.coll.bulk_write([InsertOne({'_id': i}) for i in range(3)] +
+                                 [UpdateMany({'a': 1}, {'$set': {'a': 2}}), DeleteOne({'_id': 1})])
+
+        for i in range(3):
+            insert, getlasterror = sent_messages(self.proto)
+            self.assertTrue(isinstance(insert, Insert))
+            self.assertEqual(len(insert.documents), 1)
+            self.assertTrue(isinstance(getlasterror, Query))
+            self.proto.dataReceived(encode_reply([{'ok': 1, 'err': None}], response_to=getlasterror.request_id))
+
+        update, getlasterror = sent_messages(self.proto)
+        self.assertTrue(isinstance(update, Update))
+        self.proto.dataReceived(encode_reply([{'ok': 1, 'err': None, 'n': 2, 'updatedExisting': True}],
+                                             response_to=getlasterror.request_id))
+
+        delete, getlasterror = sent_messages(self.proto)
+        self.assertTrue(isinstance(delete, Delete))
+        self.proto.dataReceived(encode_reply([{'ok': 1, 'err': None, 'n': 1}],
+                                             response_to=getlasterror.request_id))
+
+        result = yield d
+        self.assertEqual(result['nInserted'], 3)
+        self.assertEqual(result['nMatched'], 2)
+        self.assertEqual(result['nModified'], None)
+        self.assertEqual(result['nRemoved'], 1)
+
+    def test_ordered_error(self):
+        d = self.coll.bulk_write([UpdateOne({'_id': 1}, {'a': 1}), UpdateOne({'_id': 2}, {'a': 2})])
+
+        update, getlasterror = sent_messages(self.proto)
+        self.proto.dataReceived(encode_reply([{'ok': 1, 'err': 'E11000', 'code': 11000}],
+                                             response_to=getlasterror.request_id))
+
+        # the second update is not sent
+        self.assertEqual(sent_messages(self.proto), [])
+        return self.assertFailure(d, errors.BulkWriteError).addCallback(
+                lambda e: self.assertEqual([i['index'] for i in e.details['writeErrors']], [0]))
+
+    def test_ordered_insert_error(self):
+        d = self.coll.bulk_write([InsertOne({'_id': i}) for i in range(4)])
+
+        for i in range(2):
+            insert, getlasterror = sent_messages(self.proto)
+            self.proto.dataReceived(encode_reply([{'ok': 1, 'err': None}], response_to=getlasterror.request_id))
+        insert, getlasterror = sent_messages(self.proto)
+        self.assertEqual(insert.documents, [bson.BSON.encode({'_id': 2})])
+        self.proto.dataReceived(encode_reply([{'ok': 1, 'err': 'E11000', 'code': 11000}],
+                                             response_to=getlasterror.request_id))
+
+        # the last document is not sent
+        self.assertEqual(sent_messages(self.proto), [])
+
+        def check(e):
+            self.assertEqual(e.details['nInserted'], 2)
+            self.assertEqual([(i['index'], i['op']) for i in e.details['writeErrors']], [(2, {'_id': 2})])
+        return self.assertFailure(d, errors.BulkWriteError).addCallback(check)
+
+    def test_unsafe_insert(self):
+        d = self.coll.bulk_write([InsertOne({'_id': i}) for i in range(3)], ordered=False, safe=False)
+        insert, = sent_messages(self.proto)
+        self.assertEqual(len(insert.documents), 3)
+        self.assertTrue(insert.flags & INSERT_CONTINUE_ON_ERROR)
+        return d
+
+    @defer.inlineCallbacks
+    def test_unordered(self):
+        d = self.coll.bulk_write([DeleteMany({'a': 1}), DeleteMany({'a': 2}), DeleteMany({'a': 3})],
+                                 ordered=False)
+
+        # every delete is sent with its getlasterror at once
+        messages = sent_messages(self.proto)
+        self.assertEqual([type(m) for m in messages], [Delete, Query] * 3)
+        for i, getlasterror in enumerate(messages[1::2]):
+            document = {'ok': 1, 'err': None, 'n': 1}
+            if i == 1:
+                document = {'ok': 1, 'err': 'failed', 'code': 2}
+            self.proto.dataReceived(encode_reply([document], response_to=getlasterror.request_id))
+
+        try:
+            yield d
+        except errors.BulkWriteError, e:
+            self.assertEqual(e.details['nRemoved'], 2)
+            self.assertEqual(e.details['writeErrors'][0]['index'], 1)
+            self.assertEqual(e.details['writeErrors'][0]['errmsg'], 'failed')
+        else:
+            self.fail('BulkWriteError is not raised')
+
+    @defer.inlineCallbacks
+    def test_insert_split(self):
+        self.proto.max_write_batch_size = 2
+        d = self.coll.insert([{'_id': i} for i in range(3)])
+
+        insert, getlasterror = sent_messages(self.proto)
+        self.assertEqual(len(insert.documents), 2)
+        self.proto.dataReceived(encode_reply([{'ok': 1, 'err': None}], response_to=getlasterror.request_id))
+        insert, getlasterror = sent_messages(self.proto)
+        self.assertEqual(len(insert.documents), 1)
+        self.proto.dataReceived(encode_reply([{'ok': 1, 'err': None}], response_to=getlasterror.request_id))
+
+        self.assertEqual((yield d), [0, 1, 2])
+
+
+    def test_insert_encoded(self):
+        document = bson.BSON.encode({'_id': 1, 'a': 1})
+        d = self.coll.insert([document, {'_id': 2}], safe=False)
+        insert = sent_messages(self.proto)[0]
+        self.assertEqual(insert.documents[0], document)
+        d.addCallback(self.assertEqual, [None, 2])
+        return d
+
+    @defer.inlineCallbacks
+    def test_insert_group_commit(self):
+        self.proto.clock = task.Clock()
+        d1 = self.coll.insert({'_id': 1}, group_commit=True)
+        d2 = self.coll.insert([{'_id': 2}, {'_id': 3}], group_commit=True)
+        self.proto.clock.advance(0)
+
+        insert, getlasterror = sent_messages(self.proto)
+        self.assertEqual(len(insert.documents), 3)
+        self.proto.dataReceived(encode_reply([{'ok': 1, 'err': None}], response_to=getlasterror.request_id))
+        self.assertEqual((yield d1), 1)
+        self.assertEqual((yield d2), [2, 3])
+
+
+class TestCommandBulk(BulkTestCase):
+
+    def setUp(self):
+        BulkTestCase.setUp(self)
+        self.proto.set_server_info({'maxWireVersion': 6, 'maxWriteBatchSize': 2})
+
+    @defer.inlineCallbacks
+    def test_unordered(self):
+        d = self.coll.bulk_write([InsertOne({'_id': i}) for i in range(3)] +
+                                 [UpdateOne({'_id': 5}, {'a': 1}, upsert=True)], ordered=False)
+
+        messages = sent_messages(self.proto)
+        self.assertEqual([m.body.decode(as_class=SON).keys()[0] for m in messages], ['insert', 'insert', 'update'])
+        self.assertEqual([len(m.sequences.values()[0]) for m in messages], [2, 1, 1])
+
+        self.proto.dataReceived(encode_msg({'ok': 1, 'n': 2}, response_to=messages[0].request_id))
+        self.proto.dataReceived(encode_msg(
+                {'ok': 1, 'n': 0, 'writeErrors': [{'index': 0, 'code': 11000, 'errmsg': 'E11000'}]},
+                response_to=messages[1].request_id))
+        self.proto.dataReceived(encode_msg(
+                {'ok': 1, 'n': 1, 'nModified': 0, 'upserted': [{'index': 0, '_id': 5}]},
+                response_to=messages[2].request_id))
+
+        try:
+            yield d
+        except errors.BulkWriteError, e:
+            result = e.details
+        else:
+            self.fail('BulkWriteError is not raised')
+
+        self.assertEqual(result['nInserted'], 2)
+        self.assertEqual(result['nUpserted'], 1)
+        self.assertEqual(result['upserted'], [{'index': 3, '_id': 5}])
+        self.assertEqual(result['writeErrors'][0]['index'], 2)
+        self.assertEqual(result['writeErrors'][0]['op'], {'_id': 2})
+
+    @defer.inlineCallbacks
+    def test_insert_many(self):
+        d = self.coll.insert_many([{'a': 1}])
+        msg, = sent_messages(self.proto)
+        self.assertTrue(isinstance(msg, Msg))
+        self.assertEqual(msg.body.decode()['ordered'], True)
+        self.proto.dataReceived(encode_msg({'ok': 1, 'n': 1}, response_to=msg.request_id))
+
+        ids = yield d
+        self.assertEqual(len(ids), 1)
+        self.assertEqual(bson.BSON(msg.sequences['documents'][0]).decode()['_id'], ids[0])
@@ -0,0 +1,378 @@
+# coding: utf-8
+
+"""Test the query cache against a fake connection.
+
+These tests do not need a running mongodb server.
+"""
+
+from pymongo import errors
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.trial import unittest
+
+from txmongo2 import filter as qf
+from txmongo2.cache import MetadataCache, QueryCache, SingleFlight
+
+from tests.test_bulk import sent_messages
+from tests.test_codec import reply_documents
+from tests.test_cursor import CursorTestCase
+from tests.test_protocol import encode_reply
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = QueryCache(max_bytes=1000)
+        self.cache.clock = self.clock = task.Clock()
+        self.cache.set_ttl('mydb', 10)
+
+    def put(self, namespace, spec, n_documents=1):
+        key = self.cache.key(namespace, spec, None, 0, 0)
+        batches = [reply_documents([{'s': 'x' * 80}] * n_documents)]
+        self.cache.put(key, batches, self.cache.generation(namespace))
+        return key
+
+    def test_ttl(self):
+        self.assertEqual(self.cache.get_ttl('mydb.mycol'), 10)
+        self.assertEqual(self.cache.get_ttl('other.mycol'), None)
+        self.cache.set_ttl('mydb.mycol', 1)
+        self.assertEqual(self.cache.get_ttl('mydb.mycol'), 1)
+
+        key = self.put('mydb.mycol', {'a': 1})
+        self.assertNotEqual(self.cache.get(key), None)
+        self.clock.advance(1)
+        self.assertEqual(self.cache.get(key), None)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+        self.assertEqual(self.cache.size, 0)
+
+    def test_lru(self):
+        keys = [self.put('mydb.mycol', {'a': i}, n_documents=3) for i in range(3)]
+        self.assertNotEqual(self.cache.get(keys[0]), None)
+
+        # 4 results of 3 documents do not fit in 1000 bytes
+        self.put('mydb.mycol', {'a': 3}, n_documents=3)
+        self.assertEqual(self.cache.get(keys[1]), None)
+        self.assertNotEqual(self.cache.get(keys[0]), None)
+        self.assertTrue(self.cache.size <= 1000)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_too_large(self):
+        key = self.put('mydb.mycol', {'a': 1}, n_documents=20)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.get(key), None)
+
+    def test_invalidate(self):
+        key = self.put('mydb.mycol', {'a': 1})
+        other = self.put('mydb.other', {'a': 1})
+        generation = self.cache.generation('mydb.mycol')
+
+        self.cache.invalidate('mydb.mycol')
+        self.assertEqual(self.cache.get(key), None)
+        self.assertNotEqual(self.cache.get(other), None)
+
+        # a result read before the write is not kept
+        self.cache.put(key, [reply_documents([{'a': 1}])], generation)
+        self.assertEqual(self.cache.get(key), None)
+
+
+class TestCollection(CursorTestCase):
+
+    def setUp(self):
+        CursorTestCase.setUp(self)
+        self.connection.query_cache = QueryCache()
+        self.coll.set_cache_ttl(60)
+
+    @defer.inlineCallbacks
+    def test_find(self):
+        d = self.coll.find({'a': 1}, filter=qf.sort(qf.ASCENDING('a')))
+        self.reply([{'a': 1}])
+        documents = yield d
+        documents[0]['b'] = 2
+
+        # the same query is answered from the cache, with new documents
+        documents = yield self.coll.find({'a': 1}, filter=qf.sort(qf.ASCENDING('a')))
+        self.assertEqual(documents, [{'a': 1}])
+        self.assertEqual(self.proto.transport.value(), '')
+
+        # not the one with another order
+        d = self.coll.find({'a': 1}, filter=qf.sort(qf.DESCENDING('a')))
+        self.reply([{'a': 1}])
+        yield d
+
+        stats = self.connection.query_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    @defer.inlineCallbacks
+    def test_find_without_cache(self):
+        d = self.coll.find_one({'a': 1})
+        self.reply([{'a': 1}])
+        yield d
+
+        d = self.coll.find_one({'a': 1}, cache=False)
+        self.reply([{'a': 2}])
+        self.assertEqual((yield d), {'a': 2})
+
+    @defer.inlineCallbacks
+    def test_write_invalidates(self):
+        d = self.coll.find({'a': 1})
+        self.reply([{'a': 1}])
+        yield d
+
+        d = self.coll.remove({'a': 1}, safe=False)
+        yield d
+        self.proto.transport.clear()
+
+        d = self.coll.find({'a': 1})
+        self.reply([])
+        self.assertEqual((yield d), [])
+
+    @defer.inlineCallbacks
+    def test_drop_invalidates(self):
+        d = self.coll.find({'a': 1})
+        self.reply([{'a': 1}])
+        yield d
+
+        d = self.coll._database.drop_collection('mycol')
+        self.reply([{'ok': 1}])
+        yield d
+        self.proto.transport.clear()
+
+        d = self.coll.find({'a': 1})
+        self.reply([])
+        self.assertEqual((yield d), [])
+
+    @defer.inlineCallbacks
+    def test_rename_invalidates(self):
+        other = self.coll._database.other
+        for collection in (self.coll, other):
+            d = collection.find({'a': 1})
+            self.reply([{'a': 1}])
+            yield d
+
+        d = self.coll.rename('other')
+        self.reply([{'ok': 1}])
+        yield d
+        self.proto.transport.clear()
+
+        for collection in (self.coll, other):
+            d = collection.find({'a': 1})
+            self.reply([])
+            self.assertEqual((yield d), [])
+
+    @defer.inlineCallbacks
+    def test_not_cached(self):
+        self.coll.set_cache_ttl(None)
+        d = self.coll.find({'a': 1})
+        self.reply([{'a': 1}])
+        yield d
+        self.assertEqual(len(self.connection.query_cache), 0)
+
+    def test_no_cache(self):
+        self.connection.query_cache = None
+        self.assertRaises(errors.InvalidOperation, self.coll.set_cache_ttl, 1)
+
+
+class TestSingleFlight(CursorTestCase):
+
+    def setUp(self):
+        CursorTestCase.setUp(self)
+        self.connection.single_flight = SingleFlight()
+        self.coll.set_single_flight()
+
+    @defer.inlineCallbacks
+    def test_coalesce(self):
+        dl = [self.coll.find_one({'a': 1}) for i in range(3)]
+        other = self.coll.find_one({'a': 2})
+
+        messages = sent_messages(self.proto)
+        self.assertEqual(len(messages), 2)
+        self.proto.dataReceived(encode_reply([{'a': 1}], response_to=messages[0].request_id))
+        self.proto.dataReceived(encode_reply([{'a': 2}], response_to=messages[1].request_id))
+
+        documents = yield defer.gatherResults(dl)
+        self.assertEqual(documents, [{'a': 1}] * 3)
+        # every caller has its own copy
+        documents[0]['b'] = 1
+        self.assertEqual(documents[1], {'a': 1})
+        self.assertEqual((yield other), {'a': 2})
+
+        self.assertEqual(self.connection.single_flight.stats(),
+                         {'requests': 2, 'coalesced': 2, 'inflight': 0})
+
+    def test_failure(self):
+        dl = [self.coll.find({'a': 1}) for i in range(2)]
+        self.proto.connectionLost(failure.Failure(error.ConnectionDone()))
+        return defer.gatherResults([self.assertFailure(d, error.ConnectionDone) for d in dl])
+
+    def count_requests(self):
+        dl = [self.coll.find_one({'a': 1}) for i in range(2)]
+        n_messages = len(sent_messages(self.proto))
+        self.proto.connectionLost(failure.Failure(error.ConnectionDone()))
+        for d in dl:
+            d.addErrback(lambda f: f.trap(error.ConnectionDone))
+        return n_messages
+
+    def test_disabled(self):
+        self.coll.set_single_flight(False)
+        self.assertEqual(self.count_requests(), 2)
+
+    def test_database(self):
+        self.coll.set_single_flight(None)
+        self.coll._database.set_single_flight()
+        self.assertEqual(self.count_requests(), 1)
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = MetadataCache(ttl=10)
+        self.cache.clock = self.clock = task.Clock()
+
+    def put(self, namespace, kind, value):
+        self.cache.put(namespace, kind, value, self.cache.generation(namespace))
+
+    def test_ttl(self):
+        self.put('mydb.mycol', 'options', {'capped': True})
+        self.cache.ensured('mydb.mycol', 'a_1')
+        self.assertEqual(self.cache.get('mydb.mycol', 'options'), {'capped': True})
+        self.assertTrue(self.cache.is_ensured('mydb.mycol', 'a_1'))
+
+        self.clock.advance(10)
+        self.assertEqual(self.cache.get('mydb.mycol', 'options'), None)
+        self.assertFalse(self.cache.is_ensured('mydb.mycol', 'a_1'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_copy(self):
+        self.put('mydb.mycol', 'options', {'capped': True})
+        self.cache.get('mydb.mycol', 'options')['capped'] = False
+        self.assertEqual(self.cache.get('mydb.mycol', 'options'), {'capped': True})
+
+    def test_invalidate(self):
+        self.put('mydb', 'collection_names', ['mycol', 'other'])
+        self.put('mydb.mycol', 'options', {})
+        self.put('mydb.other', 'options', {})
+        self.cache.ensured('mydb.mycol', 'a_1')
+
+        self.cache.invalidate('mydb.mycol')
+        self.assertEqual(self.cache.get('mydb', 'collection_names'), None)
+        self.assertEqual(self.cache.get('mydb.mycol', 'options'), None)
+        self.assertFalse(self.cache.is_ensured('mydb.mycol', 'a_1'))
+        self.assertEqual(self.cache.get('mydb.other', 'options'), {})
+
+        self.cache.invalidate('mydb')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidate_indexes(self):
+        self.put('mydb.mycol', 'index_information', {'a_1': [('a', 1)]})
+        self.put('mydb.mycol', 'options', {})
+        self.cache.ensured('mydb.mycol', 'a_1')
+        self.cache.ensured('mydb.mycol', 'b_1')
+
+        self.cache.invalidate_indexes('mydb.mycol', 'a_1')
+        self.assertEqual(self.cache.get('mydb.mycol', 'index_information'), None)
+        self.assertFalse(self.cache.is_ensured('mydb.mycol', 'a_1'))
+        self.assertTrue(self.cache.is_ensured('mydb.mycol', 'b_1'))
+
+        self.cache.invalidate_indexes('mydb.mycol')
+        self.assertFalse(self.cache.is_ensured('mydb.mycol', 'b_1'))
+        self.assertEqual(self.cache.get('mydb.mycol', 'options'), {})
+
+    def test_stale_generation(self):
+        generation = self.cache.generation('mydb.mycol')
+        self.cache.invalidate('mydb')
+        # read before the database was dropped
+        self.cache.put('mydb.mycol', 'options', {}, generation)
+        self.assertEqual(self.cache.get('mydb.mycol', 'options'), None)
+
+
+class TestMetadataCollection(CursorTestCase):
+
+    def setUp(self):
+        CursorTestCase.setUp(self)
+        self.connection.metadata_cache = MetadataCache()
+        self.db = self.coll._database
+
+    @defer.inlineCallbacks
+    def ensure_index(self):
+        d = self.coll.ensure_index(qf.sort(qf.ASCENDING('a')))
+        if not d.called:
+            self.reply([{'ok': 1, 'n': 1, 'err': None}])
+        name = yield d
+        defer.returnValue(name)
+
+    @defer.inlineCallbacks
+    def test_ensure_index(self):
+        self.assertEqual((yield self.ensure_index()), u'a_1')
+        # the second one is not sent
+        self.assertEqual((yield self.ensure_index()), u'a_1')
+        self.assertEqual(self.proto.transport.value(), '')
+
+        d = self.coll.drop_index(qf.sort(qf.ASCENDING('a')))
+        self.reply([{'ok': 1}])
+        yield d
+
+        d = self.coll.ensure_index(qf.sort(qf.ASCENDING('a')))
+        self.assertFalse(d.called)
+        self.reply([{'ok': 1, 'n': 1, 'err': None}])
+        yield d
+
+    @defer.inlineCallbacks
+    def test_index_information(self):
+        d = self.coll.index_information()
+        self.reply([{'name': 'a_1', 'key': {'a': 1}, 'ns': 'mydb.mycol'}])
+        self.assertEqual((yield d), {'a_1': [('a', 1)]})
+
+        self.assertEqual((yield self.coll.index_information()), {'a_1': [('a', 1)]})
+        self.assertEqual(self.proto.transport.value(), '')
+
+        # a new index is seen at once
+        yield self.ensure_index()
+        d = self.coll.index_information()
+        self.assertFalse(d.called)
+        self.reply([])
+        yield d
+
+    @defer.inlineCallbacks
+    def test_collection_names(self):
+        d = self.db.collection_names()
+        self.reply([{'name': 'mydb.mycol'}, {'name': 'mydb.system.indexes'}])
+        self.assertEqual((yield d), ['mycol', 'system.indexes'])
+
+        names = yield self.db.collection_names()
+        self.assertEqual(names, ['mycol', 'system.indexes'])
+        self.assertEqual(self.proto.transport.value(), '')
+
+        d = self.coll.drop()
+        self.reply([{'ok': 1}])
+        yield d
+
+        d = self.db.collection_names()
+        self.assertFalse(d.called)
+        self.reply([{'name': 'mydb.system.indexes'}])
+        self.assertEqual((yield d), ['system.indexes'])
+
+    @defer.inlineCallbacks
+    def test_options(self):
+        d = self.coll.options()
+        self.reply([{'name': 'mydb.mycol', 'options': {'create': 'mycol', 'capped': True}}])
+        self.assertEqual((yield d), {'capped': True})
+        self.assertEqual((yield self.coll.options()), {'capped': True})
+
+        d = self.coll.rename('renamed')
+        self.reply([{'ok': 1}])
+        yield d
+
+        d = self.coll.options()
+        self.assertFalse(d.called)
+        self.reply([])
+        self.assertEqual((yield d), {})
+
+    @defer.inlineCallbacks
+    def test_no_cache(self):
+        self.connection.metadata_cache = None
+        yield self.ensure_index()
+        d = self.coll.ensure_index(qf.sort(qf.ASCENDING('a')))
+        self.assertFalse(d.called)
+        self.reply([{'ok': 1, 'n': 1, 'err': None}])
+        yield d
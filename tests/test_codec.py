@@ -0,0 +1,169 @@
+# coding: utf-8
+
+"""Test the codec executors, and how long they block the reactor.
+
+These tests do not need a running mongodb server.
+"""
+
+import time
+
+import bson
+from bson.son import SON
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+from twisted.trial import unittest
+
+from txmongo2 import codec
+from txmongo2.protocol import MongoDecoder
+
+from tests.test_cursor import CursorTestCase
+from tests.test_protocol import encode_reply, last_message
+
+
+def reply_documents(documents):
+    decoder = MongoDecoder()
+    decoder.feed(encode_reply(documents))
+    return decoder.next().documents
+
+
+class LagMeter(object):
+    """
+    the longest delay of a looping call, that is how long the reactor
+    was blocked at most.
+    """
+
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.max_lag = 0
+
+    def start(self):
+        self._last = time.time()
+        self._call = task.LoopingCall(self._tick)
+        self._call.start(self.interval, now=False)
+
+    def _tick(self):
+        now = time.time()
+        self.max_lag = max(self.max_lag, now - self._last - self.interval)
+        self._last = now
+
+    def stop(self):
+        self._call.stop()
+
+
+class TurnCounter(object):
+    """
+    the iterations of the reactor, each one running a call scheduled in
+    the one before.
+    """
+
+    def __init__(self):
+        self.turns = 0
+
+    def start(self):
+        self._call = reactor.callLater(0, self._tick)
+
+    def _tick(self):
+        self.turns += 1
+        self._call = reactor.callLater(0, self._tick)
+
+    def stop(self):
+        self._call.cancel()
+
+
+def sleep(seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+
+class TestExecutors(unittest.TestCase):
+
+    def setUp(self):
+        self.documents = [{'_id': i, 'n': i, 's': 'x' * 100} for i in range(3000)]
+
+    @defer.inlineCallbacks
+    def check(self, executor):
+        encoded = yield executor.encode(self.documents)
+        self.assertEqual(encoded, [bson.BSON.encode(d) for d in self.documents])
+
+        decoded = yield executor.decode(reply_documents(self.documents), as_class=SON)
+        self.assertEqual(decoded, self.documents)
+        self.assertTrue(isinstance(decoded[0], SON))
+
+    def test_inline(self):
+        return self.check(codec.InlineExecutor())
+
+    def test_thread(self):
+        return self.check(codec.ThreadExecutor(chunk_size=700))
+
+    def test_process(self):
+        executor = codec.ProcessExecutor(processes=1, chunk_size=700)
+        self.addCleanup(executor.close)
+        return self.check(executor)
+
+    def test_encoded(self):
+        document = bson.BSON.encode({'a': 1})
+        self.assertTrue(codec.encode(document) is document)
+
+    def test_threshold(self):
+        executor = codec.ThreadExecutor(threshold=len(self.documents) + 1)
+        d = executor.decode(reply_documents(self.documents))
+        # decoded inline
+        self.assertTrue(d.called)
+        return d
+
+
+class TestReactorLag(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def measure(self, executor, documents):
+        meter = LagMeter()
+        meter.start()
+        yield sleep(0.02)
+        counter = TurnCounter()
+        counter.start()
+        start = time.time()
+        decoded = yield executor.decode(documents)
+        elapsed = time.time() - start
+        counter.stop()
+        yield sleep(0.02)
+        meter.stop()
+
+        self.assertEqual(len(decoded), len(documents))
+        log.msg('%s: %d documents decoded in %.3fs, reactor lag %.3fs, %d reactor turns' % (
+                executor.__class__.__name__, len(documents), elapsed, meter.max_lag, counter.turns))
+        defer.returnValue(counter.turns)
+
+    @defer.inlineCallbacks
+    def test_lag(self):
+        documents = reply_documents([{'_id': i, 'n': i, 's': 'x' * 100} for i in range(200000)])
+
+        inline = yield self.measure(codec.InlineExecutor(), documents)
+        self.assertEqual(inline, 0)
+
+        # the wall clock lag depends on the load of the machine, so only the
+        # reactor getting control back between the chunks is checked
+        threaded = yield self.measure(codec.ThreadExecutor(chunk_size=500), documents)
+        chunks = len(documents) / 500
+        self.assertTrue(threaded >= chunks / 2, '%d reactor turns for %d chunks' % (threaded, chunks))
+
+
+class TestCollection(CursorTestCase):
+
+    def setUp(self):
+        CursorTestCase.setUp(self)
+        codec.set_executor(codec.ThreadExecutor(threshold=2))
+        self.addCleanup(codec.set_executor, None)
+
+    @defer.inlineCallbacks
+    def test_find(self):
+        d = self.coll.find()
+        self.reply([{'a': i} for i in range(3)])
+        documents = yield d
+        self.assertEqual(documents, [{'a': i} for i in range(3)])
+
+    @defer.inlineCallbacks
+    def test_insert(self):
+        d = self.coll.insert([{'_id': i} for i in range(3)], safe=False)
+        self.assertFalse(d.called)
+        ids = yield d
+        self.assertEqual(ids, [0, 1, 2])
+        self.assertEqual(len(last_message(self.proto).documents), 3)
@@ -0,0 +1,119 @@
+# coding: utf-8
+
+"""Test the write-behind counters against a fake connection.
+
+These tests do not need a running mongodb server.
+"""
+
+from bson.son import SON
+from twisted.internet import defer, reactor
+
+from txmongo2.counter import Counter
+
+from tests.test_bulk import sent_messages
+from tests.test_cursor import CursorTestCase
+from tests.test_protocol import encode_msg
+
+
+class TestCounter(CursorTestCase):
+
+    def setUp(self):
+        CursorTestCase.setUp(self)
+        self.proto.set_server_info({'maxWireVersion': 6})
+        self.patch(Counter, 'clock', self.clock)
+        self.counter = self.coll.counter(interval=5, max_keys=3)
+        self.addCleanup(self.counter.stop)
+
+    def updates(self):
+        messages = sent_messages(self.proto)
+        for message in messages:
+            self.proto.dataReceived(encode_msg({'ok': 1, 'n': 1, 'nModified': 1}, response_to=message.request_id))
+        return [statement.decode(as_class=SON) for message in messages
+                for statement in message.sequences['updates']]
+
+    def test_interval(self):
+        for i in range(100):
+            self.counter.inc({'_id': 'page'}, 'views')
+        self.counter.inc({'_id': 'page'}, 'clicks', 2)
+        self.counter.inc({'_id': 'other'}, 'views')
+        self.assertEqual(self.proto.transport.value(), '')
+
+        self.clock.advance(5)
+        updates = self.updates()
+        self.assertEqual(sorted([(u['q']['_id'], u['u']['$inc']) for u in updates]), [
+                ('other', {'views': 1}),
+                ('page', {'views': 100, 'clicks': 2}),
+            ])
+        self.assertTrue(all([u['upsert'] for u in updates]))
+        self.assertEqual(self.counter.stats(), {'increments': 102, 'updates': 2, 'lost': 0, 'pending': 0})
+
+        # nothing to send
+        self.clock.advance(5)
+        self.assertEqual(self.proto.transport.value(), '')
+
+    def test_max_keys(self):
+        for i in range(3):
+            self.counter.inc({'_id': i}, 'views')
+        self.assertEqual(len(self.updates()), 3)
+        self.assertEqual(len(self.counter), 0)
+
+    @defer.inlineCallbacks
+    def test_stop(self):
+        self.counter.inc({'_id': 'page'}, 'views')
+        d = self.counter.stop()
+        self.assertEqual(len(self.updates()), 1)
+        yield d
+        self.assertFalse(self.counter.running)
+
+        # no more flushes on the interval
+        self.counter.inc({'_id': 'page'}, 'views')
+        self.clock.advance(5)
+        self.assertEqual(self.proto.transport.value(), '')
+        self.assertEqual(len(self.counter), 1)
+
+        d = self.counter.flush()
+        self.updates()
+        yield d
+
+    @defer.inlineCallbacks
+    def test_shutdown(self):
+        trigger = self.counter._trigger
+        self.addCleanup(reactor.removeSystemEventTrigger, trigger)
+        removed = list()
+        self.patch(reactor, 'removeSystemEventTrigger', removed.append)
+
+        self.counter.inc({'_id': 'page'}, 'views')
+        d = self.counter._shutdown()
+        self.assertEqual(len(self.updates()), 1)
+        yield d
+        # the running trigger is left to the reactor
+        self.assertEqual(removed, [])
+        self.assertFalse(self.counter.running)
+
+    @defer.inlineCallbacks
+    def test_failure(self):
+        self.counter.inc({'_id': 1}, 'views')
+        self.counter.inc({'_id': 2}, 'views')
+        d = self.counter.flush()
+        message, = sent_messages(self.proto)
+        self.proto.dataReceived(encode_msg(
+                {'ok': 1, 'n': 1, 'writeErrors': [{'index': 1, 'code': 2, 'errmsg': 'bad'}]},
+                response_to=message.request_id))
+
+        # logged, not raised
+        yield d
+        self.assertEqual(self.counter.stats()['lost'], 1)
+
+    @defer.inlineCallbacks
+    def test_write_concern_failure(self):
+        self.counter.inc({'_id': 1}, 'views')
+        self.counter.inc({'_id': 2}, 'views')
+        d = self.counter.flush()
+        message, = sent_messages(self.proto)
+        self.proto.dataReceived(encode_msg(
+                {'ok': 1, 'n': 2, 'writeConcernError': {'code': 64, 'errmsg': 'waiting for replication timed out'}},
+                response_to=message.request_id))
+
+        # written, but not confirmed
+        yield d
+        self.assertEqual(self.counter.stats()['lost'], 2)
@@ -0,0 +1,426 @@
+# coding: utf-8
+
+"""Test the cursors against a fake connection.
+
+These tests do not need a running mongodb server.
+"""
+
+import bson
+from pymongo import errors
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.trial import unittest
+
+from txmongo2.cursor import TailableCursor, n_to_return
+from txmongo2.database import Database
+from txmongo2.protocol import (
+        Getmore,
+        Query,
+        QUERY_AWAIT_DATA,
+        QUERY_TAILABLE_CURSOR,
+    )
+
+from tests.test_protocol import encode_reply, last_message, make_protocol
+
+
+class FakeConnection (object, ) :
+    def __init__ (self, ) :
+        self.proto = make_protocol()
+
+    def getprotocol (self, _type='read', ) :
+        return self.proto
+
+
+class CursorTestCase (unittest.TestCase, ) :
+
+    def setUp(self):
+        self.connection = FakeConnection()
+        self.coll = Database(self.connection, 'mydb').mycol
+        self.clock = task.Clock()
+
+    @property
+    def proto(self):
+        return self.connection.proto
+
+    def reply(self, documents, cursor_id=0, request=None):
+        if request is None:
+            request = last_message(self.proto)
+        self.proto.dataReceived(encode_reply(documents, response_to=request.request_id,
+                                             cursor_id=cursor_id))
+        return request
+
+
+class TestKillCursors (CursorTestCase, ) :
+
+    def setUp(self):
+        CursorTestCase.setUp(self)
+        self.proto.clock = self.clock
+
+    @defer.inlineCallbacks
+    def test_find_limit(self):
+        d = self.coll.find(limit=3)
+        self.reply([{'a': 1}, {'a': 2}], cursor_id=10)
+        self.assertEqual(len(self.proto.cursors), 1)
+        self.reply([{'a': 3}], cursor_id=10)
+        documents = yield d
+        self.assertEqual(len(documents), 3)
+
+        self.clock.advance(self.proto.cursors.interval)
+        self.assertEqual(last_message(self.proto).cursors, [10])
+
+    @defer.inlineCallbacks
+    def test_find_exhausted(self):
+        d = self.coll.find(limit=3)
+        self.reply([{'a': 1}, {'a': 2}], cursor_id=10)
+        self.reply([{'a': 3}], cursor_id=0)
+        yield d
+
+        self.assertEqual(len(self.proto.cursors), 0)
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_find_failure(self):
+        d = self.coll.find(limit=3)
+        self.reply([{'a': 1}], cursor_id=10)
+        d.cancel()
+
+        self.clock.advance(self.proto.cursors.interval)
+        self.assertEqual(last_message(self.proto).cursors, [10])
+        return self.assertFailure(d, defer.CancelledError)
+
+
+class TestCursor (CursorTestCase, ) :
+
+    def setUp(self):
+        CursorTestCase.setUp(self)
+        self.proto.clock = self.clock
+
+    @defer.inlineCallbacks
+    def test_find_no_limit(self):
+        d = self.coll.find()
+        self.reply([{'a': 1}, {'a': 2}], cursor_id=10)
+        getmore = self.reply([{'a': 3}], cursor_id=0)
+        self.assertTrue(isinstance(getmore, Getmore))
+        self.assertEqual(getmore.n_to_return, 0)
+        documents = yield d
+        self.assertEqual(documents, [{'a': 1}, {'a': 2}, {'a': 3}])
+
+    @defer.inlineCallbacks
+    def test_next_batch(self):
+        cursor = self.coll.find_cursor({'a': 1}, batch_size=2)
+        d = cursor.next_batch()
+        query = self.reply([{'a': 1}, {'a': 2}], cursor_id=10)
+        self.assertEqual(query.n_to_return, 2)
+        self.assertEqual(query.query.decode(), {'a': 1})
+        batch = yield d
+        self.assertEqual(batch, [{'a': 1}, {'a': 2}])
+        self.assertTrue(cursor.alive)
+
+        d = cursor.next_batch()
+        getmore = self.reply([{'a': 3}], cursor_id=0)
+        self.assertEqual(getmore.n_to_return, 2)
+        batch = yield d
+        self.assertEqual(batch, [{'a': 3}])
+        self.assertFalse(cursor.alive)
+
+        batch = yield cursor.next_batch()
+        self.assertEqual(batch, [])
+
+    @defer.inlineCallbacks
+    def test_next(self):
+        cursor = self.coll.find_cursor()
+        d = cursor.next()
+        self.reply([{'a': 1}, {'a': 2}], cursor_id=0)
+        self.assertEqual((yield d), {'a': 1})
+        self.assertEqual((yield cursor.next()), {'a': 2})
+        self.assertEqual((yield cursor.next()), None)
+
+    @defer.inlineCallbacks
+    def test_each(self):
+        documents = list()
+        cursor = self.coll.find_cursor()
+        d = cursor.each(documents.append)
+        self.reply([{'a': 1}], cursor_id=10)
+        self.reply([{'a': 2}], cursor_id=0)
+        yield d
+        self.assertEqual(documents, [{'a': 1}, {'a': 2}])
+
+    def test_each_failure(self):
+        cursor = self.coll.find_cursor()
+        d = cursor.each(lambda document: 1 / 0)
+        self.reply([{'a': 1}], cursor_id=10)
+
+        self.assertFalse(cursor.alive)
+        self.clock.advance(self.proto.cursors.interval)
+        self.assertEqual(last_message(self.proto).cursors, [10])
+        return self.assertFailure(d, ZeroDivisionError)
+
+    @defer.inlineCallbacks
+    def test_to_list_limit(self):
+        cursor = self.coll.find_cursor(limit=3, batch_size=2)
+        d = cursor.to_list()
+        query = self.reply([{'a': 1}, {'a': 2}], cursor_id=10)
+        self.assertEqual(query.n_to_return, 2)
+        getmore = self.reply([{'a': 3}, {'a': 4}], cursor_id=10)
+        self.assertEqual(getmore.n_to_return, 1)
+        documents = yield d
+        self.assertEqual(documents, [{'a': 1}, {'a': 2}, {'a': 3}])
+        self.assertFalse(cursor.alive)
+
+    @defer.inlineCallbacks
+    def test_batch_size_one(self):
+        # the server would close the cursor after one document
+        d = self.coll.find(limit=5, batch_size=1)
+        requests = [self.reply([{'a': 1}, {'a': 2}], cursor_id=10),
+                    self.reply([{'a': 3}, {'a': 4}], cursor_id=10),
+                    self.reply([{'a': 5}], cursor_id=0)]
+        self.assertEqual([request.n_to_return for request in requests], [2, 2, 1])
+        documents = yield d
+        self.assertEqual(documents, [{'a': i} for i in range(1, 6)])
+
+        self.assertEqual(n_to_return(1, limit=-1), -1)
+        d = self.coll.find(exhaust=True, batch_size=1)
+        self.assertEqual(self.reply([{'a': 1}]).n_to_return, 2)
+        yield d
+
+    def test_fetching(self):
+        cursor = self.coll.find_cursor()
+        cursor.fetch()
+        return self.assertFailure(cursor.fetch(), errors.InvalidOperation)
+
+
+class TestRaw (CursorTestCase, ) :
+
+    @defer.inlineCallbacks
+    def test_find(self):
+        d = self.coll.find(raw=True)
+        self.reply([{'a': 1}, {'a': 2}])
+        documents = yield d
+        self.assertEqual(documents, [bson.BSON.encode({'a': 1}), bson.BSON.encode({'a': 2})])
+        self.assertTrue(isinstance(documents[0], bson.BSON))
+
+    @defer.inlineCallbacks
+    def test_find_one(self):
+        d = self.coll.find_one(raw=True)
+        self.reply([{'a': 1}])
+        self.assertEqual((yield d), bson.BSON.encode({'a': 1}))
+
+        d = self.coll.find_one(raw=True)
+        self.reply([])
+        self.assertEqual((yield d), None)
+
+    @defer.inlineCallbacks
+    def test_cursor(self):
+        cursor = self.coll.find_cursor(raw=True)
+        d = cursor.next()
+        self.reply([{'a': 1}])
+        self.assertEqual((yield d), bson.BSON.encode({'a': 1}))
+
+
+class TestPrefetch (CursorTestCase, ) :
+
+    def setUp(self):
+        CursorTestCase.setUp(self)
+        self.proto.clock = self.clock
+        self.cursor = self.coll.find_cursor(batch_size=2, prefetch=True)
+
+    @defer.inlineCallbacks
+    def test_prefetch(self):
+        d = self.cursor.next_batch()
+        self.reply([{'a': 1}, {'a': 2}], cursor_id=10)
+        self.assertEqual((yield d), [{'a': 1}, {'a': 2}])
+
+        # the next batch is requested before it is asked for
+        getmore = last_message(self.proto)
+        self.assertTrue(isinstance(getmore, Getmore))
+        self.reply([{'a': 3}, {'a': 4}], cursor_id=10, request=getmore)
+
+        # it was ready, the batch size stays
+        self.assertEqual((yield self.cursor.next_batch()), [{'a': 3}, {'a': 4}])
+        self.assertEqual(last_message(self.proto).n_to_return, 2)
+
+    @defer.inlineCallbacks
+    def test_grow_batch_size(self):
+        d = self.cursor.next_batch()
+        self.reply([{'a': 1}, {'a': 2}], cursor_id=10)
+        yield d
+
+        # the consumer waits for the prefetched batch
+        d = self.cursor.next_batch()
+        self.reply([{'a': 3}, {'a': 4}], cursor_id=10)
+        self.assertEqual((yield d), [{'a': 3}, {'a': 4}])
+        self.assertEqual(self.cursor.batch_size, 4)
+        self.assertEqual(last_message(self.proto).n_to_return, 4)
+
+    def test_max_batch_bytes(self):
+        self.cursor.max_batch_bytes = 100
+        self.cursor.next_batch()
+        self.reply([{'s': 'x' * 40}, {'s': 'x' * 40}], cursor_id=10)
+        self.cursor.next_batch()
+        self.assertEqual(self.cursor.batch_size, 1)
+
+    def test_close(self):
+        self.cursor.next_batch()
+        self.reply([{'a': 1}], cursor_id=10)
+        getmore = last_message(self.proto)
+        self.cursor.close()
+        self.reply([{'a': 2}], cursor_id=10, request=getmore)
+
+        self.clock.advance(self.proto.cursors.interval)
+        self.assertEqual(last_message(self.proto).cursors, [10])
+        self.assertEqual(len(self.proto.cursors), 0)
+
+    @defer.inlineCallbacks
+    def test_to_list_limit(self):
+        cursor = self.coll.find_cursor(limit=3, batch_size=2, prefetch=True)
+        d = cursor.to_list()
+        self.reply([{'a': 1}, {'a': 2}], cursor_id=10)
+        self.reply([{'a': 3}], cursor_id=10)
+        self.assertEqual((yield d), [{'a': 1}, {'a': 2}, {'a': 3}])
+
+
+class TestCommandCursor (CursorTestCase, ) :
+
+    def setUp(self):
+        CursorTestCase.setUp(self)
+        self.proto.clock = self.clock
+
+    def reply_cursor(self, documents, cursor_id=0, ns='mydb.mycol'):
+        return self.reply([{'cursor': {'id': cursor_id, 'ns': ns, 'firstBatch': documents}, 'ok': 1}])
+
+    @defer.inlineCallbacks
+    def test_aggregate(self):
+        pipeline = [{'$match': {'a': {'$gt': 0}}}, {'$group': {'_id': '$a'}}]
+        cursor = self.coll.aggregate(pipeline, batch_size=2, allowDiskUse=True)
+        d = cursor.next_batch()
+        query = self.reply_cursor([{'_id': 1}, {'_id': 2}], cursor_id=10)
+        self.assertEqual(query.collection, 'mydb.$cmd')
+        self.assertEqual(query.query.decode(), {
+                'aggregate': 'mycol',
+                'pipeline': pipeline,
+                'cursor': {'batchSize': 2},
+                'allowDiskUse': True,
+            })
+        self.assertEqual((yield d), [{'_id': 1}, {'_id': 2}])
+        self.assertEqual(len(self.proto.cursors), 1)
+
+        d = cursor.to_list()
+        getmore = self.reply([{'_id': 3}], cursor_id=0)
+        self.assertTrue(isinstance(getmore, Getmore))
+        self.assertEqual((getmore.collection, getmore.cursor_id, getmore.n_to_return), ('mydb.mycol', 10, 2))
+        self.assertEqual((yield d), [{'_id': 3}])
+        self.assertEqual(len(self.proto.cursors), 0)
+
+    @defer.inlineCallbacks
+    def test_raw(self):
+        cursor = self.coll.aggregate([], raw=True)
+        d = cursor.to_list()
+        query = self.reply_cursor([{'_id': 1}])
+        self.assertEqual(query.query.decode()['cursor'], {})
+        documents = yield d
+        self.assertEqual(documents, [bson.BSON.encode({'_id': 1})])
+
+    @defer.inlineCallbacks
+    def test_close(self):
+        cursor = self.coll.aggregate([])
+        d = cursor.next()
+        self.reply_cursor([{'_id': 1}], cursor_id=10)
+        self.assertEqual((yield d), {'_id': 1})
+        cursor.close()
+
+        self.clock.advance(self.proto.cursors.interval)
+        self.assertEqual(last_message(self.proto).cursors, [10])
+
+    def test_failure(self):
+        d = self.coll.aggregate([{'$bad': 1}]).to_list()
+        self.reply([{'ok': 0, 'errmsg': 'Unrecognized pipeline stage name', 'code': 16436}])
+        return self.assertFailure(d, errors.OperationFailure)
+
+    def test_pipeline_type(self):
+        self.assertRaises(TypeError, self.coll.aggregate, {'$match': {}})
+
+
+class TestTailableCursor (CursorTestCase, ) :
+
+    def setUp(self):
+        CursorTestCase.setUp(self)
+        self.patch(TailableCursor, 'clock', self.clock)
+        self.documents = list()
+        self.cursor = self.coll.tail(self.documents.append, spec={'a': 1})
+
+    def test_tail(self):
+        query = self.reply([{'_id': 1}, {'_id': 2}], cursor_id=10)
+        self.assertTrue(isinstance(query, Query))
+        self.assertTrue(query.flags & QUERY_TAILABLE_CURSOR)
+        self.assertTrue(query.flags & QUERY_AWAIT_DATA)
+        self.assertEqual(self.documents, [{'_id': 1}, {'_id': 2}])
+
+        getmore = self.reply([{'_id': 3}], cursor_id=10)
+        self.assertTrue(isinstance(getmore, Getmore))
+        self.assertEqual(getmore.cursor_id, 10)
+        self.assertEqual(self.documents[-1], {'_id': 3})
+
+        # the server waited for data, so the next getmore is sent at once
+        self.reply([], cursor_id=10)
+        self.assertTrue(isinstance(last_message(self.proto), Getmore))
+
+    def test_backoff(self):
+        self.cursor.stop()
+        self.cursor = self.coll.tail(self.documents.append, await_data=False)
+        self.reply([{'_id': 1}], cursor_id=10)
+
+        # an empty batch delays the next getmore
+        self.reply([], cursor_id=10)
+        self.assertEqual(self.proto.transport.value(), '')
+        self.clock.advance(self.cursor.min_delay)
+        self.assertTrue(isinstance(last_message(self.proto), Getmore))
+
+    def test_resume(self):
+        self.reply([{'_id': 1}, {'_id': 2}], cursor_id=10)
+        last_message(self.proto)
+        self.proto.connectionLost(failure.Failure(error.ConnectionLost()))
+
+        self.connection.proto = make_protocol()
+        self.clock.advance(self.cursor.min_delay)
+        query = last_message(self.proto)
+        self.assertEqual(query.query.decode(), {'a': 1, '_id': {'$gt': 2}})
+
+    def test_resume_field_returned(self):
+        self.cursor.stop()
+        cursor = self.coll.tail(self.documents.append, fields=['a'], oplog_replay=True)
+        self.assertEqual(self.reply([]).fields.decode(), {'a': 1, 'ts': 1})
+        cursor.stop()
+
+        cursor = self.coll.tail(self.documents.append, fields={'_id': 0, 'big': 0})
+        self.assertEqual(self.reply([]).fields.decode(), {'big': 0})
+        cursor.stop()
+
+    def test_dead_cursor(self):
+        self.reply([], cursor_id=0)
+        self.clock.advance(self.cursor.min_delay)
+        self.assertTrue(isinstance(last_message(self.proto), Query))
+
+    @defer.inlineCallbacks
+    def test_stop_backoff(self):
+        d = self.cursor.start()
+        self.reply([], cursor_id=0)
+        self.cursor.stop()
+        yield d
+
+        self.clock.advance(self.cursor.max_delay)
+        self.assertEqual(self.proto.transport.value(), '')
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    @defer.inlineCallbacks
+    def test_stop(self):
+        d = self.cursor.start()
+        self.reply([{'_id': 1}], cursor_id=10)
+        self.cursor.stop()
+        self.reply([{'_id': 2}], cursor_id=10)
+        yield d
+
+        self.assertTrue(self.cursor.stopped)
+        self.assertEqual(self.documents, [{'_id': 1}])
+
+        self.proto.clock = self.clock
+        self.proto.cursors.flush()
+        self.assertEqual(last_message(self.proto).cursors, [10])
@@ -0,0 +1,87 @@
+# coding: utf-8
+
+"""Test the batching loader against a fake connection.
+
+These tests do not need a running mongodb server.
+"""
+
+from bson import ObjectId
+from twisted.internet import defer, error
+from twisted.python import failure
+
+from txmongo2.loader import Loader
+
+from tests.test_bulk import sent_messages
+from tests.test_cursor import CursorTestCase
+from tests.test_protocol import encode_reply
+
+
+class TestLoader(CursorTestCase):
+
+    def setUp(self):
+        CursorTestCase.setUp(self)
+        self.patch(Loader, 'clock', self.clock)
+
+    def queries(self):
+        self.clock.advance(0)
+        return sent_messages(self.proto)
+
+    @defer.inlineCallbacks
+    def test_load(self):
+        ids = [ObjectId() for i in range(3)]
+        loader = self.coll.loader()
+        dl = [loader.load(i) for i in ids] + [loader.load(ids[0])]
+        self.assertEqual(self.proto.transport.value(), '')
+
+        query, = self.queries()
+        self.assertEqual(sorted(query.query.decode()['_id']['$in']), sorted(ids))
+
+        # the documents come in any order, the second one is missing
+        self.proto.dataReceived(encode_reply([{'_id': ids[2], 'n': 2}, {'_id': ids[0], 'n': 0}],
+                                             response_to=query.request_id))
+        documents = yield defer.gatherResults(dl)
+        self.assertEqual(documents, [{'_id': ids[0], 'n': 0}, None, {'_id': ids[2], 'n': 2},
+                                     {'_id': ids[0], 'n': 0}])
+        self.assertFalse(documents[0] is documents[3])
+
+    def test_max_batch_size(self):
+        loader = self.coll.loader(max_batch_size=2)
+        loader.load_many(range(5))
+        queries = self.queries()
+        self.assertEqual(sorted([len(q.query.decode()['_id']['$in']) for q in queries]), [1, 2, 2])
+
+    @defer.inlineCallbacks
+    def test_key_and_fields(self):
+        loader = self.coll.loader(key='name', fields=['age'])
+        d = loader.load_many(['a', 'b'])
+        query, = self.queries()
+        self.assertEqual(query.query.decode(), {'name': {'$in': ['a', 'b']}})
+        self.assertEqual(query.fields.decode(), {'age': 1, 'name': 1})
+
+        self.proto.dataReceived(encode_reply([{'name': 'b', 'age': 2}], response_to=query.request_id))
+        self.assertEqual((yield d), [None, {'name': 'b', 'age': 2}])
+
+    @defer.inlineCallbacks
+    def test_dotted_key(self):
+        loader = self.coll.loader(key='user.name')
+        d = loader.load_many(['a', 'b'])
+        query, = self.queries()
+        self.assertEqual(query.query.decode(), {'user.name': {'$in': ['a', 'b']}})
+
+        self.proto.dataReceived(encode_reply([{'user': {'name': 'b'}}], response_to=query.request_id))
+        self.assertEqual((yield d), [None, {'user': {'name': 'b'}}])
+
+    def test_failure(self):
+        loader = self.coll.loader()
+        d = loader.load(1)
+        self.queries()
+        self.proto.connectionLost(failure.Failure(error.ConnectionDone()))
+        return self.assertFailure(d, error.ConnectionDone)
+
+    def test_dispatch(self):
+        loader = self.coll.loader()
+        loader.load(1)
+        loader.dispatch()
+        self.assertEqual(len(loader), 0)
+        self.assertEqual(len(sent_messages(self.proto)), 1)
+        self.assertFalse(self.clock.getDelayedCalls())
@@ -0,0 +1,80 @@
+# coding: utf-8
+
+"""Test the keyset paginator against a fake connection.
+
+These tests do not need a running mongodb server.
+"""
+
+from bson.son import SON
+from pymongo import errors
+from twisted.internet import defer
+
+from txmongo2 import filter as qf
+
+from tests.test_cursor import CursorTestCase
+from tests.test_protocol import last_message
+
+
+class TestPaginator(CursorTestCase):
+
+    def setUp(self):
+        CursorTestCase.setUp(self)
+        self.paginator = self.coll.paginator(
+                qf.sort(qf.DESCENDING('score') + qf.ASCENDING('name')), page_size=2, spec={'a': 1})
+
+    @defer.inlineCallbacks
+    def test_pages(self):
+        d = self.paginator.page()
+        query = self.reply([
+                {'_id': 1, 'score': 10, 'name': u'a'},
+                {'_id': 2, 'score': 9, 'name': u'b'},
+                {'_id': 3, 'score': 9, 'name': u'b'},
+            ])
+        self.assertEqual(query.n_to_return, 3)
+        self.assertEqual(query.query.decode(), {
+                '$query': {'a': 1},
+                '$orderby': {'score': -1, 'name': 1, '_id': 1},
+            })
+        documents, token = yield d
+        self.assertEqual([document['_id'] for document in documents], [1, 2])
+
+        d = self.paginator.page(token)
+        query = self.reply([{'_id': 3, 'score': 9, 'name': u'b'}])
+        self.assertEqual(query.query.decode()['$query'], {'$and': [{'a': 1}, {'$or': [
+                {'score': {'$lt': 9}},
+                {'score': 9, 'name': {'$gt': u'b'}},
+                {'score': 9, 'name': u'b', '_id': {'$gt': 2}},
+            ]}]})
+        documents, token = yield d
+        self.assertEqual(len(documents), 1)
+        self.assertEqual(token, None)
+
+    def test_orderby_order(self):
+        # `created` comes after `_id` in a plain dict
+        paginator = self.coll.paginator(qf.sort(qf.ASCENDING('created')))
+        paginator.page()
+        query = last_message(self.proto).query.decode(as_class=SON)
+        self.assertEqual(query['$orderby'].keys(), ['created', '_id'])
+
+    def test_token_of_other_sort(self):
+        other = self.coll.paginator(qf.sort(qf.ASCENDING('name')))
+        token = other.token({'_id': 1, 'name': u'a'})
+        return defer.gatherResults([
+                self.assertFailure(self.paginator.page(token), errors.InvalidOperation),
+                self.assertFailure(self.paginator.page('garbage'), errors.InvalidOperation),
+            ])
+
+    def test_fields(self):
+        paginator = self.coll.paginator(qf.sort(qf.ASCENDING('name')), fields=['title'])
+        paginator.page()
+        fields = last_message(self.proto).fields.decode()
+        self.assertEqual(sorted(fields), ['_id', 'name', 'title'])
+
+    def test_dotted_key(self):
+        paginator = self.coll.paginator(qf.sort(qf.ASCENDING('a.b')))
+        token = paginator.token({'_id': 1, 'a': {'b': 5}})
+        self.assertEqual(paginator.after(paginator._values(token))['$or'][0], {'a.b': {'$gt': 5}})
+
+    def test_sort_type(self):
+        self.assertRaises(TypeError, self.coll.paginator, {'name': 1})
+        self.assertRaises(TypeError, self.coll.paginator, qf.sort(qf.GEO2D('loc')))
@@ -0,0 +1,518 @@
+# coding: utf-8
+
+"""Test the wire protocol encoding and decoding.
+
+These tests do not need a running mongodb server.
+"""
+
+import struct
+
+import bson
+from bson.son import SON
+from pymongo import errors
+from pymongo.uri_parser import parse_uri
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmongo2 import protocol
+from txmongo2.connection import _ConnectionPool
+from txmongo2.factory import BaseConnectionFactory
+from txmongo2.protocol import (
+        LazyDocuments,
+        MongoClientProtocol,
+        MongoDecoder,
+        MongoProtocol,
+        Getmore,
+        Insert,
+        KillCursors,
+        Msg,
+        Query,
+        Reply,
+        MSG_MORE_TO_COME,
+        OP_COMPRESSED,
+        OP_MSG,
+        OP_QUERY,
+        OP_REPLY,
+    )
+
+
+def encode_reply(documents, request_id=1, response_to=0, cursor_id=0, ):
+    documents = [bson.BSON.encode(i) for i in documents]
+    body = struct.pack('<iqii', 0, cursor_id, 0, len(documents), ) + ''.join(documents)
+    return struct.pack('<iiii', 16 + len(body), request_id, response_to, OP_REPLY, ) + body
+
+
+class TestMongoDecoder(unittest.TestCase):
+
+    def test_decode_reply(self):
+        data = encode_reply([{'a': i} for i in range(3)], cursor_id=10, )
+        decoder = MongoDecoder()
+        decoder.feed(data)
+
+        reply = decoder.next()
+        self.assertTrue(isinstance(reply, Reply))
+        self.assertEqual(reply.cursor_id, 10)
+        self.assertEqual(reply.n_returned, 3)
+        self.assertEqual([d.decode() for d in reply.documents], [{'a': i} for i in range(3)])
+        self.assertEqual(decoder.next(), None)
+
+    def test_segmented_feed(self):
+        documents = [{'v': ' ' * 1024, 'i': i} for i in range(256)]
+        data = encode_reply(documents) * 2
+
+        decoder = MongoDecoder()
+        replies = list()
+        for i in range(0, len(data), 1000):
+            decoder.feed(data[i:i + 1000])
+            reply = decoder.next()
+            while reply:
+                replies.append(reply)
+                reply = decoder.next()
+
+        self.assertEqual(len(replies), 2)
+        for reply in replies:
+            self.assertEqual([d.decode() for d in reply.documents], documents)
+        self.assertEqual(len(decoder), 0)
+
+    def test_compact(self):
+        decoder = MongoDecoder()
+        decoder.compact_threshold = 16
+        data = encode_reply([{'a': 1}])
+
+        decoder.feed(data + data[:10])
+        self.assertTrue(decoder.next())
+        decoder.feed(data[10:])
+        self.assertEqual(len(decoder.dataBuffer), len(data))
+        self.assertTrue(decoder.next())
+
+    def test_decode_query(self):
+        transport = proto_helpers.StringTransport()
+        proto = MongoClientProtocol()
+        proto.makeConnection(transport)
+        proto.send_QUERY(Query(collection='mydb.mycol', query={'a': 1}, fields={'a': 1}, n_to_return=5, ))
+        proto.flush()
+
+        query = MongoDecoder().decode(transport.value())
+        self.assertEqual(query.collection, 'mydb.mycol')
+        self.assertEqual(query.n_to_return, 5)
+        self.assertEqual(query.query.decode(), {'a': 1})
+        self.assertEqual(query.fields.decode(), {'a': 1})
+
+
+def make_protocol(uri='mongodb://localhost:27017', ):
+    proto = MongoProtocol()
+    proto.factory = BaseConnectionFactory(parse_uri(uri))
+    proto.coalesce_writes = False
+    proto.makeConnection(proto_helpers.StringTransport())
+    return proto
+
+
+def encode_msg(body, response_to=0, **sequences):
+    transport = proto_helpers.StringTransport()
+    proto = MongoClientProtocol()
+    proto.coalesce_writes = False
+    proto.makeConnection(transport)
+    proto.send_MSG(Msg(response_to=response_to, body=body, sequences=sequences))
+    return transport.value()
+
+
+def last_message(proto):
+    decoder = MongoDecoder()
+    decoder.feed(proto.transport.value())
+    messages = list(iter(decoder.next, None))
+    proto.transport.clear()
+    return messages[-1]
+
+
+class TestOpMsg(unittest.TestCase):
+
+    def test_decode(self):
+        documents = [bson.BSON.encode({'a': i}) for i in range(3)]
+        msg = MongoDecoder().decode(encode_msg({'insert': 'mycol'}, documents=documents))
+
+        self.assertTrue(isinstance(msg, Msg))
+        self.assertEqual(msg.body.decode(), {'insert': 'mycol'})
+        self.assertEqual(msg.sequences.keys(), ['documents'])
+        self.assertEqual(msg.sequences['documents'], documents)
+
+    def test_server_info(self):
+        proto = make_protocol()
+        self.assertFalse(proto.op_msg_enabled())
+
+        proto.set_server_info({'maxWireVersion': 6, 'maxWriteBatchSize': 10})
+        self.assertTrue(proto.op_msg_enabled())
+        self.assertEqual(proto.max_write_batch_size, 10)
+
+    @defer.inlineCallbacks
+    def test_write_command(self):
+        proto = make_protocol('mongodb://localhost:27017/?w=2')
+        d = proto.write_command('mydb', {'insert': 'mycol'}, 'documents',
+                                [bson.BSON.encode({'a': 1})])
+
+        msg = last_message(proto)
+        self.assertEqual(msg.body.decode(),
+                         {'insert': 'mycol', '$db': 'mydb', 'writeConcern': {'w': 2}})
+        self.assertEqual(len(msg.sequences['documents']), 1)
+
+        proto.dataReceived(encode_msg({'ok': 1, 'n': 1}, response_to=msg.request_id))
+        result = yield d
+        self.assertEqual(result, {'ok': 1, 'n': 1})
+
+    @defer.inlineCallbacks
+    def test_write_command_unsafe(self):
+        proto = make_protocol()
+        result = yield proto.write_command('mydb', {'insert': 'mycol'}, 'documents',
+                                           [bson.BSON.encode({'a': 1})], safe=False)
+        self.assertEqual(result, None)
+        self.assertEqual(proto.inflight(), 0)
+
+        msg = last_message(proto)
+        self.assertTrue(msg.flags & MSG_MORE_TO_COME)
+        self.assertEqual(msg.body.decode()['writeConcern'], {'w': 0})
+
+    def test_write_errors(self):
+        proto = make_protocol()
+        d = proto.write_command('mydb', {'insert': 'mycol'}, 'documents',
+                                [bson.BSON.encode({'a': 1})])
+        msg = last_message(proto)
+        proto.dataReceived(encode_msg(
+                {'ok': 1, 'n': 0, 'writeErrors': [{'index': 0, 'code': 11000, 'errmsg': 'dup'}]},
+                response_to=msg.request_id))
+
+        return self.assertFailure(d, errors.DuplicateKeyError)
+
+    def test_command_failure(self):
+        proto = make_protocol()
+        d = proto.send_MSG(Msg(body={'ping': 1, '$db': 'admin'}))
+        msg = last_message(proto)
+        proto.dataReceived(encode_msg({'ok': 0, 'errmsg': 'failed', 'code': 2},
+                                      response_to=msg.request_id))
+
+        return self.assertFailure(d, errors.OperationFailure)
+
+
+class TestExhaust(unittest.TestCase):
+
+    def setUp(self):
+        self.proto = make_protocol()
+        self.replies = list()
+        self.d = self.proto.send_QUERY_EXHAUST(Query(collection='mydb.mycol'), self.replies.append)
+        self.query = last_message(self.proto)
+
+    def feed(self, cursor_id, request_id, response_to):
+        self.proto.dataReceived(encode_reply([{'a': request_id}], request_id=request_id,
+                                             response_to=response_to, cursor_id=cursor_id))
+
+    @defer.inlineCallbacks
+    def test_exhaust(self):
+        self.assertTrue(self.query.flags & protocol.QUERY_EXHAUST)
+
+        self.feed(10, 100, self.query.request_id)
+        self.feed(10, 101, 100)
+        self.assertFalse(self.d.called)
+        self.assertEqual(self.proto.inflight(), 1)
+        self.assertTrue(self.proto.exhausting())
+
+        self.feed(0, 102, 101)
+        reply = yield self.d
+        self.assertEqual(reply.request_id, 102)
+        self.assertEqual([r.request_id for r in self.replies], [100, 101, 102])
+        self.assertEqual(self.proto.inflight(), 0)
+        self.assertFalse(self.proto.exhausting())
+
+    def test_callback_failure(self):
+        def _callback(reply):
+            raise ValueError()
+        self.proto = make_protocol()
+        self.d = self.proto.send_QUERY_EXHAUST(Query(collection='mydb.mycol'), _callback)
+        self.query = last_message(self.proto)
+
+        self.feed(10, 100, self.query.request_id)
+        self.assertEqual(self.proto.inflight(), 1)
+        # still draining the stream
+        self.assertTrue(self.proto.exhausting())
+        self.feed(0, 101, 100)
+        self.assertEqual(self.proto.inflight(), 0)
+        self.assertFalse(self.proto.exhausting())
+
+        return self.assertFailure(self.d, ValueError)
+
+
+class TestCursorRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.proto = make_protocol()
+        self.proto.clock = task.Clock()
+
+    def test_encode_kill_cursors(self):
+        self.proto.send_KILL_CURSORS(KillCursors(cursors=[1, 2]))
+        request = last_message(self.proto)
+        self.assertEqual(request.n_cursors, 2)
+        self.assertEqual(request.cursors, [1, 2])
+
+    def test_kill(self):
+        cursors = self.proto.cursors
+        for i in (10, 11, 12):
+            cursors.add(i, 'mydb.mycol')
+        cursors.add(0, 'mydb.mycol')
+        self.assertEqual(len(cursors), 3)
+
+        cursors.remove(10)
+        cursors.kill(10)
+        cursors.kill(11)
+        cursors.kill(12)
+        self.assertEqual(len(cursors), 0)
+        self.assertEqual(self.proto.transport.value(), '')
+
+        self.proto.clock.advance(cursors.interval)
+        self.assertEqual(last_message(self.proto).cursors, [11, 12])
+        self.assertFalse(self.proto.clock.getDelayedCalls())
+
+    def test_max_cursors(self):
+        self.proto.cursors.max_cursors = 2
+        for i in (10, 11):
+            self.proto.cursors.add(i, 'mydb.mycol')
+            self.proto.cursors.kill(i)
+        self.assertEqual(last_message(self.proto).cursors, [10, 11])
+
+    def test_connection_lost(self):
+        self.proto.cursors.add(10, 'mydb.mycol')
+        self.proto.cursors.add(11, 'mydb.mycol')
+        self.proto.cursors.kill(11)
+        self.proto.connectionLost(failure.Failure(error.ConnectionLost()))
+
+        self.assertEqual(len(self.proto.cursors), 0)
+        self.assertFalse(self.proto.clock.getDelayedCalls())
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.proto = make_protocol()
+        self.proto.compressors = ('snappy', 'zlib', )
+        self.proto.set_server_info({'maxWireVersion': 6, 'compression': ['zlib']})
+
+    def sent_opcode(self):
+        opcode, = struct.unpack('<i', self.proto.transport.value()[12:16])
+        return opcode
+
+    def test_negotiate(self):
+        self.assertEqual(self.proto.compressor.name, 'zlib')
+
+        proto = make_protocol()
+        proto.compressors = ('zlib', )
+        proto.set_server_info({'maxWireVersion': 6})
+        self.assertEqual(proto.compressor, None)
+
+    def test_later_ismaster(self):
+        # the monitor does not request compression
+        self.proto.set_server_info({'maxWireVersion': 6, 'ismaster': True})
+        self.assertEqual(self.proto.compressor.name, 'zlib')
+
+    def test_compress(self):
+        self.proto.send_QUERY(Query(collection='mydb.mycol', query={'a': 'x' * 4096}))
+        self.assertEqual(self.sent_opcode(), OP_COMPRESSED)
+        self.assertTrue(len(self.proto.transport.value()) < 1024)
+
+        query = last_message(self.proto)
+        self.assertEqual(query.opcode, OP_QUERY)
+        self.assertEqual(query.query.decode(), {'a': 'x' * 4096})
+
+    def test_threshold(self):
+        self.proto.send_QUERY(Query(collection='mydb.mycol', query={'a': 1}))
+        self.assertEqual(self.sent_opcode(), OP_QUERY)
+
+    def test_uncompressed_opcodes(self):
+        self.proto.compression_threshold = 0
+        self.proto.send_GETMORE(Getmore(collection='mydb.mycol', cursor_id=1))
+        self.assertNotEqual(self.sent_opcode(), OP_COMPRESSED)
+
+    def test_uncompressed_commands(self):
+        self.proto.compression_threshold = 0
+        self.proto.send_QUERY(Query(collection='admin.$cmd', query=SON([('ismaster', 1), ('compression', ['zlib'])])))
+        self.assertEqual(self.sent_opcode(), OP_QUERY)
+        self.proto.transport.clear()
+        self.proto.send_MSG(Msg(body=SON([('saslStart', 1), ('payload', 'x' * 4096), ('$db', 'admin')])))
+        self.assertEqual(self.sent_opcode(), OP_MSG)
+        self.proto.transport.clear()
+
+        # other commands and queries are compressed
+        self.proto.send_QUERY(Query(collection='mydb.$cmd', query={'count': 'mycol'}))
+        self.assertEqual(self.sent_opcode(), OP_COMPRESSED)
+        self.proto.transport.clear()
+        self.proto.send_QUERY(Query(collection='mydb.mycol', query={'ismaster': 1}))
+        self.assertEqual(self.sent_opcode(), OP_COMPRESSED)
+
+    def test_pool_compressors(self):
+        pool = _ConnectionPool('mongodb://localhost:27017', compressors=['zlib'])
+        self.proto.factory = BaseConnectionFactory(pool.uri)
+        self.assertEqual(self.proto.requested_compressors(), ['zlib'])
+
+    def test_unknown_compressor(self):
+        data = struct.pack('<iiB', OP_QUERY, 10, 99) + 'x' * 10
+        data = struct.pack('<iiii', 16 + len(data), 1, 0, OP_COMPRESSED) + data
+        self.assertRaises(errors.ConnectionFailure, MongoDecoder().decode, data)
+
+
+class TestGroupCommit(unittest.TestCase):
+
+    def setUp(self):
+        self.proto = make_protocol()
+        self.proto.clock = self.clock = task.Clock()
+
+    def messages(self):
+        decoder = MongoDecoder()
+        decoder.feed(self.proto.transport.value())
+        self.proto.transport.clear()
+        return list(iter(decoder.next, None))
+
+    def test_legacy(self):
+        dl = [self.proto.group_commit.insert('mydb', 'mycol', [bson.BSON.encode({'a': i})])
+              for i in range(3)]
+        self.assertEqual(self.proto.transport.value(), '')
+
+        self.clock.advance(0)
+        insert, getlasterror = self.messages()
+        self.assertEqual(insert.collection, 'mydb.mycol')
+        self.assertEqual(insert.flags, protocol.INSERT_CONTINUE_ON_ERROR)
+        self.assertEqual(len(insert.documents), 3)
+
+        results = list()
+        for d in dl:
+            d.addBoth(results.append)
+        self.proto.dataReceived(encode_reply([{'ok': 1, 'err': 'E11000', 'code': 11000}],
+                                             response_to=getlasterror.request_id))
+        self.assertEqual([r.type for r in results], [errors.DuplicateKeyError] * 3)
+
+    def test_write_command(self):
+        self.proto.set_server_info({'maxWireVersion': 6})
+        dl = [self.proto.group_commit.insert('mydb', 'mycol', [bson.BSON.encode({'a': i})])
+              for i in range(3)]
+        self.clock.advance(0)
+        msg, = self.messages()
+        self.assertEqual(msg.body.decode()['ordered'], False)
+        self.assertEqual(len(msg.sequences['documents']), 3)
+
+        results = list()
+        for d in dl:
+            d.addErrback(lambda f: f.type).addCallback(results.append)
+        self.proto.dataReceived(encode_msg(
+                {'ok': 1, 'n': 2, 'writeErrors': [{'index': 1, 'code': 11000, 'errmsg': 'E11000'}]},
+                response_to=msg.request_id))
+        self.assertEqual(results, [None, errors.DuplicateKeyError, None])
+
+    def test_window(self):
+        self.proto.group_commit.window = 0.01
+        self.proto.group_commit.insert('mydb', 'mycol', [bson.BSON.encode({'a': 1})], safe=False)
+        self.proto.group_commit.insert('mydb', 'other', [bson.BSON.encode({'a': 1})], safe=False)
+        self.clock.advance(0.005)
+        self.proto.group_commit.insert('mydb', 'mycol', [bson.BSON.encode({'a': 2})], safe=False)
+        self.assertEqual(len(self.proto.group_commit), 3)
+
+        self.clock.advance(0.005)
+        messages = self.messages()
+        self.assertEqual(sorted([(m.collection, len(m.documents)) for m in messages]),
+                         [('mydb.mycol', 2), ('mydb.other', 1)])
+        self.assertEqual(len(self.proto.group_commit), 0)
+
+    def test_max_write_batch_size(self):
+        self.proto.max_write_batch_size = 2
+        for i in range(3):
+            self.proto.group_commit.insert('mydb', 'mycol', [bson.BSON.encode({'a': i})], safe=False)
+
+        insert, = self.messages()
+        self.assertEqual(len(insert.documents), 2)
+        self.clock.advance(0)
+        insert, = self.messages()
+        self.assertEqual(len(insert.documents), 1)
+
+    def test_connection_lost(self):
+        d = self.proto.group_commit.insert('mydb', 'mycol', [bson.BSON.encode({'a': 1})])
+        self.proto.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertFalse(self.clock.getDelayedCalls())
+        return self.assertFailure(d, error.ConnectionDone)
+
+
+class TestWriteCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = proto_helpers.StringTransport()
+        self.proto = MongoClientProtocol()
+        self.proto.clock = task.Clock()
+        self.proto.makeConnection(self.transport)
+
+    def decode_all(self):
+        decoder = MongoDecoder()
+        decoder.feed(self.transport.value())
+        return list(iter(decoder.next, None))
+
+    def test_coalesce(self):
+        writes = list()
+        self.patch(self.transport, 'writeSequence', lambda data: (writes.append(data),
+                proto_helpers.StringTransport.writeSequence(self.transport, data)))
+
+        self.proto.send_INSERT(Insert(collection='mydb.mycol', documents=[bson.BSON.encode({'a': 1})]))
+        self.proto.send_QUERY(Query(collection='mydb.$cmd', query={'getlasterror': 1}))
+        self.assertEqual(self.transport.value(), '')
+
+        self.proto.clock.advance(0)
+        self.assertEqual(len(writes), 1)
+        self.assertEqual([i.collection for i in self.decode_all()], ['mydb.mycol', 'mydb.$cmd'])
+
+    def test_threshold(self):
+        self.proto.write_buffer_size = 100
+        self.proto.send_QUERY(Query(collection='mydb.mycol', query={'a': 1}))
+        self.assertEqual(self.transport.value(), '')
+
+        self.proto.send_QUERY(Query(collection='mydb.mycol', query={'a': 'x' * 100}))
+        self.assertEqual(len(self.decode_all()), 2)
+        self.assertFalse(self.proto.clock.getDelayedCalls())
+
+    def test_disabled(self):
+        self.proto.coalesce_writes = False
+        self.proto.send_QUERY(Query(collection='mydb.mycol', query={'a': 1}))
+        self.assertEqual(len(self.decode_all()), 1)
+
+
+class TestLazyDocuments(unittest.TestCase):
+
+    def setUp(self):
+        decoder = MongoDecoder()
+        decoder.feed(encode_reply([{'a': i} for i in range(3)]))
+        decoder.feed(encode_reply([{'a': i} for i in range(3, 5)]))
+        self.batches = [decoder.next().documents, decoder.next().documents]
+
+    def test_decode_on_access(self):
+        documents = LazyDocuments(as_class=dict)
+        for batch in self.batches:
+            documents.extend(batch)
+
+        self.assertEqual(len(documents), 5)
+        self.assertEqual(documents[3], {'a': 3})
+        self.assertEqual(documents._decoded.keys(), [3])
+        self.assertTrue(documents[3] is documents[3])
+        self.assertEqual(documents[-1], {'a': 4})
+        self.assertEqual(documents[1:3], [{'a': 1}, {'a': 2}])
+        self.assertEqual(documents, [{'a': i} for i in range(5)])
+        self.assertRaises(IndexError, documents.__getitem__, 5)
+
+    def test_raw(self):
+        documents = LazyDocuments(self.batches[0], raw=True)
+        self.assertTrue(isinstance(documents[0], bson.BSON))
+        self.assertEqual(documents[0].decode(), {'a': 0})
+
+    def test_decode_all(self):
+        self.assertEqual(self.batches[0].decode_all(), [{'a': i} for i in range(3)])
+        self.assertEqual(self.batches[1][1:].decode_all(), [{'a': 4}])
+        self.assertEqual(self.batches[0][::2].decode_all(), [{'a': 0}, {'a': 2}])
+
+    def test_decode_all_without_c(self):
+        self.patch(protocol, '_use_c', False)
+        self.assertEqual(self.batches[0].decode_all(), [{'a': i} for i in range(3)])
+
+    def test_slice_reply_documents(self):
+        batch = self.batches[0][:2]
+        self.assertEqual(len(batch), 2)
+        self.assertEqual([d.decode() for d in batch], [{'a': 0}, {'a': 1}])
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from pymongo import errors
 from twisted.internet import defer
 from twisted.trial import unittest
 import txmongo2
@@ -50,6 +51,23 @@ class TestMongoQueries(unittest.TestCase):
         res = yield self.coll.find(limit=_size + 10, )
         self.assertEqual(len(res), _size)
 
+    @defer.inlineCallbacks
+    def test_LazyDocuments(self):
+        yield self.coll.insert([{'v':i} for i in xrange(10)], safe=True)
+        res = yield self.coll.find(limit=5, lazy=True)
+        self.assertTrue(isinstance(res, txmongo2.protocol.LazyDocuments))
+        self.assertEqual(len(res), 5)
+        self.assertEqual(res[0]['v'], 0)
+
+    @defer.inlineCallbacks
+    def test_Exhaust(self):
+        _size = 450
+        yield self.coll.insert([{'v':i} for i in xrange(_size)], safe=True)
+        res = yield self.coll.find(exhaust=True, batch_size=100, )
+        self.assertEqual(len(res), _size)
+
+        yield self.assertFailure(self.coll.find(limit=10, exhaust=True), errors.InvalidOperation)
+
     @defer.inlineCallbacks
     def tearDown(self):
         yield self.coll.drop()
@@ -0,0 +1,137 @@
+# coding: utf-8
+
+"""Test the parallel scan against fake connections.
+
+These tests do not need a running mongodb server.
+"""
+
+import datetime
+
+from bson.objectid import ObjectId
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from txmongo2 import scan
+from txmongo2.database import Database
+
+from tests.test_protocol import encode_reply, last_message, make_protocol
+
+
+class FakePool (object, ) :
+    def __init__ (self, n_protocols, ) :
+        self.protocols = [make_protocol() for i in range(n_protocols)]
+        for proto in self.protocols:
+            proto.clock = task.Clock()
+
+    def getprotocol (self, _type='read', ) :
+        return self.protocols[0]
+
+    def getprotocols (self, _type='read', ) :
+        return list(self.protocols)
+
+
+def reply(proto, documents, cursor_id=0):
+    request = last_message(proto)
+    proto.dataReceived(encode_reply(documents, response_to=request.request_id, cursor_id=cursor_id))
+    return request
+
+
+class TestBoundaries(unittest.TestCase):
+
+    def test_numbers(self):
+        self.assertEqual(scan.interpolate(0, 100, 4), [25, 50, 75])
+        self.assertEqual(scan.interpolate(0, 1.0, 2), [0.5])
+        # no empty segments
+        self.assertEqual(scan.interpolate(0, 2, 4), [1])
+
+    def test_object_id(self):
+        lower = ObjectId('000000000000000000000000')
+        upper = ObjectId('000000000000000000000064')
+        self.assertEqual(scan.interpolate(lower, upper, 2), [ObjectId('000000000000000000000032')])
+
+    def test_datetime(self):
+        lower = datetime.datetime(2014, 1, 1)
+        upper = datetime.datetime(2014, 1, 3)
+        self.assertEqual(scan.interpolate(lower, upper, 2), [datetime.datetime(2014, 1, 2)])
+
+    def test_other_types(self):
+        self.assertEqual(scan.interpolate(u'a', u'z', 2), None)
+        self.assertEqual(scan.interpolate(1, u'z', 2), None)
+
+    def test_quantiles(self):
+        sample = [u'd', u'b', 3, u'c', u'e', u'c']
+        self.assertEqual(scan.quantiles(sample, u'a', 3), [u'c', u'd'])
+
+    def test_segment_specs(self):
+        self.assertEqual(scan.segment_specs({'a': 1}, []), [{'a': 1}])
+        self.assertEqual(scan.segment_specs(None, [10, 20]), [
+                {'_id': {'$lt': 10}},
+                {'_id': {'$gte': 10, '$lt': 20}},
+                {'_id': {'$gte': 20}},
+            ])
+        self.assertEqual(scan.segment_specs({'a': 1}, [10])[0], {'$and': [{'a': 1}, {'_id': {'$lt': 10}}]})
+
+
+class TestParallelScan(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = FakePool(2)
+        self.coll = Database(self.connection, 'mydb').mycol
+
+    @defer.inlineCallbacks
+    def start(self, lower, upper, n_segments=2, **kwargs):
+        proto = self.connection.protocols[0]
+        d = self.coll.parallel_scan(n_segments, **kwargs)
+        reply(proto, [{'_id': lower}])
+        reply(proto, [{'_id': upper}])
+        parallel = yield d
+        defer.returnValue(parallel)
+
+    @defer.inlineCallbacks
+    def test_to_list(self):
+        parallel = yield self.start(0, 100, spec={'a': 1})
+        self.assertEqual(len(parallel), 2)
+
+        d = parallel.to_list()
+        first, second = self.connection.protocols
+        query = reply(first, [{'_id': 1}, {'_id': 2}], cursor_id=10)
+        self.assertEqual(query.query.decode(), {'$and': [{'a': 1}, {'_id': {'$lt': 50}}]})
+        query = reply(second, [{'_id': 60}])
+        self.assertEqual(query.query.decode(), {'$and': [{'a': 1}, {'_id': {'$gte': 50}}]})
+        reply(first, [{'_id': 3}])
+
+        documents = yield d
+        self.assertEqual(sorted([document['_id'] for document in documents]), [1, 2, 3, 60])
+
+    @defer.inlineCallbacks
+    def test_mixed_types(self):
+        parallel = yield self.start(1, ObjectId())
+        self.assertEqual(len(parallel), 1)
+
+    @defer.inlineCallbacks
+    def test_sample(self):
+        proto = self.connection.protocols[0]
+        d = self.coll.parallel_scan(2)
+        reply(proto, [{'_id': u'a'}])
+        reply(proto, [{'_id': u'z'}])
+        command = reply(proto, [{'cursor': {'id': 0, 'ns': 'mydb.mycol',
+                                            'firstBatch': [{'_id': u'm'}, {'_id': u'b'}]}, 'ok': 1}])
+        self.assertEqual(command.query.decode()['pipeline'][0], {'$sample': {'size': 2 * scan.SAMPLE_PER_SEGMENT}})
+
+        parallel = yield d
+        self.assertEqual(parallel.cursors[1]._spec, {'_id': {'$gte': u'm'}})
+
+    @defer.inlineCallbacks
+    def test_each_failure(self):
+        parallel = yield self.start(0, 100)
+        first, second = self.connection.protocols
+
+        def callback(document):
+            if document['_id'] == 60:
+                raise ValueError(document)
+
+        d = parallel.each(callback)
+        reply(first, [{'_id': 1}], cursor_id=10)
+        reply(second, [{'_id': 60}], cursor_id=20)
+        yield self.assertFailure(d, ValueError)
+        self.assertFalse(any([cursor.alive for cursor in parallel.cursors]))
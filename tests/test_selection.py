@@ -0,0 +1,281 @@
+# coding: utf-8
+
+"""Test the selection strategies and the protocol latency.
+
+These tests do not need a running mongodb server.
+"""
+
+from pymongo import errors
+from pymongo.read_preferences import ReadPreference
+from pymongo.uri_parser import parse_uri
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.trial import unittest
+
+from txmongo2 import selection
+from txmongo2.connection import ReplicaSetConnection, ReplicaSetConnectionMonitor, _ConnectionPool
+from txmongo2.factory import MonitorConnectionFactory
+from txmongo2.protocol import Getmore, Query
+
+from tests.test_protocol import encode_reply, last_message, make_protocol
+
+
+class FakeProtocol (object, ) :
+    def __init__ (self, name, inflight=0, latency=None, state=2, rtt=None, exhausting=False, ) :
+        self.name = name
+        self.n_inflight = inflight
+        self.latency = latency
+        self.config = {'state': state}
+        self.rtt = rtt
+        self.is_exhausting = exhausting
+
+    def inflight (self, ) :
+        return self.n_inflight
+
+    def exhausting (self, ) :
+        return self.is_exhausting
+
+    def __repr__ (self, ) :
+        return self.name
+
+
+class FakeConnection (object, ) :
+    def __init__ (self, protocols, ) :
+        self.protocols = protocols
+        self.connections = dict([(proto.name, proto) for proto in protocols])
+
+    def getprotocols (self, _type='read', ) :
+        if not self.protocols :
+            raise errors.OperationFailure('connections not found.')
+        return self.protocols
+
+
+class TestStrategies(unittest.TestCase):
+
+    def setUp(self):
+        self.protocols = [FakeProtocol('a', 3), FakeProtocol('b', 1), FakeProtocol('c', 2)]
+
+    def count(self, selector, n=300):
+        counts = {}
+        for i in range(n):
+            name = selector.select(self.protocols).name
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def test_round_robin(self):
+        selector = selection.RoundRobin()
+        self.assertEqual([selector.select(self.protocols).name for i in range(7)], list('abcabca'))
+        # fewer protocols than before
+        self.assertEqual(selector.select(self.protocols[:1]).name, 'a')
+
+    def test_least_inflight(self):
+        self.assertEqual(self.count(selection.LeastInflight()), {'b': 300})
+
+    def test_power_of_two_choices(self):
+        counts = self.count(selection.PowerOfTwoChoices())
+        # the busiest one always loses
+        self.assertFalse('a' in counts)
+        self.assertTrue(counts['b'] > counts['c'])
+        self.assertEqual(selection.PowerOfTwoChoices().select(self.protocols[:1]).name, 'a')
+
+    def test_latency_weighted(self):
+        self.protocols = [FakeProtocol('slow', 0, 0.1), FakeProtocol('fast', 0, 0.01)]
+        counts = self.count(selection.LatencyWeighted(), n=1000)
+        self.assertTrue(counts['fast'] > counts.get('slow', 0) * 4, counts)
+
+        # a new protocol counts as the fastest one
+        selector = selection.LatencyWeighted()
+        self.assertEqual(selector.weight(FakeProtocol('new'), 0.01), selector.weight(self.protocols[1], 0.01))
+        # requests in flight make a protocol slower
+        self.assertEqual(selector.weight(FakeProtocol('busy', 1, 0.01), 0.01) * 2,
+                         selector.weight(self.protocols[1], 0.01))
+
+
+class TestPool(unittest.TestCase):
+
+    def make_pool(self, connections, selector=None):
+        pool = _ConnectionPool('mongodb://127.0.0.1:27017', pool_size=len(connections), selector=selector)
+        pool._pool = connections
+        return pool
+
+    def test_round_robin(self):
+        connections = [FakeConnection([FakeProtocol(name)]) for name in 'abc']
+        pool = self.make_pool(connections)
+        names = [pool.getprotocol().name for i in range(9)]
+        # every connection as often as the others
+        self.assertEqual(names, list('abcabcabc'))
+
+    def test_least_inflight(self):
+        connections = [FakeConnection([FakeProtocol('a', 2), FakeProtocol('b', 5)]),
+                       FakeConnection([FakeProtocol('c', 1)])]
+        pool = self.make_pool(connections, selector=selection.LeastInflight())
+        self.assertEqual(pool.getprotocol().name, 'c')
+
+    def test_no_protocol(self):
+        connections = [FakeConnection([]), FakeConnection([FakeProtocol('b')])]
+        pool = self.make_pool(connections)
+        self.assertEqual(pool.getprotocol().name, 'b')
+
+        connections[1].protocols = []
+        self.assertRaises(errors.OperationFailure, pool.getprotocol)
+
+    def test_exhausting(self):
+        connections = [FakeConnection([FakeProtocol('a', exhausting=True)]),
+                       FakeConnection([FakeProtocol('b', 3)])]
+        pool = self.make_pool(connections, selector=selection.LeastInflight())
+        self.assertEqual([proto.name for proto in pool.getprotocols()], ['b'])
+        self.assertEqual(pool.getprotocol().name, 'b')
+
+        # the request waits for the end of the stream
+        connections[1].protocols = []
+        self.assertEqual(pool.getprotocol().name, 'a')
+
+
+class TestLatency(unittest.TestCase):
+
+    def test_latency(self):
+        proto = make_protocol()
+        proto.clock = task.Clock()
+        self.assertEqual(proto.latency, None)
+
+        def query(seconds):
+            proto.send_QUERY(Query(collection='mydb.mycol', query={}))
+            proto.clock.advance(seconds)
+            proto.dataReceived(encode_reply([], response_to=last_message(proto).request_id))
+
+        query(1)
+        self.assertEqual(proto.latency, 1)
+        query(2)
+        self.assertAlmostEqual(proto.latency, 1 + proto.latency_alpha)
+
+
+class TestNearest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = ReplicaSetConnection(parse_uri('mongodb://localhost:27017'))
+        self.connection.uri['options']['read_preferences'] = ReadPreference.NEAREST
+        self.protocols = [
+                FakeProtocol('primary', state=1, rtt=0.002),
+                FakeProtocol('near', rtt=0.010),
+                FakeProtocol('far', rtt=0.080),
+                FakeProtocol('recovering', state=3, rtt=0.001),
+            ]
+        self.connection.connections = dict([(proto.name, proto) for proto in self.protocols])
+
+    def nearest(self):
+        return sorted([proto.name for proto in self.connection.getprotocols()])
+
+    def test_window(self):
+        self.assertEqual(self.nearest(), ['near', 'primary'])
+        names = set([self.connection.getprotocol().name for i in range(50)])
+        self.assertEqual(names, set(['near', 'primary']))
+
+        self.connection.local_threshold_ms = 5
+        self.assertEqual(self.nearest(), ['primary'])
+
+        self.connection.uri['options']['localthresholdms'] = 100
+        self.assertEqual(self.nearest(), ['far', 'near', 'primary'])
+
+    def test_not_probed(self):
+        for proto in self.protocols:
+            proto.rtt = None
+        self.assertEqual(self.nearest(), ['far', 'near', 'primary'])
+
+    def test_writes(self):
+        self.assertEqual(self.connection.getprotocol(_type='write').name, 'primary')
+
+    def test_exhausting(self):
+        self.protocols[0].is_exhausting = True
+        self.assertEqual(self.nearest(), ['near'])
+        self.assertEqual(self.connection.getprotocol(_type='write').name, 'primary')
+
+        self.connection.uri['options']['read_preferences'] = ReadPreference.SECONDARY_PREFERRED
+        self.protocols[1].is_exhausting = True
+        self.assertEqual(self.connection.getprotocol().name, 'far')
+
+
+class TestMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.monitor = ReplicaSetConnectionMonitor(FakeConnection([]))
+        self.monitor.clock = task.Clock()
+        self.probes = list()
+        self.monitor.connect_probe = self.connect_probe
+
+    def connect_probe(self, name):
+        probe = make_protocol('mongodb://%s' % name)
+        probe.factory = MonitorConnectionFactory(self.monitor, probe.factory.uri)
+        self.probes.append(probe)
+        return defer.succeed(probe)
+
+    def probe(self, proto, seconds):
+        d = self.monitor.probe(proto)
+        self.monitor.clock.advance(seconds)
+        probe = self.probes[-1]
+        probe.dataReceived(encode_reply([{'ismaster': True}], response_to=last_message(probe).request_id))
+        self.successResultOf(d)
+
+    def test_probe(self):
+        proto = make_protocol()
+        for seconds in (0.05, 0.15):
+            self.probe(proto, seconds)
+
+        self.assertAlmostEqual(proto.rtt, 0.05 + proto.rtt_alpha * 0.1)
+        # one monitoring connection, kept between the probes
+        self.assertEqual(len(self.probes), 1)
+        self.assertEqual(proto.transport.value(), '')
+
+    def test_busy(self):
+        # a GETMORE waiting for data on the server does not delay the probe
+        proto = make_protocol()
+        proto.send_GETMORE(Getmore(collection='mydb.mycol', cursor_id=10))
+        self.probe(proto, 0.002)
+        self.assertAlmostEqual(proto.rtt, 0.002)
+        self.assertEqual(proto.inflight(), 1)
+
+    def test_reconnect(self):
+        proto = make_protocol()
+        self.probe(proto, 0.01)
+        self.probes[0].connectionLost(failure.Failure(error.ConnectionDone()))
+        self.probe(proto, 0.01)
+        self.assertEqual(len(self.probes), 2)
+
+    def test_close(self):
+        proto = make_protocol()
+        self.monitor._connection.connections = {proto.addr: proto}
+        self.probe(proto, 0.01)
+
+        self.monitor._connection.connections = {}
+        self.monitor._close_probes()
+        self.assertTrue(self.probes[0].transport.disconnecting)
+
+    def test_timeout(self):
+        proto = make_protocol()
+        proto.rtt = 0.01
+        d = self.monitor.probe(proto)
+        self.monitor.clock.advance(self.monitor.timeout)
+
+        self.failureResultOf(d, defer.CancelledError)
+        # left out of the nearest members, on a new monitoring connection
+        self.assertEqual(proto.rtt, None)
+        self.assertTrue(self.probes[0].transport.disconnecting)
+        self.probe(proto, 0.01)
+        self.assertEqual(len(self.probes), 2)
+
+    def test_round_not_held_up(self):
+        proto = make_protocol()
+        self.monitor._connection.connections = {proto.addr: proto}
+        self.monitor._select_connection = lambda: None
+
+        self.monitor.start()
+        self.assertEqual(len(self.probes), 1)
+        # the next rounds start while the probe is unanswered, and do not
+        # probe the member again
+        self.monitor.clock.advance(self.monitor.interval)
+        self.monitor.clock.advance(self.monitor.interval)
+        self.assertEqual(len(self.probes), 1)
+        self.assertTrue(self.probes[0].transport.value())
+
+        self.monitor.clock.advance(self.monitor.timeout)
+        self.monitor.clock.advance(self.monitor.interval)
+        self.assertEqual(len(self.probes), 2)